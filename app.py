@@ -5,9 +5,18 @@ This module provides the application factory pattern for creating Flask app inst
 Routes are organized in separate blueprint modules in the routes package.
 """
 
-from flask import Flask
-from database import init_database, add_sample_data
+import atexit
+from flask import Flask, g
+from database import init_database, add_sample_data, close_pool, refresh_caches
 from routes import register_blueprints
+from commands import register_commands
+from services.payment_service import close_payment_gateway
+from services.payment_jobs import start_payment_workers, stop_payment_workers
+
+# Close pooled connections cleanly when the process exits; registered once here
+# rather than in create_app, which tests and commands call many times
+atexit.register(close_pool)
+atexit.register(close_payment_gateway)
 
 def create_app():
     """
@@ -25,12 +34,28 @@ def create_app():
     # Add sample data for testing and demonstration
     add_sample_data()
     
+    # Requests check out a pooled connection per query rather than for their
+    # whole life, so payment gateway calls and streamed responses don't hold one
+
+    # Pick up catalog changes made by other worker processes; the version is
+    # also used by the blueprints to answer conditional requests
+    @app.before_request
+    def refresh_catalog_version():
+        g.catalog_version = refresh_caches()
+
     # Register all route blueprints
     register_blueprints(app)
+
+    # Register command line tasks (flask --app app <command>)
+    register_commands(app)
     
     return app
 
 
 if __name__ == '__main__':
     app = create_app()
+    # Drain queued payment jobs in the background of the serving process;
+    # other processes run them with `flask --app app payment-worker`
+    start_payment_workers()
+    atexit.register(stop_payment_workers, 5.0)
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,7 @@
+"""
+Benchmarks Package - Performance measurements for the Library Management System
+
+Each module is a standalone script run from the project root, e.g.
+`python -m benchmarks.bench_pragmas`. Benchmarks always work on a throwaway
+database file and never touch library.db.
+"""
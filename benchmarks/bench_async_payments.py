@@ -0,0 +1,48 @@
+"""
+Late fee payments: one blocking PaymentGateway call after another versus a
+concurrent AsyncPaymentGateway batch.
+
+Each simulated charge takes one gateway round trip (0.5 s). Charged one at a
+time, 100 payments take 100 round trips; batched with enough concurrency they
+take about one. Smaller concurrency limits show the round trips growing as
+payments / limit.
+
+Usage: python -m benchmarks.bench_async_payments [--payments 100] [--sequential 100]
+"""
+
+import argparse
+import asyncio
+
+from services.payment_service import AsyncPaymentGateway, PaymentGateway, PAYMENT_LATENCY
+from .util import timed, report
+
+def charge_sequentially(charges: list) -> list:
+    gateway = PaymentGateway()
+    return [gateway.process_payment(*charge) for charge in charges]
+
+def charge_in_batch(charges: list, max_concurrency: int) -> list:
+    gateway = AsyncPaymentGateway(max_concurrency=max_concurrency)
+    return asyncio.run(gateway.process_payments(charges))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payments', type=int, default=100)
+    parser.add_argument('--sequential', type=int, default=100,
+                        help="payments to make with the blocking gateway (0 to skip)")
+    args = parser.parse_args()
+
+    charges = [(str(100000 + i), 5.0 + i % 10, "Late fees") for i in range(args.payments)]
+
+    runs = [("blocking gateway, one at a time", lambda: charge_sequentially(charges[:args.sequential]),
+             args.sequential)] if args.sequential else []
+    runs += [(f"async batch, limit {limit}", lambda limit=limit: charge_in_batch(charges, limit), args.payments)
+             for limit in (10, 50, args.payments)]
+
+    for label, run, count in runs:
+        results, seconds = timed(run)
+        assert all(success for success, _, _ in results)
+        report(f"payments, {label}", count, seconds)
+        print(f"    {count} payments in {seconds:.2f} s = {seconds / PAYMENT_LATENCY:.1f} gateway round trips")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+/api/book/<id> latency with and without the book lookup cache.
+
+Lookups target a catalog where a hot set of books receives most of the
+traffic, as on a busy circulation desk. The benchmark times get_book_by_id
+on its own and the full endpoint through Flask's test client, whose
+per-request overhead is included in the endpoint figure.
+
+Usage: python -m benchmarks.bench_book_cache [--requests 20000] [--books 50000]
+"""
+
+import argparse
+import random
+
+import database
+from app import create_app
+from cache import LRUCache
+from .util import temporary_database, seed_books, timed, report
+
+def book_ids(book_count: int, requests: int) -> list:
+    """90% of lookups go to 500 hot books, the rest anywhere in the catalog."""
+    rng = random.Random(42)
+    hot_books = [rng.randint(1, book_count) for _ in range(500)]
+    return [rng.choice(hot_books) if rng.random() < 0.9 else rng.randint(1, book_count) for _ in range(requests)]
+
+def run_lookups(ids: list) -> None:
+    for book_id in ids:
+        database.get_book_by_id(book_id)
+
+def run_requests(client, ids: list) -> None:
+    for book_id in ids:
+        client.get(f'/api/book/{book_id}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--books', type=int, default=50000)
+    args = parser.parse_args()
+
+    ids = book_ids(args.books, args.requests)
+    original_cache = database.book_cache
+    try:
+        for label, cache in (("no cache", LRUCache(0)),
+                             ("LRU cache", LRUCache(database.BOOK_CACHE_SIZE, database.BOOK_CACHE_TTL))):
+            database.book_cache = cache
+            with temporary_database():
+                seed_books(args.books)
+                client = create_app().test_client()
+                _, lookup_seconds = timed(run_lookups, ids)
+                cache.clear()
+                _, request_seconds = timed(run_requests, client, ids)
+            report(f"get_book_by_id, {label}", args.requests, lookup_seconds)
+            report(f"/api/book/<id>, {label}", args.requests, request_seconds)
+            print(f"    mean latency: lookup {lookup_seconds / args.requests * 1e6:.1f} us, "
+                  f"endpoint {request_seconds / args.requests * 1e6:.0f} us; cache stats {cache.stats()}")
+    finally:
+        database.book_cache = original_cache
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Borrow throughput and oversell check: the old five-round-trip borrow path versus
+the single-transaction borrow_book_by_patron.
+
+At every step all threads try to borrow the same book for different patrons,
+so each book's last copy is raced for. After each run the benchmark counts books
+whose recorded loans exceed their total copies.
+
+Usage: python -m benchmarks.bench_borrow [--threads 8] [--borrows 4000]
+"""
+
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+import database
+from services.library_service import borrow_book_by_patron
+from .util import temporary_database, seed_books, timed, report
+
+BOOK_COUNT = 500
+COPIES = 2
+
+def legacy_borrow(patron_id: str, book_id: int) -> bool:
+    """The pre-transaction borrow path: separate connections for every check and write."""
+    book = database.get_book_by_id(book_id)
+    if not book or book['available_copies'] <= 0:
+        return False
+    if database.get_patron_borrow_count(patron_id) >= 5:
+        return False
+    if any(record['book_id'] == book_id for record in database.get_patron_borrowed_books(patron_id)):
+        return False
+    now = datetime.now()
+    if not database.insert_borrow_record(patron_id, book_id, now, now + timedelta(days=14)):
+        return False
+    return database.update_book_availability(book_id, -1)
+
+def atomic_borrow(patron_id: str, book_id: int) -> bool:
+    return borrow_book_by_patron(patron_id, book_id)[0]
+
+def run(borrow, threads: int, borrows: int) -> tuple:
+    """Run `borrows` borrow attempts over `threads` threads; return (successes, oversold books)."""
+    successes = [0] * threads
+
+    def worker(index):
+        for attempt in range(index, borrows, threads):
+            patron_id = str(100000 + attempt).zfill(6)
+            if borrow(patron_id, 1 + (attempt // threads) % BOOK_COUNT):
+                successes[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    with database.db_connection() as conn:
+        oversold = conn.execute('''
+            SELECT COUNT(*) FROM books b
+            WHERE (SELECT COUNT(*) FROM borrow_records br WHERE br.book_id = b.id AND br.return_date IS NULL) > b.total_copies
+               OR b.available_copies < 0
+        ''').fetchone()[0]
+    return sum(successes), oversold
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--borrows', type=int, default=4000)
+    args = parser.parse_args()
+
+    for label, borrow in (("legacy five round trips", legacy_borrow), ("single transaction", atomic_borrow)):
+        with temporary_database():
+            seed_books(BOOK_COUNT, copies=COPIES)
+            database.configure_pool(size=args.threads)
+            (successes, oversold), seconds = timed(run, borrow, args.threads, args.borrows)
+        report(f"{label}: borrow attempts", args.borrows, seconds)
+        print(f"{label}: successful borrows {successes} (copies available {BOOK_COUNT * COPIES}), "
+              f"oversold books {oversold}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Bulk catalog import: import_books versus one add_book_to_catalog call per row.
+
+A synthetic CSV file is written first (with 1% of rows repeating an earlier
+ISBN), then loaded into an empty catalog. The per-row baseline only runs over
+the first --baseline-rows rows, since it commits once per book. Peak memory of
+the import is measured in a separate run so tracing does not skew the timings.
+
+Usage: python -m benchmarks.bench_catalog_import [--rows 200000] [--baseline-rows 5000] [--batch-size 5000]
+"""
+
+import argparse
+import csv
+import os
+import tempfile
+import tracemalloc
+
+from services.catalog_import import import_books
+from services.library_service import add_book_to_catalog
+from .util import temporary_database, timed, report
+
+def write_catalog_file(path: str, rows: int) -> None:
+    with open(path, 'w', newline='') as target:
+        writer = csv.writer(target)
+        writer.writerow(('title', 'author', 'isbn', 'total_copies'))
+        for i in range(rows):
+            isbn = i - 1 if i % 100 == 99 else i
+            writer.writerow((f"Imported book {i}", f"Author {i % 5003}", str(isbn).zfill(13), 1 + i % 5))
+
+def add_books_one_by_one(path: str, limit: int) -> int:
+    added = 0
+    with open(path, newline='') as source:
+        for i, row in enumerate(csv.DictReader(source)):
+            if i >= limit:
+                break
+            added += add_book_to_catalog(row['title'], row['author'], row['isbn'], int(row['total_copies']))[0]
+    return added
+
+def run_import(path: str, batch_size: int) -> dict:
+    with open(path, newline='') as source:
+        return import_books(source, 'csv', batch_size)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--baseline-rows', type=int, default=5000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="library-import-")
+    path = os.path.join(directory, "catalog.csv")
+    try:
+        write_catalog_file(path, args.rows)
+
+        with temporary_database():
+            added, seconds = timed(add_books_one_by_one, path, args.baseline_rows)
+        report("add_book_to_catalog per row", args.baseline_rows, seconds)
+
+        with temporary_database():
+            result, seconds = timed(run_import, path, args.batch_size)
+        report(f"import_books, batches of {args.batch_size}", result['rows'], seconds)
+        print(f"    {result['imported']} imported, {result['duplicates']} duplicates, {result['invalid']} invalid")
+
+        with temporary_database():
+            tracemalloc.start()
+            run_import(path, args.batch_size)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        print(f"    peak traced memory during import: {peak / 2**20:.1f} MiB for {args.rows} rows")
+    finally:
+        os.remove(path)
+        os.rmdir(directory)
+
+if __name__ == '__main__':
+    main()
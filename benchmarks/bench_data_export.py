@@ -0,0 +1,60 @@
+"""
+Bulk export of books and loans: streamed export_rows versus building the export from get_all_books().
+
+The buffered baseline loads the whole catalog as Book records and joins the
+CSV into one string, which is what an export built on get_all_books() would
+have to do. Exports are timed without tracing, then run again under
+tracemalloc to record peak memory.
+
+Usage: python -m benchmarks.bench_data_export [--books 200000] [--loans 200000]
+"""
+
+import argparse
+import csv
+import io
+import tracemalloc
+
+from database import get_all_books
+from services.data_export import export_rows
+from .util import temporary_database, seed_books, seed_loans, timed, report
+
+def buffered_books_csv() -> int:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(('id', 'title', 'author', 'isbn', 'total_copies', 'available_copies'))
+    writer.writerows([book[field] for field in book] for book in get_all_books())
+    return len(buffer.getvalue())
+
+def streamed(name: str, format: str) -> int:
+    return sum(len(chunk) for chunk in export_rows(name, format))
+
+def peak_memory(function, *args) -> float:
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=200000)
+    parser.add_argument('--loans', type=int, default=200000)
+    args = parser.parse_args()
+
+    with temporary_database():
+        seed_books(args.books)
+        seed_loans(args.loans, args.books)
+        cases = (
+            ("books CSV, buffered via get_all_books()", args.books, buffered_books_csv),
+            ("books CSV, streamed", args.books, streamed, 'books', 'csv'),
+            ("books NDJSON, streamed", args.books, streamed, 'books', 'ndjson'),
+            ("loans CSV, streamed", args.loans, streamed, 'loans', 'csv'),
+            ("loans NDJSON, streamed", args.loans, streamed, 'loans', 'ndjson'),
+        )
+        for label, rows, function, *function_args in cases:
+            size, seconds = timed(function, *function_args)
+            report(label, rows, seconds)
+            print(f"    {size / 2**20:.1f} MiB written, peak traced memory {peak_memory(function, *function_args):.1f} MiB")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Per-charge latency over the real HTTP path: a new connection for every call
+versus PaymentGateway's pooled keep-alive session.
+
+Charges go to the local stub gateway (services/stub_gateway.py), first one at a
+time and then from several threads sharing one gateway. The stub counts the
+TCP connections it accepts, so the report shows how many each run opened.
+Connections to the stub are plain HTTP on localhost; against a real TLS
+gateway, every new connection also pays for a TLS handshake, so pooling
+saves more than it does here.
+
+Usage: python -m benchmarks.bench_gateway_pooling [--charges 2000] [--threads 8] [--latency 0.0]
+"""
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from services.payment_service import PaymentGateway
+from services.stub_gateway import start_stub_gateway
+
+def timed_charge(gateway: PaymentGateway, i: int) -> float:
+    start = time.perf_counter()
+    success, _, _ = gateway.process_payment(str(100000 + i % 900000), 5.0, "Late fees")
+    assert success
+    return time.perf_counter() - start
+
+def run(server, label: str, charges: int, threads: int, pooled: bool) -> None:
+    server.connections = 0
+    with PaymentGateway(base_url=server.url, pooled=pooled, pool_size=threads) as gateway:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = sorted(executor.map(lambda i: timed_charge(gateway, i), range(charges)))
+        elapsed = time.perf_counter() - start
+    print(f"{label:<34} {charges / elapsed:>8.0f} charges/s  "
+          f"mean {statistics.mean(latencies) * 1e3:6.2f} ms  "
+          f"p50 {latencies[len(latencies) // 2] * 1e3:6.2f} ms  "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e3:6.2f} ms  "
+          f"{server.connections:>5} connections")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--charges', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the stub adds to every request")
+    args = parser.parse_args()
+
+    server = start_stub_gateway(latency=args.latency)
+    try:
+        for threads in (1, args.threads):
+            for pooled in (False, True):
+                label = f"{'pooled' if pooled else 'new connection'}, {threads} thread(s)"
+                run(server, label, args.charges, threads, pooled)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Overdue sweep throughput: a per-loan Python loop over compute_late_fee versus
+the vectorized NumPy sweep, at library scale.
+
+Fee calculation is timed on its own over the same loans: the scalar loop
+parses each ISO due date with datetime.fromisoformat and calls
+compute_late_fee, the vectorized path is compute_late_fees over the integer
+due timestamps. The full nightly job (query, fees and
+summary report) is timed separately. The benchmark checks that both fee
+calculations produce identical results.
+
+Usage: python -m benchmarks.bench_overdue_sweep [--loans 1000000] [--books 50000]
+"""
+
+import argparse
+from datetime import datetime
+
+import database
+from database import get_open_loan_columns
+from services.library_service import compute_late_fee
+from services.overdue_sweep import compute_late_fees, sweep_overdue_loans, summarize_sweep
+from .util import temporary_database, seed_books, seed_loans, timed, report
+
+def scalar_fees(due_dates: list, as_of: datetime) -> tuple:
+    """The row-at-a-time calculation: one fromisoformat and one compute_late_fee call per loan."""
+    results = [compute_late_fee(datetime.fromisoformat(due_date), as_of) for due_date in due_dates]
+    return [result['days_overdue'] for result in results], [result['fee_amount'] for result in results]
+
+def read_due_dates() -> list:
+    """Read every open loan's ISO due date, as the sweep did before loan timestamps."""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        return [row[0] for row in cursor.execute(
+            'SELECT due_date FROM borrow_records WHERE return_date IS NULL ORDER BY id')]
+
+def nightly_sweep(as_of: datetime) -> dict:
+    return summarize_sweep(sweep_overdue_loans(as_of))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loans', type=int, default=1000000)
+    parser.add_argument('--books', type=int, default=50000)
+    args = parser.parse_args()
+
+    with temporary_database():
+        seed_books(args.books)
+        seed_loans(args.loans, args.books)
+        as_of = datetime.now()
+
+        due_dates = read_due_dates()
+        (_, _, _, due_timestamps), fetch_seconds = timed(get_open_loan_columns)
+        (scalar_days, scalar_amounts), scalar_seconds = timed(scalar_fees, due_dates, as_of)
+        (days, amounts), vector_seconds = timed(compute_late_fees, due_timestamps, as_of)
+        summary, sweep_seconds = timed(nightly_sweep, as_of)
+
+    identical = scalar_days == days.tolist() and scalar_amounts == amounts.tolist()
+    report("read all open loans", args.loans, fetch_seconds)
+    report("late fees, per-loan loop", args.loans, scalar_seconds)
+    report("late fees, vectorized", args.loans, vector_seconds)
+    report("nightly sweep: query, fees and summary", args.loans, sweep_seconds)
+    print(f"    {summary['overdue_loans']} overdue loans, ${summary['total_late_fees']:,.2f} in fees; "
+          f"scalar and vectorized results identical: {identical}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Mixed read/write throughput with SQLite defaults versus the tuned PRAGMA profile.
+
+Reader threads look books up by ID and list a page of the catalog while writer
+threads record borrows, which is the traffic mix of the catalog and borrowing
+routes under load.
+
+Usage: python -m benchmarks.bench_pragmas [--seconds 3] [--readers 6] [--writers 2]
+"""
+
+import argparse
+import threading
+import time
+from datetime import datetime, timedelta
+
+import database
+from .util import temporary_database, seed_books, report
+
+BOOK_COUNT = 5000
+
+DEFAULT_PROFILE = ('DELETE', {})
+TUNED_PROFILE = (database.JOURNAL_MODE, dict(database.PRAGMAS))
+
+def run_workload(seconds: float, readers: int, writers: int) -> dict:
+    """Run readers and writers against the current database for `seconds`; return operation counts."""
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    stop = time.monotonic() + seconds
+
+    def reader(seed):
+        reads = errors = 0
+        book_id = seed
+        while time.monotonic() < stop:
+            try:
+                database.get_book_by_id(1 + book_id % BOOK_COUNT)
+                with database.db_connection() as conn:
+                    conn.execute('SELECT * FROM books ORDER BY title LIMIT 50').fetchall()
+                reads += 2
+            except Exception:
+                errors += 1
+            book_id += 7
+        with lock:
+            counts['reads'] += reads
+            counts['errors'] += errors
+
+    def writer(seed):
+        writes = errors = 0
+        book_id = seed
+        while time.monotonic() < stop:
+            now = datetime.now()
+            ok = database.insert_borrow_record(str(seed).zfill(6), 1 + book_id % BOOK_COUNT, now, now + timedelta(days=14))
+            ok = database.update_book_availability(1 + book_id % BOOK_COUNT, 0) and ok
+            if ok:
+                writes += 2
+            else:
+                errors += 1
+            book_id += 13
+        with lock:
+            counts['writes'] += writes
+            counts['errors'] += errors
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+def run_profile(label: str, profile: tuple, seconds: float, readers: int, writers: int) -> None:
+    """Benchmark one PRAGMA profile on a fresh database."""
+    journal_mode, pragmas = profile
+    original = (database.JOURNAL_MODE, database.PRAGMAS)
+    database.JOURNAL_MODE, database.PRAGMAS = journal_mode, pragmas
+    try:
+        with temporary_database():
+            seed_books(BOOK_COUNT)
+            database.configure_pool(size=readers + writers)
+            counts = run_workload(seconds, readers, writers)
+    finally:
+        database.JOURNAL_MODE, database.PRAGMAS = original
+    report(f"{label}: reads", counts['reads'], seconds)
+    report(f"{label}: writes", counts['writes'], seconds)
+    print(f"{label}: failed operations (e.g. database is locked): {counts['errors']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--readers', type=int, default=6)
+    parser.add_argument('--writers', type=int, default=2)
+    args = parser.parse_args()
+
+    run_profile("defaults (rollback journal)", DEFAULT_PROFILE, args.seconds, args.readers, args.writers)
+    run_profile("tuned (WAL profile)", TUNED_PROFILE, args.seconds, args.readers, args.writers)
+
+if __name__ == '__main__':
+    main()
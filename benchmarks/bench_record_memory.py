@@ -0,0 +1,89 @@
+"""
+Memory per row of query results: dicts versus the slotted Book and Loan records.
+
+Loads the whole catalog (and every loan) once as dicts, the way the data layer
+built results before, and once through the data layer's record types. Each
+load is measured with tracemalloc, so the figures cover the containers built
+for the result and not SQLite's own page cache. String and integer values are
+the same objects in both cases; the difference is the per-row container.
+
+Usage: python -m benchmarks.bench_record_memory [--books 100000]
+"""
+
+import argparse
+import gc
+import tracemalloc
+from datetime import datetime
+
+import database
+from .util import temporary_database, seed_books, seed_loans, timed
+
+def book_dicts() -> list:
+    with database.db_connection() as conn:
+        return [dict(book) for book in conn.execute('SELECT * FROM books ORDER BY title')]
+
+def book_records() -> list:
+    with database.db_connection() as conn:
+        return database._fetch_books(conn, f'SELECT {database._BOOK_COLUMNS} FROM books ORDER BY title')
+
+def loan_rows():
+    with database.db_connection() as conn:
+        return conn.execute('''
+            SELECT br.*, b.title, b.author FROM borrow_records br JOIN books b ON br.book_id = b.id
+        ''').fetchall()
+
+def loan_dicts(rows: list) -> list:
+    now = datetime.now()
+    loans = []
+    for row in rows:
+        due_date = database._loan_time(row, 'due')
+        return_date = database._loan_time(row, 'return')
+        loans.append({
+            'book_id': row['book_id'],
+            'title': row['title'],
+            'author': row['author'],
+            'borrow_date': database._loan_time(row, 'borrow'),
+            'due_date': due_date,
+            'return_date': return_date,
+            'is_overdue': return_date is None and now > due_date
+        })
+    return loans
+
+def loan_records(rows: list) -> list:
+    now = datetime.now()
+    return [database._loan(row, now) for row in rows]
+
+def measure(function, *args) -> tuple:
+    """Return (bytes still allocated by the result, seconds) for one call; timed without tracing."""
+    gc.collect()
+    tracemalloc.start()
+    result = function(*args)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    _, seconds = timed(function, *args)
+    return allocated, seconds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=100000)
+    args = parser.parse_args()
+
+    with temporary_database():
+        seed_books(args.books)
+        seed_loans(args.books, args.books)
+        rows = loan_rows()
+        results = [
+            ("books as dicts", args.books, measure(book_dicts)),
+            ("books as Book records", args.books, measure(book_records)),
+            ("loans as dicts", len(rows), measure(loan_dicts, rows)),
+            ("loans as Loan records", len(rows), measure(loan_records, rows)),
+        ]
+
+    for label, count, (allocated, seconds) in results:
+        print(f"{label:<28} {count:>8} rows  {allocated / 2**20:>8.1f} MiB  "
+              f"{allocated / count:>7.0f} bytes/row  {seconds:>6.3f} s")
+
+if __name__ == '__main__':
+    main()
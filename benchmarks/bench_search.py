@@ -0,0 +1,62 @@
+"""
+Catalog search latency: Python substring scan over get_all_books() versus the
+FTS5 full-text index behind search_books_in_catalog.
+
+Both are timed with catalog_cache cleared before every search, so each one
+reads the database; repeated searches answered from the cache are reported
+separately.
+
+Usage: python -m benchmarks.bench_search [--sizes 10000 100000 1000000] [--repeat 20]
+"""
+
+import argparse
+
+import database
+from services.library_service import search_books_in_catalog
+from .util import temporary_database, seed_books, timed, report
+
+SEARCHES = [
+    ("topic 42", "title"),
+    ("Book 9999", "title"),
+    ("author 17", "author"),
+    ("no such text", "title"),
+]
+
+def scan_search(search_term: str, search_type: str) -> list:
+    """The pre-index search: load every book and filter in Python."""
+    search_term = search_term.lower()
+    return [book for book in database.get_all_books() if search_term in book[search_type].lower()]
+
+def time_searches(search, repeat: int, cached: bool) -> float:
+    """Total seconds for `repeat` rounds of SEARCHES, clearing catalog_cache before each search unless `cached`."""
+    if cached:
+        for term, kind in SEARCHES:
+            search(term, kind)  # fill the cache before timing
+    seconds = 0.0
+    for _ in range(repeat):
+        for term, kind in SEARCHES:
+            if not cached:
+                database.catalog_cache.clear()
+            seconds += timed(search, term, kind)[1]
+    return seconds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        with temporary_database():
+            _, seconds = timed(seed_books, size)
+            print(f"--- {size:,} books (seeded and indexed in {seconds:.1f} s)")
+            scan_repeat = max(1, args.repeat // max(1, size // 10000))
+            for label, search, repeat, cached in (
+                    ("python scan", scan_search, scan_repeat, False),
+                    ("fts5 index", search_books_in_catalog, args.repeat, False),
+                    ("fts5 index, cached", search_books_in_catalog, args.repeat, True)):
+                seconds = time_searches(search, repeat, cached)
+                report(f"{label} @ {size:,} books", repeat * len(SEARCHES), seconds)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Patron status report cost: the old per-book late fee lookups versus the
+single-query get_patron_status_report.
+
+Every patron has a number of open loans (some overdue) plus returned history.
+The benchmark counts SQL statements and pooled connection checkouts per report
+with sqlite3's trace callback, and times reports for every patron.
+
+Usage: python -m benchmarks.bench_status_report [--patrons 2000] [--loans 5] [--history 20]
+"""
+
+import argparse
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import database
+from services.library_service import calculate_late_fee_for_book, get_patron_status_report
+from .util import temporary_database, seed_books, timed, report
+
+BOOK_COUNT = 5000
+
+def legacy_status_report(patron_id: str) -> dict:
+    """The pre-refactor report: borrowed list, one late fee lookup per book, then the history."""
+    currently_borrowed_books = database.get_patron_borrowed_books(patron_id)
+    late_fees = 0.0
+    for book in currently_borrowed_books:
+        result = calculate_late_fee_for_book(patron_id, book['book_id'])
+        if result['status'] == "Overdue":
+            late_fees += result['fee_amount']
+    borrowing_history = database.get_patron_borrowing_history(patron_id)
+    return {
+        'patron_id': patron_id,
+        'currently_borrowed_books': currently_borrowed_books,
+        'total_late_fees_owed': late_fees,
+        'borrowing_history': borrowing_history
+    }
+
+def seed_patrons(patrons: int, loans: int, history: int) -> list:
+    """Give every patron `loans` open loans (every other one overdue) and `history` returned loans."""
+    now = datetime.now()
+    rows = []
+    patron_ids = [str(100000 + p) for p in range(patrons)]
+    for p, patron_id in enumerate(patron_ids):
+        for i in range(loans + history):
+            borrow_date = now - timedelta(days=30 if i % 2 else 3, minutes=i)
+            return_date = (borrow_date + timedelta(days=7)).isoformat() if i >= loans else None
+            rows.append((patron_id, 1 + (p * 31 + i) % BOOK_COUNT, borrow_date.isoformat(),
+                         (borrow_date + timedelta(days=14)).isoformat(), return_date))
+    with database.db_connection() as conn:
+        conn.executemany('''
+            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+    return patron_ids
+
+@contextmanager
+def counting_queries(counts: dict):
+    """Count statements run and connections checked out while the block runs."""
+    def trace(statement):
+        if statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
+            counts['statements'] += 1
+
+    original_db_connection = database.db_connection
+
+    @contextmanager
+    def traced_db_connection():
+        with original_db_connection() as conn:
+            counts['connections'] += 1
+            conn.set_trace_callback(trace)
+            try:
+                yield conn
+            finally:
+                conn.set_trace_callback(None)
+
+    database.db_connection = traced_db_connection
+    try:
+        yield counts
+    finally:
+        database.db_connection = original_db_connection
+
+def run(build_report, patron_ids: list) -> float:
+    total = 0.0
+    for patron_id in patron_ids:
+        total += build_report(patron_id)['total_late_fees_owed']
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--patrons', type=int, default=2000)
+    parser.add_argument('--loans', type=int, default=5)
+    parser.add_argument('--history', type=int, default=20)
+    args = parser.parse_args()
+
+    with temporary_database():
+        seed_books(BOOK_COUNT)
+        patron_ids = seed_patrons(args.patrons, args.loans, args.history)
+        for label, build_report in (("per-book lookups", legacy_status_report),
+                                    ("single query", get_patron_status_report)):
+            with counting_queries({'statements': 0, 'connections': 0}) as counts:
+                run(build_report, patron_ids[:100])
+            database.book_cache.clear()
+            fees, seconds = timed(run, build_report, patron_ids)
+            report(f"status reports, {label}", args.patrons, seconds)
+            print(f"    per report: {counts['statements'] / 100:.1f} statements, "
+                  f"{counts['connections'] / 100:.1f} connection checkouts, "
+                  f"{seconds / args.patrons * 1e3:.2f} ms; total fees ${fees:,.2f}")
+
+if __name__ == '__main__':
+    main()
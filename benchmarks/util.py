@@ -0,0 +1,71 @@
+"""
+Shared helpers for the benchmark scripts.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import database
+
+@contextmanager
+def temporary_database(name: str = "bench.db"):
+    """Point the database module at a fresh, initialized database file for the duration of the block."""
+    directory = tempfile.mkdtemp(prefix="library-bench-")
+    original = database.DATABASE
+    database.close_pool()
+    database.DATABASE = os.path.join(directory, name)
+    try:
+        database.init_database()
+        yield database.DATABASE
+    finally:
+        database.close_pool()
+        database.DATABASE = original
+        shutil.rmtree(directory, ignore_errors=True)
+
+def seed_books(count: int, copies: int = 3, batch_size: int = 10000) -> None:
+    """Insert `count` synthetic books in large batches."""
+    with database.db_connection() as conn:
+        for start in range(0, count, batch_size):
+            rows = [
+                (f"Book {i} about topic {i % 997}", f"Author {i % 5003}", str(i).zfill(13), copies, copies)
+                for i in range(start, min(start + batch_size, count))
+            ]
+            conn.executemany('''
+                INSERT INTO books (title, author, isbn, total_copies, available_copies)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+        conn.commit()
+
+def seed_loans(count: int, book_count: int, overdue_ratio: float = 0.5, batch_size: int = 10000) -> None:
+    """Insert `count` open loans spread over patrons and books; roughly `overdue_ratio` of them overdue."""
+    now = datetime.now()
+    with database.db_connection() as conn:
+        for start in range(0, count, batch_size):
+            rows = []
+            for i in range(start, min(start + batch_size, count)):
+                days_ago = (i % 40) if (i % 100) < overdue_ratio * 100 else (i % 10)
+                borrow_date = now - timedelta(days=days_ago, seconds=i % 86400)
+                due_date = borrow_date + timedelta(days=14)
+                rows.append((str(100000 + i // 5).zfill(6), 1 + i % book_count,
+                             borrow_date.isoformat(), due_date.isoformat(),
+                             database.to_timestamp(borrow_date), database.to_timestamp(due_date)))
+            conn.executemany('''
+                INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, borrow_ts, due_ts)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+        conn.commit()
+
+def timed(function, *args, **kwargs):
+    """Call `function` and return (result, elapsed seconds)."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def report(label: str, operations: int, seconds: float) -> None:
+    """Print one benchmark result line."""
+    rate = operations / seconds if seconds else float('inf')
+    print(f"{label:<48} {operations:>10} ops  {seconds:>8.3f} s  {rate:>12,.1f} ops/s")
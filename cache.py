@@ -0,0 +1,91 @@
+"""
+Cache module for Library Management System
+In-process LRU cache used to keep hot rows out of SQLite
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+MISSING = object()  # Returned by LRUCache.get when a key is not cached
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with an optional time-to-live.
+
+    Memory is bounded by `max_entries`; the least recently used entry is evicted
+    when the cache is full. A `max_entries` of 0 disables caching entirely.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def version(self) -> int:
+        """
+        Counter bumped by every invalidation.
+
+        Read it before loading a value from the database and pass it to `set`, so a
+        value loaded before a concurrent write is not cached after that write
+        invalidated the key.
+        """
+        return self._version
+
+    def get(self, key: Hashable) -> Any:
+        """Get a cached value, or MISSING if the key is absent or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+    def set(self, key: Hashable, value: Any, if_version: Optional[int] = None) -> None:
+        """Cache a value, unless the cache was invalidated since `if_version` was read."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if if_version is not None and if_version != self._version:
+                return
+            expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys: Hashable) -> None:
+        """Remove the given keys from the cache."""
+        with self._lock:
+            self._version += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove every entry from the cache."""
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """Get the cache's size and hit, miss and eviction counters."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
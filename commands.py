@@ -0,0 +1,126 @@
+"""
+Command line tasks for the Library Management System, run through the Flask CLI,
+e.g. `flask --app app overdue-sweep`.
+"""
+
+import time
+from datetime import datetime
+import click
+from database import check_patron_summaries, rebuild_patron_summaries, refresh_overdue_counts
+from services.catalog_import import IMPORT_BATCH_SIZE, IMPORT_FORMATS, decode_lines, detect_import_format, import_books
+from services.data_export import EXPORT_FORMATS, EXPORT_TABLES, export_rows
+from services.overdue_sweep import sweep_overdue_loans, summarize_sweep, write_sweep_report
+from services.payment_jobs import start_payment_workers, stop_payment_workers
+
+@click.command('overdue-sweep')
+@click.option('--output', default='overdue_report.json', show_default=True,
+              help='Where to write the JSON summary report.')
+@click.option('--as-of', type=click.DateTime(), default=None,
+              help='Calculate fees as of this moment instead of now.')
+def overdue_sweep_command(output, as_of):
+    """Find every overdue loan, total its late fees, write a summary report and refresh patron overdue counts."""
+    started = datetime.now()
+    sweep = sweep_overdue_loans(as_of)
+    summary = summarize_sweep(sweep)
+    write_sweep_report(summary, output)
+    refresh_overdue_counts(sweep['as_of'])
+    elapsed = (datetime.now() - started).total_seconds()
+    click.echo(f"Swept {summary['open_loans']} open loans in {elapsed:.2f} s: "
+               f"{summary['overdue_loans']} overdue, ${summary['total_late_fees']:,.2f} in late fees. "
+               f"Report written to {output}.")
+
+@click.command('rebuild-patron-summary')
+@click.option('--verify-only', is_flag=True, help='Report drift without rebuilding the table.')
+def rebuild_patron_summary_command(verify_only):
+    """Recompute the patrons summary table from borrow_records and report any drift."""
+    drift = check_patron_summaries() if verify_only else rebuild_patron_summaries()
+    for entry in drift:
+        click.echo(f"Patron {entry['patron_id']}: {entry['field']} was {entry['actual']!r}, "
+                   f"expected {entry['expected']!r}")
+    if not drift:
+        click.echo("Patron summaries match borrow_records.")
+    elif verify_only:
+        click.echo(f"{len(drift)} mismatched values found; run without --verify-only to rebuild.")
+    else:
+        click.echo(f"{len(drift)} mismatched values found and rebuilt.")
+    if verify_only and drift:
+        raise SystemExit(1)
+
+@click.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format', type=click.Choice(IMPORT_FORMATS), default=None,
+              help='File format; by default taken from the file extension (.csv, .jsonl, .ndjson).')
+@click.option('--batch-size', type=click.IntRange(min=1), default=IMPORT_BATCH_SIZE, show_default=True,
+              help='Books written per transaction.')
+@click.option('--quiet', is_flag=True, help='Only print the final summary.')
+def import_books_command(path, format, batch_size, quiet):
+    """Bulk-load books from a CSV or JSON Lines file, skipping invalid rows and duplicate ISBNs."""
+    format = format or detect_import_format(path)
+    if format is None:
+        raise click.UsageError("Cannot tell the file format from its name; pass --format.")
+
+    def show_progress(result):
+        click.echo(f"  {result['rows']:,} rows read, {result['imported']:,} imported "
+                   f"({result['rows_per_second']:,.0f} rows/s)")
+
+    with open(path, 'rb') as source:
+        result = import_books(decode_lines(source), format, batch_size, None if quiet else show_progress)
+    for error in result['errors']:
+        click.echo(f"Line {error['line']}: {error['error']}" + (f" (ISBN {error['isbn']})" if error['isbn'] else ''))
+    skipped = result['duplicates'] + result['invalid']
+    if skipped > len(result['errors']):
+        click.echo(f"... {skipped - len(result['errors'])} more skipped rows not listed.")
+    if result['failed']:
+        click.echo(f"Error: line {result['failed']['line']}: {result['failed']['error']}", err=True)
+        click.echo(f"Import stopped; {result['imported']:,} books from the {result['rows']:,} rows "
+                   f"before it were imported.", err=True)
+        raise SystemExit(1)
+    click.echo(f"Imported {result['imported']:,} of {result['rows']:,} rows in {result['seconds']:.2f} s "
+               f"({result['rows_per_second']:,.0f} rows/s): {result['duplicates']:,} duplicate ISBNs, "
+               f"{result['invalid']:,} invalid rows skipped.")
+    if skipped:
+        raise SystemExit(1)
+
+@click.command('export-data')
+@click.argument('name', type=click.Choice(list(EXPORT_TABLES)))
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8', lazy=True), default='-',
+              help='File to write; standard output by default.')
+@click.option('--format', 'format', type=click.Choice(EXPORT_FORMATS), default=None,
+              help='Output format; by default taken from the output file extension, otherwise csv.')
+@click.option('--after-id', type=click.IntRange(min=0), default=None,
+              help='Only export rows with a larger id (resume an earlier export).')
+@click.option('--since', type=click.DateTime(), default=None,
+              help='loans only: export loans borrowed or returned at or after this moment.')
+def export_data_command(name, output, format, after_id, since):
+    """Stream the books catalog or loan history to CSV or NDJSON in id order, in constant memory."""
+    if format is None:
+        format = 'ndjson' if output.name.lower().endswith(('.ndjson', '.jsonl')) else 'csv'
+    try:
+        chunks = export_rows(name, format, after_id, since)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    for chunk in chunks:
+        output.write(chunk)
+
+@click.command('payment-worker')
+@click.option('--workers', type=click.IntRange(min=1), default=4, show_default=True,
+              help='Number of worker threads.')
+def payment_worker_command(workers):
+    """Run queued payment jobs until interrupted."""
+    start_payment_workers(workers)
+    click.echo(f"Running payment jobs with {workers} workers; press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        click.echo("Stopping payment workers once their current jobs finish.")
+    finally:
+        stop_payment_workers()
+
+def register_commands(app):
+    """Register all command line tasks with the Flask app."""
+    app.cli.add_command(overdue_sweep_command)
+    app.cli.add_command(rebuild_patron_summary_command)
+    app.cli.add_command(import_books_command)
+    app.cli.add_command(export_data_command)
+    app.cli.add_command(payment_worker_command)
@@ -3,73 +3,773 @@ Database module for Library Management System
 Handles all database operations and connections
 """
 
+import json
+import logging
 import sqlite3
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from cache import LRUCache, MISSING
+from models import Book, Loan
+
+logger = logging.getLogger(__name__)
 
 # Database configuration
 DATABASE = 'library.db'
 
-def get_db_connection():
-    """Get a database connection."""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # This enables column access by name
-    return conn
+# Connection pool configuration
+POOL_SIZE = 5  # Maximum number of open connections per process
+POOL_TIMEOUT = 30.0  # Seconds to wait for a free connection before giving up
+POOL_HEALTH_CHECK_INTERVAL = 60.0  # Idle seconds after which a connection is pinged on checkout
 
-def init_database():
-    """Initialize the database with required tables."""
-    conn = get_db_connection()
-    
-    # Create books table
+# Book lookup cache configuration
+BOOK_CACHE_SIZE = 10000  # Maximum number of cached entries (0 disables the cache)
+BOOK_CACHE_TTL = 300.0  # Seconds before a cached book is re-read from the database
+
+# Cache for get_book_by_id/get_book_by_isbn. Keys are (DATABASE, 'id', book_id) -> book
+# and (DATABASE, 'isbn', isbn) -> book_id, so invalidating a book only needs its ID.
+# Only books that exist are cached, so inserting a book never needs an invalidation.
+book_cache = LRUCache(BOOK_CACHE_SIZE, BOOK_CACHE_TTL)
+
+def invalidate_cached_book(book_id: int) -> None:
+    """Drop a book from the lookup cache after it has been written."""
+    book_cache.invalidate((DATABASE, 'id', book_id))
+
+def get_book_cache_stats() -> Dict:
+    """Get the book lookup cache's size and hit, miss and eviction counters."""
+    return book_cache.stats()
+
+# Catalog snapshot cache configuration
+CATALOG_CACHE_SIZE = 256  # Maximum number of cached catalog listings, pages and searches
+
+# Cache of whole-catalog reads (listing, pages, searches). Entries are stored as
+# (catalog_version, result) and are only served while catalog_version is unchanged,
+# so writes made by any connection or worker process are picked up on the next read.
+catalog_cache = LRUCache(CATALOG_CACHE_SIZE)
+
+_seen_catalog_versions = {}  # DATABASE -> catalog_version seen by refresh_caches()
+
+# Journal mode is persistent in the database file and is set by init_database()
+JOURNAL_MODE = 'WAL'  # Readers no longer block behind a writer (and vice versa)
+
+# PRAGMA profile applied to every new connection
+PRAGMAS = {
+    'synchronous': 'NORMAL',  # Safe with WAL; fsync on checkpoint instead of every commit
+    'busy_timeout': 5000,  # Milliseconds to wait on a lock before raising "database is locked"
+    'cache_size': -16000,  # Negative values are KiB, i.e. a 16 MB page cache per connection
+    'mmap_size': 134217728,  # Read up to 128 MB of the file through memory mapping
+    'temp_store': 'MEMORY',  # Keep temporary tables and sort spills in memory
+}
+
+# Loan dates are stored twice: as ISO text (borrow_date, due_date, return_date),
+# which older code reads and writes, and as integer microseconds since the epoch
+# (borrow_ts, due_ts, return_ts), which queries filter, sort and index on.
+# Like the text columns, timestamps hold naive local wall-clock times.
+EPOCH = datetime(1970, 1, 1)
+
+# SQL equivalent of to_timestamp() for an ISO date column (used by the backfill and triggers)
+_ISO_TO_TIMESTAMP_SQL = (
+    "(CAST(strftime('%s', {0}) AS INTEGER) * 1000000"
+    " + CASE WHEN substr({0}, 20, 1) = '.' THEN CAST(substr({0} || '000000', 21, 6) AS INTEGER) ELSE 0 END)"
+)
+
+def to_timestamp(value: datetime) -> int:
+    """Convert a datetime to the integer loan timestamp (microseconds since the epoch)."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+def from_timestamp(timestamp: int) -> datetime:
+    """Convert an integer loan timestamp back to a datetime."""
+    return EPOCH + timedelta(microseconds=timestamp)
+
+def _loan_time(record: sqlite3.Row, name: str) -> Optional[datetime]:
+    """Read one loan date ('borrow', 'due' or 'return') from its timestamp, or its ISO text for legacy rows."""
+    timestamp = record[f'{name}_ts']
+    if timestamp is not None:
+        return from_timestamp(timestamp)
+    text = record[f'{name}_date']
+    return None if text is None else datetime.fromisoformat(text)
+
+# SELECT lists in Book field order, so rows can be turned into Books positionally
+_BOOK_COLUMNS = ', '.join(Book._fields)
+_BOOK_COLUMNS_B = ', '.join(f'b.{name}' for name in Book._fields)
+
+def _book_factory(cursor: sqlite3.Cursor, row: tuple) -> Book:
+    return Book(*row)
+
+def _fetch_books(conn: sqlite3.Connection, query: str, parameters=()) -> List[Book]:
+    """Run a query selecting _BOOK_COLUMNS and build Books straight from the raw rows."""
+    cursor = conn.cursor()
+    cursor.row_factory = _book_factory
+    return cursor.execute(query, parameters).fetchall()
+
+def _loan(record: sqlite3.Row, now: datetime) -> Loan:
+    """Build a Loan from a borrow_records row joined with the book's title and author."""
+    due_date = _loan_time(record, 'due')
+    return_date = _loan_time(record, 'return')
+    return Loan(record['book_id'], record['title'], record['author'], _loan_time(record, 'borrow'),
+                due_date, return_date, return_date is None and now > due_date)
+
+def fts5_available(conn: sqlite3.Connection) -> bool:
+    """Check whether this SQLite build supports FTS5 with the trigram tokenizer."""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x, tokenize='trigram')")
+        conn.execute('DROP TABLE temp.fts5_probe')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def _create_books_fts(conn: sqlite3.Connection) -> None:
+    """Create the full-text index over book titles and authors, if FTS5 is available."""
+    if not fts5_available(conn):
+        return
+    # Trigram tokens give case-insensitive substring (and therefore prefix) matching,
+    # which keeps the partial-match behaviour required by R6
     conn.execute('''
-        CREATE TABLE IF NOT EXISTS books (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            author TEXT NOT NULL,
-            isbn TEXT UNIQUE NOT NULL,
-            total_copies INTEGER NOT NULL,
-            available_copies INTEGER NOT NULL
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_fts
+        USING fts5(title, author, content='books', content_rowid='id', tokenize='trigram')
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+            INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+        END
+    ''')
+    conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+
+# Per-patron loan counts recomputed from borrow_records; used to backfill,
+# verify and rebuild the patrons summary table. Loans count as overdue when
+# they were due before the cutoff in patron_summary_state.
+_PATRON_SUMMARY_QUERY = '''
+    SELECT patron_id,
+           SUM(return_date IS NULL) AS open_loans,
+           SUM(return_date IS NULL AND due_date < (SELECT overdue_as_of FROM patron_summary_state WHERE id = 1))
+               AS overdue_loans,
+           MAX(max(borrow_date, coalesce(return_date, ''))) AS last_activity
+    FROM borrow_records
+    GROUP BY patron_id
+'''
+
+def _create_patron_summaries(conn: sqlite3.Connection) -> None:
+    """Create the patrons summary table, the triggers that maintain it, and backfill it."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patrons (
+            patron_id TEXT PRIMARY KEY,
+            open_loans INTEGER NOT NULL DEFAULT 0,
+            overdue_loans INTEGER NOT NULL DEFAULT 0,
+            last_activity TEXT
         )
     ''')
-    
-    # Create borrow_records table
+    # Overdue status depends on the clock, which triggers cannot follow; loans
+    # count as overdue relative to this cutoff, moved by refresh_overdue_counts()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patron_summary_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            overdue_as_of TEXT NOT NULL
+        )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO patron_summary_state (id, overdue_as_of) VALUES (1, ?)',
+                 (datetime.now().isoformat(),))
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patron_summary_insert AFTER INSERT ON borrow_records BEGIN
+            INSERT OR IGNORE INTO patrons (patron_id) VALUES (new.patron_id);
+            UPDATE patrons SET
+                open_loans = open_loans + (new.return_date IS NULL),
+                overdue_loans = overdue_loans + (new.return_date IS NULL AND new.due_date <
+                    (SELECT overdue_as_of FROM patron_summary_state WHERE id = 1)),
+                last_activity = max(coalesce(last_activity, ''), new.borrow_date, coalesce(new.return_date, ''))
+            WHERE patron_id = new.patron_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patron_summary_update AFTER UPDATE OF due_date, return_date ON borrow_records BEGIN
+            UPDATE patrons SET
+                open_loans = open_loans - (old.return_date IS NULL) + (new.return_date IS NULL),
+                overdue_loans = overdue_loans
+                    - (old.return_date IS NULL AND old.due_date < (SELECT overdue_as_of FROM patron_summary_state WHERE id = 1))
+                    + (new.return_date IS NULL AND new.due_date < (SELECT overdue_as_of FROM patron_summary_state WHERE id = 1)),
+                last_activity = max(coalesce(last_activity, ''), coalesce(new.return_date, ''))
+            WHERE patron_id = new.patron_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patron_summary_delete AFTER DELETE ON borrow_records BEGIN
+            UPDATE patrons SET
+                open_loans = open_loans - (old.return_date IS NULL),
+                overdue_loans = overdue_loans - (old.return_date IS NULL AND old.due_date <
+                    (SELECT overdue_as_of FROM patron_summary_state WHERE id = 1)),
+                last_activity = (SELECT MAX(max(borrow_date, coalesce(return_date, '')))
+                                 FROM borrow_records WHERE patron_id = old.patron_id)
+            WHERE patron_id = old.patron_id;
+            DELETE FROM patrons WHERE patron_id = old.patron_id AND last_activity IS NULL;
+        END
+    ''')
+    conn.execute(f'INSERT OR REPLACE INTO patrons (patron_id, open_loans, overdue_loans, last_activity) {_PATRON_SUMMARY_QUERY}')
+
+def _add_loan_timestamps(conn: sqlite3.Connection) -> None:
+    """Add integer timestamp columns to borrow_records, backfill them, and index them."""
+    columns = {row['name'] for row in conn.execute('PRAGMA table_info(borrow_records)')}
+    for name in ('borrow_ts', 'due_ts', 'return_ts'):
+        if name not in columns:
+            conn.execute(f'ALTER TABLE borrow_records ADD COLUMN {name} INTEGER')
+    conn.execute(f'''
+        UPDATE borrow_records SET
+            borrow_ts = {_ISO_TO_TIMESTAMP_SQL.format('borrow_date')},
+            due_ts = {_ISO_TO_TIMESTAMP_SQL.format('due_date')},
+            return_ts = {_ISO_TO_TIMESTAMP_SQL.format('return_date')}
+    ''')
+    # Rows written with only the ISO text (e.g. by a process still running older
+    # code) get their timestamps filled in by the database itself
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS loan_timestamps_insert AFTER INSERT ON borrow_records
+        WHEN new.borrow_ts IS NULL OR new.due_ts IS NULL OR (new.return_date IS NOT NULL AND new.return_ts IS NULL)
+        BEGIN
+            UPDATE borrow_records SET
+                borrow_ts = {_ISO_TO_TIMESTAMP_SQL.format('new.borrow_date')},
+                due_ts = {_ISO_TO_TIMESTAMP_SQL.format('new.due_date')},
+                return_ts = {_ISO_TO_TIMESTAMP_SQL.format('new.return_date')}
+            WHERE id = new.id;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS loan_timestamps_update AFTER UPDATE OF borrow_date, due_date, return_date ON borrow_records
+        WHEN new.borrow_ts IS old.borrow_ts AND new.due_ts IS old.due_ts AND new.return_ts IS old.return_ts
+        BEGIN
+            UPDATE borrow_records SET
+                borrow_ts = {_ISO_TO_TIMESTAMP_SQL.format('new.borrow_date')},
+                due_ts = {_ISO_TO_TIMESTAMP_SQL.format('new.due_date')},
+                return_ts = {_ISO_TO_TIMESTAMP_SQL.format('new.return_date')}
+            WHERE id = new.id;
+        END
+    ''')
+    # The timestamp indexes replace the ones on the ISO text columns
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrow_records_patron_borrow_ts ON borrow_records (patron_id, borrow_ts)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrow_records_open_due_ts ON borrow_records (due_ts) WHERE return_date IS NULL')
+    conn.execute('DROP INDEX IF EXISTS idx_borrow_records_patron_history')
+    conn.execute('DROP INDEX IF EXISTS idx_borrow_records_open_due')
+
+def _add_bulk_insert_switch(conn: sqlite3.Connection) -> None:
+    """
+    Let bulk inserts into books skip the per-row full-text index and catalog version triggers.
+
+    While bulk_insert_state.active is set (only ever inside insert_books' write
+    transaction, so no other connection sees it), the two insert triggers do
+    nothing and insert_books updates books_fts and catalog_version once per batch.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bulk_insert_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            active INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO bulk_insert_state (id, active) VALUES (1, 0)')
+    conn.execute('DROP TRIGGER IF EXISTS catalog_version_insert')
+    conn.execute('''
+        CREATE TRIGGER catalog_version_insert AFTER INSERT ON books
+        WHEN NOT (SELECT active FROM bulk_insert_state WHERE id = 1)
+        BEGIN
+            UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+        END
+    ''')
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'books_fts_insert'").fetchone():
+        conn.execute('DROP TRIGGER books_fts_insert')
+        conn.execute('''
+            CREATE TRIGGER books_fts_insert AFTER INSERT ON books
+            WHEN NOT (SELECT active FROM bulk_insert_state WHERE id = 1)
+            BEGIN
+                INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+            END
+        ''')
+
+def _track_changed_books(conn: sqlite3.Connection) -> None:
+    """
+    Record which book each catalog version change was for, so caches can drop just that book.
+
+    book_changes holds one row per updated or deleted book with the catalog
+    version of its latest change; refresh_caches evicts the books changed
+    since the version it last saw instead of clearing the whole lookup cache,
+    so borrows and returns (which update available_copies) only evict their own book.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS book_changes (
+            book_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_book_changes_version ON book_changes (version)')
+    for trigger, event, row in (('catalog_version_update', 'UPDATE', 'new'), ('catalog_version_delete', 'DELETE', 'old')):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        conn.execute(f'''
+            CREATE TRIGGER {trigger} AFTER {event} ON books BEGIN
+                UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+                INSERT INTO book_changes (book_id, version)
+                SELECT {row}.id, version FROM catalog_version WHERE id = 1
+                ON CONFLICT (book_id) DO UPDATE SET version = excluded.version;
+            END
+        ''')
+
+def _reserve_payment_allocations(conn: sqlite3.Connection) -> None:
+    """
+    Let payment_allocations hold reservations made before a consolidated charge.
+
+    Rows now belong to a payments ledger entry and are 'pending' until the
+    charge completes ('paid', with its transaction id) or fails (deleted), so
+    the transaction id becomes nullable; SQLite can only change that by
+    rebuilding the table.
+    """
     conn.execute('''
-        CREATE TABLE IF NOT EXISTS borrow_records (
+        CREATE TABLE payment_allocations_new (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payment_id INTEGER,
+            transaction_id TEXT,
             patron_id TEXT NOT NULL,
+            borrow_record_id INTEGER NOT NULL,
             book_id INTEGER NOT NULL,
-            borrow_date TEXT NOT NULL,
-            due_date TEXT NOT NULL,
-            return_date TEXT,
-            FOREIGN KEY (book_id) REFERENCES books (id)
+            amount REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'paid',
+            paid_at TEXT
         )
     ''')
-    
-    conn.commit()
-    conn.close()
+    conn.execute('''
+        INSERT INTO payment_allocations_new (id, transaction_id, patron_id, borrow_record_id, book_id, amount, paid_at)
+        SELECT id, transaction_id, patron_id, borrow_record_id, book_id, amount, paid_at FROM payment_allocations
+    ''')
+    conn.execute('DROP TABLE payment_allocations')
+    conn.execute('ALTER TABLE payment_allocations_new RENAME TO payment_allocations')
+    conn.execute('CREATE INDEX idx_payment_allocations_transaction ON payment_allocations (transaction_id)')
+    conn.execute('CREATE INDEX idx_payment_allocations_loan ON payment_allocations (borrow_record_id)')
+    conn.execute('CREATE INDEX idx_payment_allocations_payment ON payment_allocations (payment_id)')
 
-def clear_database():
-    """Clear all data from the database tables."""
-    conn = get_db_connection()
+# Schema migrations applied in order by migrate_database(). Entry N (counting
+# from 1) upgrades the schema to version N, which is recorded in PRAGMA
+# user_version. An entry is either a tuple of SQL statements or a function
+# taking the connection. Append new migrations; never edit or reorder existing ones.
+MIGRATIONS = [
+    # 1: Open loans by patron (borrow limit, duplicate check, return) and loans by book
+    (
+        '''CREATE INDEX IF NOT EXISTS idx_borrow_records_open_patron
+           ON borrow_records (patron_id, book_id) WHERE return_date IS NULL''',
+        '''CREATE INDEX IF NOT EXISTS idx_borrow_records_book_return
+           ON borrow_records (book_id, return_date)''',
+    ),
+    # 2: Patron borrowing history and open loans by due date (overdue checks)
+    (
+        '''CREATE INDEX IF NOT EXISTS idx_borrow_records_patron_history
+           ON borrow_records (patron_id, borrow_date)''',
+        '''CREATE INDEX IF NOT EXISTS idx_borrow_records_open_due
+           ON borrow_records (due_date) WHERE return_date IS NULL''',
+    ),
+    # 3: Full-text search over titles and authors
+    _create_books_fts,
+    # 4: Catalog pages in (title, id) order; the rowid id is implicitly part of the index
+    (
+        '''CREATE INDEX IF NOT EXISTS idx_books_title ON books (title)''',
+    ),
+    # 5: Change counter bumped by every write to books, shared by all connections and processes
+    (
+        '''CREATE TABLE IF NOT EXISTS catalog_version (
+               id INTEGER PRIMARY KEY CHECK (id = 1),
+               version INTEGER NOT NULL
+           )''',
+        '''INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)''',
+        '''CREATE TRIGGER IF NOT EXISTS catalog_version_insert AFTER INSERT ON books BEGIN
+               UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS catalog_version_update AFTER UPDATE ON books BEGIN
+               UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS catalog_version_delete AFTER DELETE ON books BEGIN
+               UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+           END''',
+    ),
+    # 6: Per-patron open/overdue loan counts and last activity, maintained by triggers
+    _create_patron_summaries,
+    # 7: Integer loan timestamps for filtering, sorting and indexing without parsing ISO text
+    _add_loan_timestamps,
+    # 8: How each consolidated late fee payment was split across the patron's loans
+    (
+        '''CREATE TABLE IF NOT EXISTS payment_allocations (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               transaction_id TEXT NOT NULL,
+               patron_id TEXT NOT NULL,
+               borrow_record_id INTEGER NOT NULL,
+               book_id INTEGER NOT NULL,
+               amount REAL NOT NULL,
+               paid_at TEXT NOT NULL
+           )''',
+        '''CREATE INDEX IF NOT EXISTS idx_payment_allocations_transaction
+           ON payment_allocations (transaction_id)''',
+        '''CREATE INDEX IF NOT EXISTS idx_payment_allocations_loan
+           ON payment_allocations (borrow_record_id)''',
+    ),
+    # 9: Payment jobs drained by the background payment workers; a running job's
+    # lease lets another worker reclaim it if its process dies
+    (
+        '''CREATE TABLE IF NOT EXISTS payment_jobs (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               kind TEXT NOT NULL,
+               payload TEXT NOT NULL,
+               status TEXT NOT NULL DEFAULT 'queued',
+               attempts INTEGER NOT NULL DEFAULT 0,
+               result TEXT,
+               created_at TEXT NOT NULL,
+               started_at TEXT,
+               finished_at TEXT,
+               lease_expires_ts INTEGER
+           )''',
+        '''CREATE INDEX IF NOT EXISTS idx_payment_jobs_pending
+           ON payment_jobs (id) WHERE status IN ('queued', 'running')''',
+    ),
+    # 10: Ledger of gateway charges, looked up by idempotency key or transaction id
+    (
+        '''CREATE TABLE IF NOT EXISTS payments (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               idempotency_key TEXT UNIQUE,
+               transaction_id TEXT UNIQUE,
+               patron_id TEXT NOT NULL,
+               book_id INTEGER,
+               amount REAL NOT NULL,
+               refunded_amount REAL NOT NULL DEFAULT 0,
+               status TEXT NOT NULL,
+               message TEXT,
+               created_at TEXT NOT NULL,
+               updated_at TEXT NOT NULL
+           )''',
+    ),
+    # 11: Switch for insert_books to update the full-text index and catalog version once per batch
+    _add_bulk_insert_switch,
+    # 12: Allocations reserved against a pending charge, so concurrent payments cannot cover the same fees
+    _reserve_payment_allocations,
+    # 13: Which book each update or delete changed, so cached lookups are evicted one book at a time
+    _track_changed_books,
+    # 14: Refund amount sent to the gateway whose outcome is not known yet (the call timed out)
+    (
+        'ALTER TABLE payments ADD COLUMN pending_refund REAL NOT NULL DEFAULT 0',
+    ),
+]
+
+def apply_pragmas(conn: sqlite3.Connection, pragmas: Optional[Dict] = None) -> None:
+    """Apply a PRAGMA profile (PRAGMAS by default) to a connection."""
+    for name, value in (PRAGMAS if pragmas is None else pragmas).items():
+        conn.execute(f'PRAGMA {name} = {value}')
+
+def get_db_connection(database: Optional[str] = None):
+    """Open a new standalone database connection (not managed by the pool)."""
+    conn = sqlite3.connect(database or DATABASE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row  # This enables column access by name
+    apply_pragmas(conn)
+    return conn
+
+class ConnectionPool:
+    """
+    Thread-safe pool of long-lived SQLite connections.
+
+    Connections are created lazily up to `size`, handed out exclusively to one
+    thread at a time and returned to the pool instead of being closed.
+    """
+
+    def __init__(self, database: str, size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT,
+                 health_check_interval: float = POOL_HEALTH_CHECK_INTERVAL):
+        if size <= 0:
+            raise ValueError("Pool size must be a positive integer.")
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._open = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def open_connections(self) -> int:
+        """Number of connections currently open (idle or checked out)."""
+        with self._cond:
+            return self._open
+
+    @property
+    def idle_connections(self) -> int:
+        """Number of open connections waiting in the pool."""
+        with self._cond:
+            return len(self._idle)
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        Check a connection out of the pool, opening a new one if the pool is not full.
+
+        Raises:
+            sqlite3.OperationalError: if no connection becomes free within `timeout` seconds
+            sqlite3.ProgrammingError: if the pool has been closed
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                conn, last_used = None, None
+                while conn is None:
+                    if self._closed:
+                        raise sqlite3.ProgrammingError("Connection pool is closed.")
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                    elif self._open < self.size:
+                        self._open += 1
+                        break
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise sqlite3.OperationalError("Timed out waiting for a database connection.")
+                        self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    return get_db_connection(self.database)
+                except Exception:
+                    self._forget()
+                    raise
+
+            if time.monotonic() - last_used < self.health_check_interval or self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """Return a connection to the pool, rolling back any transaction left open."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        with self._cond:
+            if self._closed:
+                conn.close()
+                self._open -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self) -> None:
+        """Close every idle connection and refuse further checkouts."""
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                conn.close()
+            self._open -= len(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    @staticmethod
+    def _is_healthy(conn: sqlite3.Connection) -> bool:
+        """Ping a connection that has been idle for a while."""
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn: sqlite3.Connection) -> None:
+        """Close a broken connection and free its slot."""
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._forget()
+
+    def _forget(self) -> None:
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """Get the process-wide connection pool, (re)creating it if DATABASE has changed."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.database != DATABASE:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DATABASE)
+        return _pool
+
+def configure_pool(size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT,
+                   health_check_interval: float = POOL_HEALTH_CHECK_INTERVAL) -> ConnectionPool:
+    """Replace the process-wide connection pool with one using the given settings."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(DATABASE, size, timeout, health_check_interval)
+        return _pool
+
+def close_pool() -> None:
+    """Close the process-wide connection pool (shutdown hook)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection for the duration of a `with` block."""
+    pool = get_pool()
+    conn = pool.acquire()
     try:
-        # Clear all tables
-        conn.execute('DELETE FROM borrow_records')
-        conn.execute('DELETE FROM books')
-        # Reset auto-increment counters
-        conn.execute('DELETE FROM sqlite_sequence WHERE name IN ("books", "borrow_records")')
+        yield conn
+    finally:
+        pool.release(conn)
+
+def get_catalog_version(conn: sqlite3.Connection) -> int:
+    """Read the catalog change counter (a single primary-key lookup)."""
+    row = conn.execute('SELECT version FROM catalog_version WHERE id = 1').fetchone()
+    return row[0] if row else 0
+
+def refresh_caches() -> int:
+    """
+    Drop cached books that changed since the last check (e.g. once per request).
+
+    Catches writes made by other worker processes, which cannot invalidate this
+    process's book lookup cache directly. Only the books updated or deleted
+    since the last version seen are dropped (see book_changes); the whole
+    cache is only cleared the first time a database is seen.
+
+    Returns:
+        int: the current catalog version
+    """
+    seen = _seen_catalog_versions.get(DATABASE)
+    with db_connection() as conn:
+        version = get_catalog_version(conn)
+        changed = [] if seen is None or seen == version else conn.execute(
+            'SELECT book_id FROM book_changes WHERE version > ?', (seen,)).fetchall()
+    if seen is None:
+        book_cache.clear()
+    for book_id, in changed:
+        invalidate_cached_book(book_id)
+    _seen_catalog_versions[DATABASE] = version
+    return version
+
+def _read_catalog_snapshot(key: Tuple, load):
+    """
+    Serve a catalog read from catalog_cache while catalog_version is unchanged.
+
+    On a miss, `load(conn)` runs in a read transaction together with the version
+    lookup, so the cached result is exactly the catalog at that version.
+    """
+    key = (DATABASE,) + key
+    with db_connection() as conn:
+        cached = catalog_cache.get(key)
+        if cached is not MISSING and cached[0] == get_catalog_version(conn):
+            return cached[1]
+        conn.execute('BEGIN')
+        try:
+            version = get_catalog_version(conn)
+            result = load(conn)
+        finally:
+            conn.commit()
+    catalog_cache.set(key, (version, result))
+    return result
+
+def init_database():
+    """Initialize the database with required tables."""
+    with db_connection() as conn:
+        apply_pragmas(conn, {'journal_mode': JOURNAL_MODE})
+
+        # Create books table
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS books (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                author TEXT NOT NULL,
+                isbn TEXT UNIQUE NOT NULL,
+                total_copies INTEGER NOT NULL,
+                available_copies INTEGER NOT NULL
+            )
+        ''')
+
+        # Create borrow_records table
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS borrow_records (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patron_id TEXT NOT NULL,
+                book_id INTEGER NOT NULL,
+                borrow_date TEXT NOT NULL,
+                due_date TEXT NOT NULL,
+                return_date TEXT,
+                FOREIGN KEY (book_id) REFERENCES books (id)
+            )
+        ''')
+
         conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
+        migrate_database(conn)
+
+def migrate_database(conn: sqlite3.Connection) -> int:
+    """
+    Upgrade the schema in place by applying every pending migration.
+
+    Each migration runs in its own BEGIN IMMEDIATE transaction together with the
+    user_version bump, so concurrent processes starting up apply it only once.
+
+    Returns:
+        int: the schema version after migrating
+    """
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.commit()
+                return version
+            migration = MIGRATIONS[version]
+            if callable(migration):
+                migration(conn)
+            else:
+                for statement in migration:
+                    conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def clear_database():
+    """Clear all data from the database tables."""
+    with db_connection() as conn:
+        try:
+            # Clear all tables
+            conn.execute('DELETE FROM payment_allocations')
+            conn.execute('DELETE FROM payment_jobs')
+            conn.execute('DELETE FROM payments')
+            conn.execute('DELETE FROM borrow_records')
+            conn.execute('DELETE FROM patrons')
+            conn.execute('DELETE FROM books')
+            # Reset auto-increment counters
+            conn.execute('DELETE FROM sqlite_sequence WHERE name IN ("books", "borrow_records", "payment_allocations", "payment_jobs", "payments")')
+            conn.commit()
+            book_cache.clear()
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
 
 def setup_database_for_testing():
     """Setup the database for testing."""
     init_database()
     clear_database()
     add_sample_data()
-    conn = get_db_connection()
     more_sample_books = [
             ('Test Book 1', 'Test Author 1', '0000000000001', 3),
             ('Test Book 2', 'Test Author 2', '0000000000002', 2),
@@ -77,185 +777,1034 @@ def setup_database_for_testing():
             ('Test Book 4', 'Test Author 4', '0000000000004', 5),
             ('Test Book 5', 'Test Author 5', '0000000000005', 5)
         ]
-    for title, author, isbn, copies in more_sample_books:
-            conn.execute('''
-                INSERT INTO books (title, author, isbn, total_copies, available_copies)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (title, author, isbn, copies, copies))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        for title, author, isbn, copies in more_sample_books:
+                conn.execute('''
+                    INSERT INTO books (title, author, isbn, total_copies, available_copies)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (title, author, isbn, copies, copies))
+        conn.commit()
 
 def add_sample_data():
     """Add sample data to the database if it's empty."""
-    conn = get_db_connection()
-    book_count = conn.execute('SELECT COUNT(*) as count FROM books').fetchone()['count']
-    
-    if book_count == 0:
-        # Add sample books
-        sample_books = [
-            ('The Great Gatsby', 'F. Scott Fitzgerald', '9780743273565', 3),
-            ('To Kill a Mockingbird', 'Harper Lee', '9780061120084', 2),
-            ('1984', 'George Orwell', '9780451524935', 1)
-        ]
-        
-        for title, author, isbn, copies in sample_books:
+    with db_connection() as conn:
+        book_count = conn.execute('SELECT COUNT(*) as count FROM books').fetchone()['count']
+
+        if book_count == 0:
+            # Add sample books
+            sample_books = [
+                ('The Great Gatsby', 'F. Scott Fitzgerald', '9780743273565', 3),
+                ('To Kill a Mockingbird', 'Harper Lee', '9780061120084', 2),
+                ('1984', 'George Orwell', '9780451524935', 1)
+            ]
+
+            for title, author, isbn, copies in sample_books:
+                conn.execute('''
+                    INSERT INTO books (title, author, isbn, total_copies, available_copies)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (title, author, isbn, copies, copies))
+
+            # Make 1984 unavailable by adding a borrow record
+            borrow_date = datetime.now() - timedelta(days=5)
+            due_date = datetime.now() + timedelta(days=9)
             conn.execute('''
-                INSERT INTO books (title, author, isbn, total_copies, available_copies)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (title, author, isbn, copies, copies))
-        
-        # Make 1984 unavailable by adding a borrow record
-        conn.execute('''
-            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
-            VALUES (?, ?, ?, ?)
-        ''', ('123456', 3, 
-              (datetime.now() - timedelta(days=5)).isoformat(),
-              (datetime.now() + timedelta(days=9)).isoformat()))
-        
-        # Update available copies for 1984
-        conn.execute('UPDATE books SET available_copies = 0 WHERE id = 3')
-        
-        conn.commit()
-    
-    conn.close()
+                INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, borrow_ts, due_ts)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', ('123456', 3, borrow_date.isoformat(), due_date.isoformat(),
+                  to_timestamp(borrow_date), to_timestamp(due_date)))
+
+            # Update available copies for 1984
+            conn.execute('UPDATE books SET available_copies = 0 WHERE id = 3')
+
+            conn.commit()
+            invalidate_cached_book(3)
 
 # Helper Functions for Database Operations
 
-def get_all_books() -> List[Dict]:
+def get_all_books() -> List[Book]:
     """Get all books from the database."""
-    conn = get_db_connection()
-    books = conn.execute('SELECT * FROM books ORDER BY title').fetchall()
-    conn.close()
-    return [dict(book) for book in books]
+    return list(_read_catalog_snapshot(('all_books',), lambda conn: _fetch_books(
+        conn, f'SELECT {_BOOK_COLUMNS} FROM books ORDER BY title'
+    )))
+
+def get_books_page(after: Optional[Tuple[str, int]] = None, limit: int = 50) -> Tuple[List[Book], Optional[Tuple[str, int]]]:
+    """
+    Get one page of books ordered by (title, id) using keyset pagination.
+
+    Args:
+        after: (title, id) of the last book on the previous page, or None for the first page
+        limit: maximum number of books on the page
+
+    Returns:
+        tuple: (books, next_key) where next_key is the (title, id) to pass as
+            `after` for the following page, or None if this is the last page
+    """
+    def load(conn):
+        if after is None:
+            return _fetch_books(conn, f'''
+                SELECT {_BOOK_COLUMNS} FROM books ORDER BY title, id LIMIT ?
+            ''', (limit + 1,))
+        return _fetch_books(conn, f'''
+            SELECT {_BOOK_COLUMNS} FROM books WHERE (title, id) > (?, ?) ORDER BY title, id LIMIT ?
+        ''', (after[0], after[1], limit + 1))
+
+    books = list(_read_catalog_snapshot(('page', after, limit), load))
+    if len(books) <= limit:
+        return books, None
+    books = books[:limit]
+    return books, (books[-1].title, books[-1].id)
 
-def get_book_by_id(book_id: int) -> Optional[Dict]:
+def search_books(search_term: str, field: str, limit: int) -> List[Book]:
+    """
+    Find books whose title or author contains the search term (case-insensitive).
+
+    Uses the books_fts full-text index ranked by BM25 when it exists and the term
+    is long enough to form a trigram; otherwise falls back to a LIKE scan ordered
+    by title.
+
+    Args:
+        search_term: text to look for
+        field: 'title' or 'author'
+        limit: maximum number of books to return
+    """
+    if field not in ('title', 'author'):
+        raise ValueError(f"Cannot search books by {field!r}.")
+
+    def load(conn):
+        has_fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+        ).fetchone()
+        if has_fts and len(search_term) >= 3:
+            phrase = '"' + search_term.replace('"', '""') + '"'
+            return _fetch_books(conn, f'''
+                SELECT {_BOOK_COLUMNS_B} FROM books_fts
+                JOIN books b ON b.id = books_fts.rowid
+                WHERE books_fts MATCH ?
+                ORDER BY bm25(books_fts), b.title
+                LIMIT ?
+            ''', (f'{field} : {phrase}', limit))
+        pattern = '%' + search_term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return _fetch_books(conn, f'''
+            SELECT {_BOOK_COLUMNS} FROM books WHERE {field} LIKE ? ESCAPE '\\'
+            ORDER BY title
+            LIMIT ?
+        ''', (pattern, limit))
+
+    return list(_read_catalog_snapshot(('search', field, search_term, limit), load))
+
+def get_book_by_id(book_id: int) -> Optional[Book]:
     """Get a specific book by ID."""
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    conn.close()
-    return dict(book) if book else None
+    book = book_cache.get((DATABASE, 'id', book_id))
+    if book is MISSING:
+        version = book_cache.version
+        with db_connection() as conn:
+            books = _fetch_books(conn, f'SELECT {_BOOK_COLUMNS} FROM books WHERE id = ?', (book_id,))
+        if not books:
+            return None
+        book = books[0]
+        book_cache.set((DATABASE, 'id', book_id), book, if_version=version)
+    return book
 
-def get_book_by_isbn(isbn: str) -> Optional[Dict]:
+def get_book_by_isbn(isbn: str) -> Optional[Book]:
     """Get a specific book by ISBN."""
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE isbn = ?', (isbn,)).fetchone()
-    conn.close()
-    return dict(book) if book else None
+    book_id = book_cache.get((DATABASE, 'isbn', isbn))
+    if book_id is not MISSING:
+        book = book_cache.get((DATABASE, 'id', book_id))
+        if book is not MISSING:
+            return book
+    version = book_cache.version
+    with db_connection() as conn:
+        books = _fetch_books(conn, f'SELECT {_BOOK_COLUMNS} FROM books WHERE isbn = ?', (isbn,))
+    if not books:
+        return None
+    book = books[0]
+    book_cache.set((DATABASE, 'id', book.id), book, if_version=version)
+    book_cache.set((DATABASE, 'isbn', isbn), book.id, if_version=version)
+    return book
+
+def get_books_by_isbns(isbns: List[str]) -> List[Book]:
+    """Get the books matching any of the given ISBNs, in the order the ISBNs were given."""
+    isbns = list(dict.fromkeys(isbns))
+    books_by_isbn = {}
+    with db_connection() as conn:
+        for start in range(0, len(isbns), 500):
+            batch = isbns[start:start + 500]
+            placeholders = ', '.join('?' * len(batch))
+            for book in _fetch_books(conn, f'SELECT {_BOOK_COLUMNS} FROM books WHERE isbn IN ({placeholders})', batch):
+                books_by_isbn[book.isbn] = book
+    return [books_by_isbn[isbn] for isbn in isbns if isbn in books_by_isbn]
 
-def get_patron_borrowed_books(patron_id: str) -> List[Dict]:
+def get_patron_borrowed_books(patron_id: str) -> List[Loan]:
     """Get currently borrowed books for a patron."""
-    conn = get_db_connection()
-    records = conn.execute('''
-        SELECT br.*, b.title, b.author 
-        FROM borrow_records br 
-        JOIN books b ON br.book_id = b.id 
-        WHERE br.patron_id = ? AND br.return_date IS NULL
-        ORDER BY br.borrow_date
-    ''', (patron_id,)).fetchall()
-    conn.close()
+    now = datetime.now()
+    with db_connection() as conn:
+        records = conn.execute('''
+            SELECT br.*, b.title, b.author 
+            FROM borrow_records br 
+            JOIN books b ON br.book_id = b.id 
+            WHERE br.patron_id = ? AND br.return_date IS NULL
+            ORDER BY br.borrow_ts
+        ''', (patron_id,)).fetchall()
     
-    borrowed_books = []
-    for record in records:
-        borrowed_books.append({
-            'book_id': record['book_id'],
-            'title': record['title'],
-            'author': record['author'],
-            'borrow_date': datetime.fromisoformat(record['borrow_date']),
-            'due_date': datetime.fromisoformat(record['due_date']),
-            'is_overdue': datetime.now() > datetime.fromisoformat(record['due_date'])
-        })
-    
-    return borrowed_books
+    return [_loan(record, now) for record in records]
 
-def get_patron_borrowing_history(patron_id: str) -> List[Dict]:
+def get_patron_borrowing_history(patron_id: str) -> List[Loan]:
     """Get borrowing history for a patron."""
-    conn = get_db_connection()
-    records = conn.execute('''
-        SELECT br.*, b.title, b.author 
-        FROM borrow_records br 
-        JOIN books b ON br.book_id = b.id 
-        WHERE br.patron_id = ?
-        ORDER BY br.borrow_date
-    ''', (patron_id,)).fetchall()
-    borrowing_history = []
-    for record in records:
-        borrowing_history.append({
-            'book_id': record['book_id'],
-            'title': record['title'],
-            'author': record['author'],
-            'borrow_date': datetime.fromisoformat(record['borrow_date']),
-            'due_date': datetime.fromisoformat(record['due_date']),
-            'return_date': None if record['return_date'] is None else datetime.fromisoformat(record['return_date'])
-        })
-    conn.close()
-    return borrowing_history
+    now = datetime.now()
+    with db_connection() as conn:
+        records = conn.execute('''
+            SELECT br.*, b.title, b.author 
+            FROM borrow_records br 
+            JOIN books b ON br.book_id = b.id 
+            WHERE br.patron_id = ?
+            ORDER BY br.borrow_ts, br.id
+        ''', (patron_id,)).fetchall()
+    return [_loan(record, now) for record in records]
+
+def get_patron_borrowing_history_page(patron_id: str, after: Optional[Tuple[int, int]] = None,
+                                      limit: int = 50) -> Tuple[List[Loan], Optional[Tuple[int, int]]]:
+    """
+    Get one page of a patron's borrowing history ordered by (borrow_ts, id) using keyset pagination.
+
+    Args:
+        patron_id: 6-digit library card ID
+        after: (borrow timestamp, borrow record id) of the last record on the
+            previous page, or None for the first page
+        limit: maximum number of records on the page
+
+    Returns:
+        tuple: (records, next_key) where next_key is the key to pass as `after`
+            for the following page, or None if this is the last page
+    """
+    with db_connection() as conn:
+        if after is None:
+            records = conn.execute('''
+                SELECT br.*, b.title, b.author
+                FROM borrow_records br
+                JOIN books b ON br.book_id = b.id
+                WHERE br.patron_id = ?
+                ORDER BY br.borrow_ts, br.id
+                LIMIT ?
+            ''', (patron_id, limit + 1)).fetchall()
+        else:
+            records = conn.execute('''
+                SELECT br.*, b.title, b.author
+                FROM borrow_records br
+                JOIN books b ON br.book_id = b.id
+                WHERE br.patron_id = ? AND (br.borrow_ts, br.id) > (?, ?)
+                ORDER BY br.borrow_ts, br.id
+                LIMIT ?
+            ''', (patron_id, after[0], after[1], limit + 1)).fetchall()
+    next_key = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_key = (records[-1]['borrow_ts'], records[-1]['id'])
+    now = datetime.now()
+    return [_loan(record, now) for record in records], next_key
 
 def get_patron_borrow_count(patron_id: str) -> int:
-    """Get the number of books currently borrowed by a patron."""
-    conn = get_db_connection()
-    count = conn.execute('''
-        SELECT COUNT(*) as count FROM borrow_records 
-        WHERE patron_id = ? AND return_date IS NULL
-    ''', (patron_id,)).fetchone()['count']
-    conn.close()
-    return count
+    """Get the number of books currently borrowed by a patron (read from the patrons summary table)."""
+    with db_connection() as conn:
+        row = conn.execute('SELECT open_loans FROM patrons WHERE patron_id = ?', (patron_id,)).fetchone()
+    return row['open_loans'] if row else 0
+
+def get_patron_summary(patron_id: str) -> Optional[Dict]:
+    """
+    Get a patron's loan summary with a single primary-key lookup.
+
+    Returns:
+        dict: {'patron_id', 'open_loans', 'overdue_loans', 'last_activity', 'overdue_as_of'}
+            where overdue_loans counts open loans due before overdue_as_of,
+            or None if the patron has never borrowed a book
+    """
+    with db_connection() as conn:
+        row = conn.execute('''
+            SELECT p.*, s.overdue_as_of FROM patrons p, patron_summary_state s
+            WHERE p.patron_id = ? AND s.id = 1
+        ''', (patron_id,)).fetchone()
+    if not row:
+        return None
+    return {
+        'patron_id': row['patron_id'],
+        'open_loans': row['open_loans'],
+        'overdue_loans': row['overdue_loans'],
+        'last_activity': datetime.fromisoformat(row['last_activity']),
+        'overdue_as_of': datetime.fromisoformat(row['overdue_as_of'])
+    }
+
+def refresh_overdue_counts(as_of: datetime) -> int:
+    """
+    Recount every patron's overdue loans as of `as_of` and make it the new overdue cutoff.
+
+    Returns:
+        int: number of patrons whose overdue count changed
+    """
+    with db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('UPDATE patron_summary_state SET overdue_as_of = ? WHERE id = 1', (as_of.isoformat(),))
+            changed = conn.execute('''
+                UPDATE patrons SET overdue_loans = counts.overdue_loans
+                FROM (
+                    SELECT p.patron_id, COUNT(br.id) AS overdue_loans
+                    FROM patrons p
+                    LEFT JOIN borrow_records br
+                        ON br.patron_id = p.patron_id AND br.return_date IS NULL AND br.due_date < ?
+                    GROUP BY p.patron_id
+                ) AS counts
+                WHERE patrons.patron_id = counts.patron_id AND patrons.overdue_loans != counts.overdue_loans
+            ''', (as_of.isoformat(),)).rowcount
+            conn.commit()
+            return changed
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+def _patron_summary_drift(conn: sqlite3.Connection) -> List[Dict]:
+    """Compare the patrons table with a recount from borrow_records."""
+    expected = {row['patron_id']: row for row in conn.execute(_PATRON_SUMMARY_QUERY)}
+    actual = {row['patron_id']: row for row in conn.execute('SELECT * FROM patrons')}
+    drift = []
+    for patron_id in sorted(expected.keys() | actual.keys()):
+        for field in ('open_loans', 'overdue_loans', 'last_activity'):
+            expected_value = expected[patron_id][field] if patron_id in expected else None
+            actual_value = actual[patron_id][field] if patron_id in actual else None
+            if expected_value != actual_value:
+                drift.append({'patron_id': patron_id, 'field': field,
+                              'expected': expected_value, 'actual': actual_value})
+    return drift
+
+def check_patron_summaries() -> List[Dict]:
+    """
+    Verify the patrons summary table against borrow_records without changing it.
+
+    Returns:
+        list of dict: one {'patron_id', 'field', 'expected', 'actual'} entry per
+            mismatched value (None stands for a missing row); empty if there is no drift
+    """
+    with db_connection() as conn:
+        return _patron_summary_drift(conn)
+
+def rebuild_patron_summaries() -> List[Dict]:
+    """
+    Recompute the patrons summary table from borrow_records.
+
+    Returns:
+        list of dict: the drift found before rebuilding (see check_patron_summaries)
+    """
+    with db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            drift = _patron_summary_drift(conn)
+            conn.execute('DELETE FROM patrons')
+            conn.execute(f'INSERT INTO patrons (patron_id, open_loans, overdue_loans, last_activity) {_PATRON_SUMMARY_QUERY}')
+            conn.commit()
+            return drift
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+def iter_overdue_loans(as_of: datetime, patron_ids: Optional[List[str]] = None,
+                       batch_size: int = 1000) -> Iterator[Dict]:
+    """
+    Stream the open loans that were due before `as_of`, grouped by patron.
+
+    Patron IDs are passed as a single JSON array, so any number of patrons
+    costs one statement per batch. Rows are read `batch_size` at a time from
+    where the previous batch ended (keyset pagination on the sort order), and
+    each batch borrows a pooled connection only while it is read, so a slow
+    consumer (e.g. a client streaming late fees) does not hold a connection
+    for the length of the stream.
+
+    Args:
+        as_of: the moment loans must have been due before
+        patron_ids: patrons to include, or None for every patron
+        batch_size: rows fetched from SQLite per round trip
+
+    Yields:
+        dict: {'loan_id', 'patron_id', 'book_id', 'title', 'borrow_date', 'due_date'} ordered by patron ID, then due date
+    """
+    query = '''
+        SELECT br.id, br.patron_id, br.book_id, br.borrow_date, br.due_date, br.borrow_ts, br.due_ts, b.title
+        FROM borrow_records br
+        JOIN books b ON br.book_id = b.id
+        WHERE br.return_date IS NULL AND br.due_ts < ?
+    '''
+    parameters = [to_timestamp(as_of)]
+    if patron_ids is not None:
+        query += ' AND br.patron_id IN (SELECT value FROM json_each(?))'
+        parameters.append(json.dumps(list(patron_ids)))
+    query += ' AND (br.patron_id, br.due_ts, br.id) > (?, ?, ?) ORDER BY br.patron_id, br.due_ts, br.id LIMIT ?'
+
+    position = ('', float('-inf'), 0)
+    while True:
+        with db_connection() as conn:
+            records = conn.execute(query, [*parameters, *position, batch_size]).fetchall()
+        for record in records:
+            yield {
+                'loan_id': record['id'],
+                'patron_id': record['patron_id'],
+                'book_id': record['book_id'],
+                'title': record['title'],
+                'borrow_date': _loan_time(record, 'borrow'),
+                'due_date': _loan_time(record, 'due')
+            }
+        if len(records) < batch_size:
+            break
+        last = records[-1]
+        position = (last['patron_id'], last['due_ts'], last['id'])
+
+# Columns written by iter_export_rows for each exportable table
+EXPORT_COLUMNS = {
+    'books': ('id', 'title', 'author', 'isbn', 'total_copies', 'available_copies'),
+    'borrow_records': ('id', 'patron_id', 'book_id', 'borrow_date', 'due_date', 'return_date'),
+}
+
+def iter_export_rows(table: str, after_id: Optional[int] = None, since: Optional[datetime] = None,
+                     batch_size: int = 1000) -> Iterator[List[tuple]]:
+    """
+    Stream a whole table in id order, for bulk exports.
+
+    Rows are read `batch_size` at a time by id range (keyset pagination), and
+    each batch borrows a pooled connection only while it is read, so a slow
+    consumer (e.g. a client downloading an export) does not hold a connection
+    for the length of the stream. Memory use does not grow with the table;
+    rows committed during the export with a larger id than the last one read are included.
+
+    Args:
+        table: a key of EXPORT_COLUMNS
+        after_id: only rows with a larger id (resume from the last id of a previous export)
+        since: borrow_records only: loans borrowed or returned at or after this moment
+        batch_size: rows read per query
+
+    Yields:
+        list: up to `batch_size` row tuples in EXPORT_COLUMNS order
+    """
+    columns = EXPORT_COLUMNS[table]
+    query = f'SELECT {", ".join(columns)} FROM {table} WHERE id > ?'
+    filters = []
+    if since is not None:
+        query += ' AND (borrow_ts >= ? OR return_ts >= ?)'
+        filters = [to_timestamp(since)] * 2
+    query += ' ORDER BY id LIMIT ?'
+
+    last_id = after_id or 0
+    while True:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None  # plain tuples; no per-row Row objects
+            rows = cursor.execute(query, [last_id, *filters, batch_size]).fetchall()
+        if not rows:
+            break
+        yield rows
+        if len(rows) < batch_size:
+            break
+        last_id = rows[-1][0]  # id is the first export column
+
+def get_open_loan_id(patron_id: str, book_id: int) -> Optional[int]:
+    """Get the id of the patron's open loan of a book, or None if they do not have it out."""
+    with db_connection() as conn:
+        record = conn.execute(
+            'SELECT id FROM borrow_records WHERE patron_id = ? AND book_id = ? AND return_date IS NULL',
+            (patron_id, book_id)).fetchone()
+    return record[0] if record else None
+
+def get_open_loan_count() -> int:
+    """Get the number of open loans in the whole library."""
+    with db_connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM borrow_records WHERE return_date IS NULL').fetchone()[0]
+
+def get_open_loan_columns(due_before: Optional[datetime] = None) -> Tuple[List[int], List[str], List[int], List[int]]:
+    """
+    Get open loans as parallel columns, for sweeps over the whole library.
+
+    Args:
+        due_before: only include loans due before this moment (served from the
+            open-loans due date index), or None for every open loan
+
+    Returns:
+        tuple: (borrow record ids, patron IDs, book IDs, due timestamps), ordered by record id
+    """
+    query = 'SELECT id, patron_id, book_id, due_ts FROM borrow_records WHERE return_date IS NULL'
+    parameters = []
+    if due_before is not None:
+        query += ' AND due_ts < ?'
+        parameters.append(to_timestamp(due_before))
+    query += ' ORDER BY id'
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None  # plain tuples are much cheaper to build than sqlite3.Row
+        rows = cursor.execute(query, parameters).fetchall()
+    return ([row[0] for row in rows], [row[1] for row in rows],
+            [row[2] for row in rows], [row[3] for row in rows])
+
+def get_payment_allocations(transaction_id: str) -> List[Dict]:
+    """Get how a payment was split across loans, as {'loan_id', 'book_id', 'amount'} dicts in loan order."""
+    with db_connection() as conn:
+        rows = conn.execute('''
+            SELECT borrow_record_id AS loan_id, book_id, amount FROM payment_allocations
+            WHERE transaction_id = ? AND status = 'paid' ORDER BY borrow_record_id
+        ''', (transaction_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+def get_payment_job(job_id: int) -> Optional[Dict]:
+    """Get a payment job's status and result, or None if there is no such job."""
+    with db_connection() as conn:
+        record = conn.execute('''
+            SELECT id, kind, status, attempts, result, created_at, started_at, finished_at
+            FROM payment_jobs WHERE id = ?
+        ''', (job_id,)).fetchone()
+    if not record:
+        return None
+    job = dict(record)
+    job['result'] = json.loads(job['result']) if job['result'] is not None else None
+    return job
+
+_PAYMENT_COLUMNS = '''id, idempotency_key, transaction_id, patron_id, book_id, amount, refunded_amount,
+                      pending_refund, status, message, created_at, updated_at'''
+
+def get_payment_by_key(idempotency_key: str) -> Optional[Dict]:
+    """Get the ledger entry for a charge made with the given idempotency key."""
+    with db_connection() as conn:
+        record = conn.execute(f'SELECT {_PAYMENT_COLUMNS} FROM payments WHERE idempotency_key = ?',
+                              (idempotency_key,)).fetchone()
+    return dict(record) if record else None
+
+def get_payment_by_transaction(transaction_id: str) -> Optional[Dict]:
+    """Get the ledger entry for a gateway transaction."""
+    with db_connection() as conn:
+        record = conn.execute(f'SELECT {_PAYMENT_COLUMNS} FROM payments WHERE transaction_id = ?',
+                              (transaction_id,)).fetchone()
+    return dict(record) if record else None
 
 def insert_book(title: str, author: str, isbn: str, total_copies: int, available_copies: int) -> bool:
     """Insert a new book into the database."""
-    conn = get_db_connection()
-    try:
-        conn.execute('''
-            INSERT INTO books (title, author, isbn, total_copies, available_copies)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (title, author, isbn, total_copies, available_copies))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
+    with db_connection() as conn:
+        try:
+            conn.execute('''
+                INSERT INTO books (title, author, isbn, total_copies, available_copies)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (title, author, isbn, total_copies, available_copies))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
+
+def insert_books(books: List[Tuple[str, str, str, int]]) -> Tuple[int, List[str]]:
+    """
+    Insert a batch of books in one transaction, skipping ISBNs already in the catalog.
+
+    The full-text index and catalog version are updated once for the whole batch
+    rather than by the per-row insert triggers (see _add_bulk_insert_switch).
+
+    Args:
+        books: (title, author, isbn, total_copies) tuples with distinct ISBNs;
+            every copy starts out available
+
+    Returns:
+        tuple: (number of books inserted, ISBNs that were skipped as duplicates)
+    """
+    with db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            isbns = [book[2] for book in books]
+            existing = set()
+            for start in range(0, len(isbns), 500):
+                batch = isbns[start:start + 500]
+                placeholders = ', '.join('?' * len(batch))
+                existing.update(row[0] for row in conn.execute(
+                    f'SELECT isbn FROM books WHERE isbn IN ({placeholders})', batch))
+            # With AUTOINCREMENT every new id is above the largest id used so far
+            last_id = conn.execute("SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = 'books'").fetchone()[0]
+            conn.execute('UPDATE bulk_insert_state SET active = 1 WHERE id = 1')
+            # ON CONFLICT also covers an ISBN inserted between the lookup and the insert
+            # by a connection that does not take the write lock first
+            inserted = conn.executemany('''
+                INSERT INTO books (title, author, isbn, total_copies, available_copies)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(isbn) DO NOTHING
+            ''', ((title, author, isbn, copies, copies) for title, author, isbn, copies in books
+                  if isbn not in existing)).rowcount
+            conn.execute('UPDATE bulk_insert_state SET active = 0 WHERE id = 1')
+            if inserted:
+                if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'books_fts'").fetchone():
+                    conn.execute('''
+                        INSERT INTO books_fts (rowid, title, author)
+                        SELECT id, title, author FROM books WHERE id > ?
+                    ''', (last_id,))
+                conn.execute('UPDATE catalog_version SET version = version + 1 WHERE id = 1')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return inserted, [isbn for isbn in isbns if isbn in existing]
 
 def insert_borrow_record(patron_id: str, book_id: int, borrow_date: datetime, due_date: datetime) -> bool:
     """Insert a new borrow record into the database."""
-    conn = get_db_connection()
-    try:
-        conn.execute('''
-            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
-            VALUES (?, ?, ?, ?)
-        ''', (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat()))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
+    with db_connection() as conn:
+        try:
+            conn.execute('''
+                INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, borrow_ts, due_ts)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat(),
+                  to_timestamp(borrow_date), to_timestamp(due_date)))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
+
+def insert_payment_job(kind: str, payload: Dict) -> Optional[int]:
+    """Queue a payment job; returns its id, or None if it could not be stored."""
+    with db_connection() as conn:
+        try:
+            cursor = conn.execute('''
+                INSERT INTO payment_jobs (kind, payload, created_at) VALUES (?, ?, ?)
+            ''', (kind, json.dumps(payload), datetime.now().isoformat()))
+            conn.commit()
+            return cursor.lastrowid
+        except Exception as e:
+            conn.rollback()
+            return None
+
+def claim_payment_job(lease_seconds: float, now: Optional[datetime] = None) -> Optional[Dict]:
+    """
+    Claim the oldest queued payment job, or a running one whose lease has expired.
+
+    The job is marked running with a new lease in a single UPDATE, so two
+    workers (in any process) can never claim the same job at once.
+
+    Args:
+        lease_seconds: how long the claim lasts before another worker may take the job over
+        now: the current time (default: now)
+
+    Returns:
+        dict: {'id', 'kind', 'payload' (decoded), 'attempts'}, or None if no job is waiting
+    """
+    now = now or datetime.now()
+    with db_connection() as conn:
+        try:
+            record = conn.execute('''
+                UPDATE payment_jobs
+                SET status = 'running', attempts = attempts + 1, started_at = ?, lease_expires_ts = ?
+                WHERE id = (
+                    SELECT id FROM payment_jobs
+                    WHERE status = 'queued' OR (status = 'running' AND lease_expires_ts < ?)
+                    ORDER BY id LIMIT 1
+                )
+                RETURNING id, kind, payload, attempts
+            ''', (now.isoformat(), to_timestamp(now + timedelta(seconds=lease_seconds)), to_timestamp(now))).fetchone()
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    if not record:
+        return None
+    return {'id': record['id'], 'kind': record['kind'], 'payload': json.loads(record['payload']),
+            'attempts': record['attempts']}
+
+def finish_payment_job(job_id: int, status: str, result: Dict) -> bool:
+    """Record the outcome of a running payment job; `status` is 'succeeded', 'failed' or 'needs_review'."""
+    with db_connection() as conn:
+        try:
+            conn.execute('''
+                UPDATE payment_jobs SET status = ?, result = ?, finished_at = ?, lease_expires_ts = NULL
+                WHERE id = ? AND status = 'running'
+            ''', (status, json.dumps(result), datetime.now().isoformat(), job_id))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
+
+def begin_payment(idempotency_key: Optional[str], patron_id: str, book_id: Optional[int],
+                  amount: float) -> Tuple[Optional[int], Optional[Dict]]:
+    """
+    Add a pending charge to the payments ledger before the gateway is called.
+
+    A key already in the ledger is only taken over if its earlier charge ended
+    in an error (the gateway could not be reached), so the charge may be retried.
+
+    Args:
+        idempotency_key: the client's key for this charge, or None
+        patron_id: patron being charged
+        book_id: the book the fee is for, or None for a charge covering several books
+        amount: amount being charged
+
+    Returns:
+        tuple: (ledger id, None) if the charge may go ahead, or (None, existing ledger entry)
+            if the key belongs to a charge that is in progress or finished
+    """
+    with db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = _begin_payment(conn, idempotency_key, patron_id, book_id, amount)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return result
+
+def _begin_payment(conn: sqlite3.Connection, idempotency_key: Optional[str], patron_id: str,
+                   book_id: Optional[int], amount: float) -> Tuple[Optional[int], Optional[Dict]]:
+    """begin_payment inside the caller's write transaction."""
+    now = datetime.now().isoformat()
+    record = conn.execute('''
+        INSERT INTO payments (idempotency_key, patron_id, book_id, amount, status, created_at, updated_at)
+        VALUES (?, ?, ?, ?, 'pending', ?, ?)
+        ON CONFLICT (idempotency_key) DO UPDATE SET
+            patron_id = excluded.patron_id, book_id = excluded.book_id, amount = excluded.amount,
+            status = 'pending', message = NULL, updated_at = excluded.updated_at
+        WHERE status = 'error'
+        RETURNING id
+    ''', (idempotency_key, patron_id, book_id, amount, now, now)).fetchone()
+    if record:
+        return record['id'], None
+    return None, _payment_by_key(conn, idempotency_key)
+
+def _payment_by_key(conn: sqlite3.Connection, idempotency_key: str) -> Optional[Dict]:
+    record = conn.execute(f'SELECT {_PAYMENT_COLUMNS} FROM payments WHERE idempotency_key = ?',
+                          (idempotency_key,)).fetchone()
+    return dict(record) if record else None
+
+def reserve_late_fee_payment(idempotency_key: Optional[str], patron_id: str, fees: List[Dict],
+                             book_id: Optional[int] = None) -> Tuple[Optional[int], List[Dict], Optional[Dict]]:
+    """
+    Open a pending late fee charge and reserve the fees it covers, before the gateway is called.
+
+    Consolidated payments (pay_all_late_fees) and single-book payments
+    (pay_late_fees) both reserve through here, so each sees what the other
+    has paid or is paying.
+
+    In one write transaction, fees already paid or reserved by another pending
+    charge are subtracted from each loan's fee, the ledger entry is added, and
+    the outstanding amounts are recorded as pending allocations of that entry.
+    A concurrent payment for the same patron therefore finds nothing left to
+    charge instead of charging the same loans again. finish_payment turns the
+    reservations into paid allocations or releases them.
+
+    Args:
+        idempotency_key: the client's key for this charge, or None
+        patron_id: patron being charged
+        fees: {'loan_id', 'book_id', 'amount'} with each overdue loan's full late fee
+        book_id: the book a single-book charge is for, recorded on its ledger entry (None for a consolidated charge)
+
+    Returns:
+        tuple: (ledger id, reserved allocations, None) if the charge may go ahead;
+            (None, [], existing ledger entry) if the key belongs to another charge, or if
+            nothing is left to charge because another charge is still pending;
+            (None, [], None) if nothing is owed
+    """
+    with db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            covered = {}
+            pending_payment_id = None
+            loan_ids = {fee['loan_id'] for fee in fees}
+            for loan_id, amount, status, payment_id in conn.execute('''
+                SELECT borrow_record_id, SUM(amount), status, MAX(payment_id) FROM payment_allocations
+                WHERE patron_id = ? GROUP BY borrow_record_id, status
+            ''', (patron_id,)):
+                covered[loan_id] = covered.get(loan_id, 0.0) + amount
+                if status == 'pending' and loan_id in loan_ids:
+                    pending_payment_id = payment_id
+            allocations = [{**fee, 'amount': round(fee['amount'] - covered.get(fee['loan_id'], 0.0), 2)}
+                           for fee in fees]
+            allocations = [allocation for allocation in allocations if allocation['amount'] > 0]
+            total = round(sum(allocation['amount'] for allocation in allocations), 2)
+
+            if total <= 0:
+                existing = None
+                if idempotency_key:
+                    existing = _payment_by_key(conn, idempotency_key)
+                if existing is None and pending_payment_id is not None:
+                    record = conn.execute(f'SELECT {_PAYMENT_COLUMNS} FROM payments WHERE id = ?',
+                                          (pending_payment_id,)).fetchone()
+                    existing = dict(record) if record else None
+                conn.commit()
+                return None, [], existing
+
+            payment_id, existing = _begin_payment(conn, idempotency_key, patron_id, book_id, total)
+            if payment_id is not None:
+                conn.executemany('''
+                    INSERT INTO payment_allocations (payment_id, patron_id, borrow_record_id, book_id, amount, status)
+                    VALUES (?, ?, ?, ?, ?, 'pending')
+                ''', [(payment_id, patron_id, allocation['loan_id'], allocation['book_id'], allocation['amount'])
+                      for allocation in allocations])
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return (payment_id, allocations, None) if payment_id is not None else (None, [], existing)
+
+def finish_payment(payment_id: int, status: str, transaction_id: Optional[str], message: str) -> bool:
+    """
+    Record the gateway's answer for a pending or unknown ledger entry ('completed', 'failed', 'error' or 'unknown').
+
+    Allocations reserved for the charge become paid when it completed and are
+    released when it failed or errored, in the same transaction; an unknown
+    charge keeps them reserved until its outcome is settled.
+    """
+    now = datetime.now().isoformat()
+    with db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('''
+                UPDATE payments SET status = ?, transaction_id = ?, message = ?, updated_at = ? WHERE id = ?
+            ''', (status, transaction_id, message, now, payment_id))
+            if status == 'completed':
+                conn.execute('''
+                    UPDATE payment_allocations SET status = 'paid', transaction_id = ?, paid_at = ?
+                    WHERE payment_id = ? AND status = 'pending'
+                ''', (transaction_id, now, payment_id))
+            elif status in ('failed', 'error'):
+                conn.execute("DELETE FROM payment_allocations WHERE payment_id = ? AND status = 'pending'",
+                             (payment_id,))
+            conn.commit()
+            return True
+        except sqlite3.Error:
+            conn.rollback()
+            logger.exception("Could not record %s payment %s (transaction %s) in the ledger",
+                             status, payment_id, transaction_id)
+            return False
+
+def expire_pending_payments(pending_before: datetime, idempotency_key: Optional[str] = None) -> List[Optional[str]]:
+    """
+    Mark ledger entries that have been pending since before `pending_before` as 'unknown'.
+
+    A charge stays pending only while its process is waiting on the gateway,
+    so one that has been pending for longer than any gateway call can take
+    was cut off: it may or may not have been made. Keyed entries are then
+    looked up with the gateway by their key (see settle_payment). Keyless
+    entries cannot be looked up, so their reserved allocations are released
+    in the same transaction, or the patron's fees would stay blocked for good;
+    the entry stays 'unknown' for an operator to check.
+
+    Args:
+        pending_before: keyed entries last updated, and keyless entries created, before this moment are expired
+        idempotency_key: only expire the entry with this key
+
+    Returns:
+        list: the idempotency keys of the expired entries (None for keyless entries)
+    """
+    with db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            expired = conn.execute('''
+                UPDATE payments SET status = 'unknown', updated_at = ?, message = CASE
+                    WHEN idempotency_key IS NULL THEN 'Payment processing error: the charge was interrupted and '
+                        || 'has no idempotency key to look it up by; check it with the gateway.'
+                    ELSE 'Payment processing error: the charge was interrupted; its outcome is being checked.' END
+                WHERE status = 'pending' AND (? IS NULL OR idempotency_key = ?)
+                    AND CASE WHEN idempotency_key IS NULL THEN created_at ELSE updated_at END < ?
+                RETURNING id, idempotency_key
+            ''', (datetime.now().isoformat(), idempotency_key, idempotency_key, pending_before.isoformat())).fetchall()
+            keyless = [payment_id for payment_id, key in expired if key is None]
+            if keyless:
+                conn.execute(f'''
+                    DELETE FROM payment_allocations
+                    WHERE status = 'pending' AND payment_id IN ({", ".join("?" * len(keyless))})
+                ''', keyless)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return [key for _, key in expired]
+
+def update_payment_status(transaction_id: str, status: str) -> bool:
+    """Update a ledger entry's status with what the gateway reports."""
+    with db_connection() as conn:
+        try:
+            conn.execute('UPDATE payments SET status = ?, updated_at = ? WHERE transaction_id = ?',
+                         (status, datetime.now().isoformat(), transaction_id))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
+
+def record_payment_refund(transaction_id: str, amount: float) -> bool:
+    """Add a refund to a charge's ledger entry, marking it refunded once the whole amount is returned."""
+    with db_connection() as conn:
+        try:
+            conn.execute('''
+                UPDATE payments SET
+                    refunded_amount = refunded_amount + ?,
+                    status = CASE WHEN refunded_amount + ? >= amount THEN 'refunded' ELSE status END,
+                    updated_at = ?
+                WHERE transaction_id = ?
+            ''', (amount, amount, datetime.now().isoformat(), transaction_id))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
+
+def record_pending_refund(transaction_id: str, amount: float) -> bool:
+    """Hold a refund whose gateway call timed out as pending on the charge's ledger entry until it is confirmed."""
+    with db_connection() as conn:
+        try:
+            conn.execute('''
+                UPDATE payments SET pending_refund = pending_refund + ?, updated_at = ? WHERE transaction_id = ?
+            ''', (amount, datetime.now().isoformat(), transaction_id))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
+
+def settle_pending_refund(transaction_id: str, refunded: bool) -> bool:
+    """
+    Clear a charge's pending refund once the gateway has said whether it went through.
+
+    Args:
+        transaction_id: the refunded charge
+        refunded: True to add the pending amount to the refunded amount, False to drop it
+    """
+    with db_connection() as conn:
+        try:
+            conn.execute('''
+                UPDATE payments SET
+                    refunded_amount = refunded_amount + CASE WHEN ? THEN pending_refund ELSE 0 END,
+                    status = CASE WHEN ? AND refunded_amount + pending_refund >= amount THEN 'refunded' ELSE status END,
+                    pending_refund = 0,
+                    updated_at = ?
+                WHERE transaction_id = ?
+            ''', (refunded, refunded, datetime.now().isoformat(), transaction_id))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
 
 def update_book_availability(book_id: int, change: int) -> bool:
     """Update the available copies of a book by a given amount (+1 for return, -1 for borrow)."""
-    conn = get_db_connection()
-    try:
-        conn.execute('''
-            UPDATE books SET available_copies = available_copies + ? WHERE id = ?
-        ''', (change, book_id))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
+    with db_connection() as conn:
+        try:
+            conn.execute('''
+                UPDATE books SET available_copies = available_copies + ? WHERE id = ?
+            ''', (change, book_id))
+            conn.commit()
+            invalidate_cached_book(book_id)
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
 
 def update_borrow_record_return_date(patron_id: str, book_id: int, return_date: datetime) -> bool:
     """Update the return date for a borrow record."""
-    conn = get_db_connection()
-    try:
-        conn.execute('''
-            UPDATE borrow_records 
-            SET return_date = ? 
-            WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
-        ''', (return_date.isoformat(), patron_id, book_id))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
+    with db_connection() as conn:
+        try:
+            conn.execute('''
+                UPDATE borrow_records 
+                SET return_date = ?, return_ts = ?
+                WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
+            ''', (return_date.isoformat(), to_timestamp(return_date), patron_id, book_id))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            return False
+
+def borrow_book_atomic(patron_id: str, book_id: int, borrow_date: datetime, due_date: datetime,
+                       max_borrowed: int = 5) -> Tuple[str, Optional[Book]]:
+    """
+    Check and record a borrow in a single BEGIN IMMEDIATE transaction.
+
+    The availability, borrow limit and duplicate checks see the same snapshot as
+    the writes, and the decrement is guarded by `available_copies > 0`, so
+    concurrent borrowers can never take more copies than exist.
+
+    Returns:
+        tuple: (status: str, book: Book or None) where status is one of
+            'borrowed', 'not_found', 'unavailable', 'limit_reached',
+            'already_borrowed' or 'error'
+    """
+    with db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            books = _fetch_books(conn, f'SELECT {_BOOK_COLUMNS} FROM books WHERE id = ?', (book_id,))
+            if not books:
+                conn.rollback()
+                return 'not_found', None
+            book = books[0]
+            if book.available_copies <= 0:
+                conn.rollback()
+                return 'unavailable', book
+
+            patron = conn.execute('SELECT open_loans FROM patrons WHERE patron_id = ?', (patron_id,)).fetchone()
+            if patron and patron['open_loans'] >= max_borrowed:
+                conn.rollback()
+                return 'limit_reached', book
+
+            already_borrowed = conn.execute('''
+                SELECT 1 FROM borrow_records
+                WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
+            ''', (patron_id, book_id)).fetchone()
+            if already_borrowed:
+                conn.rollback()
+                return 'already_borrowed', book
+
+            updated = conn.execute('''
+                UPDATE books SET available_copies = available_copies - 1
+                WHERE id = ? AND available_copies > 0
+            ''', (book_id,)).rowcount
+            if updated == 0:
+                conn.rollback()
+                return 'unavailable', book
+
+            conn.execute('''
+                INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, borrow_ts, due_ts)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat(),
+                  to_timestamp(borrow_date), to_timestamp(due_date)))
+            conn.commit()
+            invalidate_cached_book(book_id)
+            return 'borrowed', book
+        except sqlite3.Error as e:
+            conn.rollback()
+            return 'error', None
+
+def return_book_atomic(patron_id: str, book_id: int, return_date: datetime) -> Tuple[str, Optional[Book], Optional[datetime]]:
+    """
+    Find a patron's open loan and record its return in a single BEGIN IMMEDIATE transaction.
+
+    The book and the open loan are fetched with one indexed lookup; the return
+    date and the availability increment are committed together.
+
+    Returns:
+        tuple: (status: str, book: Book or None, due_date: datetime or None) where
+            status is one of 'returned', 'not_found', 'not_borrowed' or 'error'
+    """
+    with db_connection() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            record = conn.execute(f'''
+                SELECT {_BOOK_COLUMNS_B}, br.id AS loan_id, br.due_date, br.due_ts
+                FROM books b
+                LEFT JOIN borrow_records br
+                    ON br.book_id = b.id AND br.patron_id = ? AND br.return_date IS NULL
+                WHERE b.id = ?
+                ORDER BY br.borrow_ts
+                LIMIT 1
+            ''', (patron_id, book_id)).fetchone()
+            if not record:
+                conn.rollback()
+                return 'not_found', None, None
+
+            book = Book.from_row(record[:len(Book._fields)])
+            if record['loan_id'] is None:
+                conn.rollback()
+                return 'not_borrowed', book, None
+
+            conn.execute('UPDATE borrow_records SET return_date = ?, return_ts = ? WHERE id = ?',
+                         (return_date.isoformat(), to_timestamp(return_date), record['loan_id']))
+            conn.execute('UPDATE books SET available_copies = available_copies + 1 WHERE id = ?', (book_id,))
+            conn.commit()
+            invalidate_cached_book(book_id)
+            return 'returned', book, _loan_time(record, 'due')
+        except sqlite3.Error as e:
+            conn.rollback()
+            return 'error', None, None
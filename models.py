@@ -0,0 +1,66 @@
+"""
+Record types returned by the data layer.
+
+Books and loans are frozen dataclasses with __slots__, which take a fraction of
+the memory of an equivalent dict and can be shared between callers (and the
+caches) without copying. They also behave as read-only mappings, so code,
+templates and jsonify can keep treating them like the dicts they replace:
+book['title'], book.get('isbn'), dict(book) and 'title' in book all work.
+"""
+
+from collections.abc import Mapping
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Optional, Tuple
+
+class Record(Mapping):
+    """Read-only mapping view over a slotted dataclass's fields."""
+
+    __slots__ = ()
+    _fields: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_row(cls, row):
+        """Build a record from a database row whose columns are in field order."""
+        return cls(*row)
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+def record(cls):
+    """Turn a Record subclass into a frozen, slotted dataclass; equality is the Mapping one, so records equal dicts."""
+    cls = dataclass(frozen=True, slots=True, eq=False, repr=False)(cls)
+    cls._fields = tuple(field.name for field in fields(cls))
+    return cls
+
+@record
+class Book(Record):
+    """A row of the books table."""
+    id: int
+    title: str
+    author: str
+    isbn: str
+    total_copies: int
+    available_copies: int
+
+@record
+class Loan(Record):
+    """A borrow record joined with its book's title and author."""
+    book_id: int
+    title: str
+    author: str
+    borrow_date: datetime
+    due_date: datetime
+    return_date: Optional[datetime]
+    is_overdue: bool
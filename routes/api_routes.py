@@ -2,9 +2,18 @@
 API Routes - JSON API endpoints
 """
 
-from flask import Blueprint, jsonify, request
-from services.library_service import calculate_late_fee_for_book, search_books_in_catalog
-from database import get_book_by_id
+import json
+from datetime import datetime
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from services.library_service import (
+    calculate_late_fee_for_book, calculate_late_fees_for_patrons, search_books_in_catalog, return_book_with_late_fee, SEARCH_RESULT_LIMIT,
+    pay_all_late_fees,
+    get_catalog_page, get_patron_history_page, DEFAULT_PAGE_SIZE
+)
+from services.catalog_import import IMPORT_FORMATS, decode_lines, import_books
+from services.data_export import EXPORT_MIMETYPES, EXPORT_TABLES, export_rows
+from database import get_book_by_id, get_book_cache_stats
+from .conditional import conditional, catalog_etag, book_etag
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
@@ -17,7 +26,113 @@ def get_late_fee(patron_id, book_id):
     result = calculate_late_fee_for_book(patron_id, book_id)
     return jsonify(result), 501 if 'not implemented' in result.get('status', '') else 200
 
+@api_bp.route('/late_fees', methods=['GET', 'POST'])
+def get_late_fees_bulk():
+    """
+    Calculate late fees for many patrons, streamed as one JSON object per line (NDJSON).
+    Patrons are given as `?patrons=123456,234567` or a JSON body `{"patron_ids": [...]}`;
+    "all" selects every patron with overdue loans.
+    Bulk API endpoint for R5: Late Fee Calculation
+    """
+    if request.method == 'POST':
+        patron_ids = (request.get_json(silent=True) or {}).get('patron_ids')
+    else:
+        patrons = request.args.get('patrons', '').strip()
+        patron_ids = patrons if patrons == 'all' else [p.strip() for p in patrons.split(',') if p.strip()] or None
+
+    if not patron_ids or not (patron_ids == 'all' or isinstance(patron_ids, list)):
+        return jsonify({'error': 'A list of patron IDs or "all" is required'}), 400
+
+    try:
+        summaries = calculate_late_fees_for_patrons(patron_ids)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def generate():
+        for summary in summaries:
+            yield json.dumps(summary, default=lambda value: value.isoformat()) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Request content types accepted by the catalog import, and the format each one carries
+IMPORT_CONTENT_TYPES = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'jsonl',
+    'application/jsonl': 'jsonl',
+    'application/json-lines': 'jsonl',
+}
+
+@api_bp.route('/books/import', methods=['POST'])
+def import_books_api():
+    """
+    Bulk-import books from a CSV (with a header line) or JSON Lines request body.
+    The format comes from `?format=csv|jsonl` or the Content-Type header.
+    Rows are read from the body as it arrives and written in batches; the response
+    reports counts, rows per second and the rows that were skipped. A body that
+    cannot be read to the end (not UTF-8, malformed CSV) gets a 400 naming the
+    line, with the counts of the rows imported before it.
+    API endpoint for R1: Book Catalog Management
+    """
+    format = request.args.get('format') or IMPORT_CONTENT_TYPES.get(request.mimetype)
+    if format not in IMPORT_FORMATS:
+        return jsonify({'error': 'Send text/csv or application/x-ndjson, or give ?format=csv or ?format=jsonl'}), 400
+
+    result = import_books(decode_lines(request.stream), format)
+    if result['failed']:
+        failed = result['failed']
+        return jsonify({**result, 'error': f"Line {failed['line']}: {failed['error']}"}), 400
+    return jsonify(result), 200
+
+@api_bp.route('/export/<name>')
+def export_api(name):
+    """
+    Stream the whole catalog (`books`) or loan history (`loans`) as CSV or NDJSON.
+    `?format=csv|ndjson` picks the format (CSV by default). Rows come in id order;
+    `?after_id=N` resumes after the last id of an earlier export, and for loans
+    `?since=<ISO timestamp>` selects loans borrowed or returned since then.
+    """
+    if name not in EXPORT_TABLES:
+        return jsonify({'error': f'Unknown export; choose one of: {", ".join(EXPORT_TABLES)}'}), 404
+    format = request.args.get('format', 'csv')
+    try:
+        after_id = int(request.args['after_id']) if request.args.get('after_id') else None
+        since = datetime.fromisoformat(request.args['since']) if request.args.get('since') else None
+        chunks = export_rows(name, format, after_id, since)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[format],
+                    headers={'Content-Disposition': f'attachment; filename={name}.{format}'})
+
+@api_bp.route('/pay_late_fees/<patron_id>', methods=['POST'])
+def pay_all_late_fees_api(patron_id):
+    """
+    Pay all of a patron's outstanding late fees in one transaction.
+    An Idempotency-Key header makes retrying the request safe.
+    API endpoint for R5: Late Fee Calculation
+    """
+    success, message, payment = pay_all_late_fees(patron_id, idempotency_key=request.headers.get('Idempotency-Key'))
+    return jsonify({
+        'success': success,
+        'message': message,
+        'payment': payment
+    }), 200 if success else 400
+
+@api_bp.route('/return/<patron_id>/<int:book_id>', methods=['POST'])
+def return_book_api(patron_id, book_id):
+    """
+    Return a book and report the late fee owed for it in one call.
+    API endpoint for R4: Book Return Processing and R5: Late Fee Calculation
+    """
+    success, message, late_fee = return_book_with_late_fee(patron_id, book_id)
+    return jsonify({
+        'success': success,
+        'message': message,
+        'late_fee': late_fee
+    }), 200 if success else 400
+
 @api_bp.route('/search')
+@conditional(catalog_etag)
 def search_books_api():
     """
     Search for books via API endpoint.
@@ -25,12 +140,13 @@ def search_books_api():
     """
     search_term = request.args.get('q', '').strip()
     search_type = request.args.get('type', 'title')
+    limit = request.args.get('limit', SEARCH_RESULT_LIMIT, type=int)
     
     if not search_term:
         return jsonify({'error': 'Search term is required'}), 400
     
     # Use business logic function
-    books = search_books_in_catalog(search_term, search_type)
+    books = search_books_in_catalog(search_term, search_type, limit)
     
     return jsonify({
         'search_term': search_term,
@@ -39,7 +155,53 @@ def search_books_api():
         'count': len(books)
     })
 
+@api_bp.route('/books')
+@conditional(catalog_etag)
+def list_books_api():
+    """
+    List the catalog one page at a time, ordered by title.
+    API endpoint for R2: Book Catalog Display
+    """
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    
+    try:
+        page = get_catalog_page(cursor, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'books': page['books'],
+        'count': len(page['books']),
+        'next': page['next_cursor']
+    })
+
+@api_bp.route('/patron/<patron_id>/history')
+def patron_history_api(patron_id):
+    """
+    List a patron's borrowing history one page at a time, oldest loans first.
+    API endpoint for R7: Patron Status Report
+    """
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    
+    try:
+        page = get_patron_history_page(patron_id, cursor, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if page is None:
+        return jsonify({'error': 'Invalid patron ID. Must be exactly 6 digits.'}), 400
+    
+    return jsonify({
+        'patron_id': patron_id,
+        'borrowing_history': page['borrowing_history'],
+        'count': len(page['borrowing_history']),
+        'next': page['next_cursor']
+    })
+
 @api_bp.route('/book/<int:book_id>', methods=['GET'])
+@conditional(book_etag)
 def get_book_details(book_id):
     """
     Calls the database function get_book_by_id directly
@@ -60,4 +222,11 @@ def get_book_details(book_id):
         return jsonify({
             "status": "error",
             "message": f"Book with ID {book_id} not found."
-        }), 404
\ No newline at end of file
+        }), 404
+
+@api_bp.route('/cache/stats')
+def cache_stats():
+    """
+    Report the size and hit, miss and eviction counters of the book lookup cache.
+    """
+    return jsonify({'book_cache': get_book_cache_stats()})
@@ -3,8 +3,10 @@ Catalog Routes - Book catalog related endpoints
 """
 
 from flask import Blueprint, render_template, request, redirect, url_for, flash
-from database import get_all_books
-from services.library_service import add_book_to_catalog
+from services.library_service import (
+    add_book_to_catalog, get_book_by_isbn, get_catalog_cursor_at, get_catalog_page, DEFAULT_PAGE_SIZE
+)
+from .conditional import conditional, catalog_etag
 
 catalog_bp = Blueprint('catalog', __name__)
 
@@ -14,13 +16,23 @@ def index():
     return redirect(url_for('catalog.catalog'))
 
 @catalog_bp.route('/catalog')
+@conditional(catalog_etag)
 def catalog():
     """
-    Display all books in the catalog.
+    Display the catalog one page at a time.
     Implements R2: Book Catalog Display
     """
-    books = get_all_books()
-    return render_template('catalog.html', books=books)
+    cursor = request.args.get('cursor')
+    page_size = request.args.get('page_size', DEFAULT_PAGE_SIZE, type=int)
+    
+    try:
+        page = get_catalog_page(cursor, page_size)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('catalog.catalog'))
+    
+    return render_template('catalog.html', books=page['books'], next_cursor=page['next_cursor'],
+                           is_first_page=not cursor, page_size=page_size)
 
 @catalog_bp.route('/add_book', methods=['GET', 'POST'])
 def add_book():
@@ -47,7 +59,9 @@ def add_book():
     
     if success:
         flash(message, 'success')
-        return redirect(url_for('catalog.catalog'))
+        # Show the page the new book is on; with a large catalog it is rarely the first one
+        book = get_book_by_isbn(isbn)
+        return redirect(url_for('catalog.catalog', cursor=get_catalog_cursor_at(book) if book else None))
     else:
         flash(message, 'error')
         return render_template('add_book.html')
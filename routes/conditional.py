@@ -0,0 +1,63 @@
+"""
+Conditional Requests - ETag support shared by the route blueprints
+"""
+
+import hashlib
+import json
+from functools import wraps
+from flask import current_app, g, make_response, request, session
+from database import db_connection, get_book_by_id, get_catalog_version
+
+def current_catalog_version():
+    """Get the catalog version read at the start of this request."""
+    if 'catalog_version' not in g:
+        with db_connection() as conn:
+            g.catalog_version = get_catalog_version(conn)
+    return g.catalog_version
+
+def catalog_etag(*args, **kwargs):
+    """
+    ETag for pages and responses built from the whole catalog.
+
+    Returns None (no conditional handling) while flash messages are waiting to
+    be shown, since those are part of the rendered page but not of the catalog.
+    """
+    if session.get('_flashes'):
+        return None
+    return f"catalog-{current_catalog_version()}"
+
+def book_etag(book_id, *args, **kwargs):
+    """ETag for a single book, derived from its current contents (served from the book cache)."""
+    book = get_book_by_id(book_id)
+    if not book:
+        return None
+    digest = hashlib.sha1(json.dumps(dict(book), sort_keys=True).encode()).hexdigest()[:16]
+    return f"book-{book_id}-{digest}"
+
+def conditional(etag_function):
+    """
+    Answer `If-None-Match` requests with 304 Not Modified before the view runs.
+
+    `etag_function` receives the view's URL arguments and returns a strong ETag,
+    or None to serve the request normally. Successful responses carry the ETag
+    and `Cache-Control: no-cache`, so clients revalidate on every use.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = etag_function(*args, **kwargs)
+            if etag is None:
+                return view(*args, **kwargs)
+
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,87 @@
+"""
+Payment Routes - Queue late fee payments and refunds, and report their progress
+
+Submitting a payment only queues a job (see services.payment_jobs) and answers
+202 Accepted with the job's status URL; the gateway is called in the background.
+An Idempotency-Key header makes resubmitting the same payment safe.
+"""
+
+from flask import Blueprint, jsonify, request, url_for
+from services.payment_jobs import enqueue_payment_job
+from services.library_service import IDEMPOTENCY_KEY_REUSED, get_payment_status, idempotency_key_conflicts
+from services.payment_service import get_payment_gateway
+from database import get_payment_job
+
+payments_bp = Blueprint('payments', __name__, url_prefix='/api/payments')
+
+def _accepted(kind, payload):
+    """Queue a job and answer 202 with where to poll for its result."""
+    if request.headers.get('Idempotency-Key'):
+        payload['idempotency_key'] = request.headers['Idempotency-Key']
+        if 'patron_id' in payload and idempotency_key_conflicts(payload['idempotency_key'], payload['patron_id'],
+                                                                 payload.get('book_id')):
+            return jsonify({'error': IDEMPOTENCY_KEY_REUSED}), 422
+    job_id = enqueue_payment_job(kind, payload)
+    if job_id is None:
+        return jsonify({'error': 'Payment could not be queued'}), 503
+    status_url = url_for('payments.payment_job_status', job_id=job_id)
+    return jsonify({'job_id': job_id, 'status': 'queued', 'status_url': status_url}), 202, {'Location': status_url}
+
+@payments_bp.route('/late_fees', methods=['POST'])
+def queue_late_fee_payment():
+    """
+    Queue payment of a patron's late fees: for one book if `book_id` is given, otherwise for all overdue books.
+    API endpoint for R5: Late Fee Calculation
+    """
+    data = request.get_json(silent=True) or {}
+    patron_id = data.get('patron_id')
+    book_id = data.get('book_id')
+    if not isinstance(patron_id, str):
+        return jsonify({'error': 'patron_id is required'}), 400
+    if book_id is None:
+        return _accepted('pay_all_late_fees', {'patron_id': patron_id})
+    if not isinstance(book_id, int) or isinstance(book_id, bool):
+        return jsonify({'error': 'book_id must be an integer'}), 400
+    return _accepted('pay_late_fees', {'patron_id': patron_id, 'book_id': book_id})
+
+@payments_bp.route('/refunds', methods=['POST'])
+def queue_refund():
+    """
+    Queue a refund of a late fee payment.
+    """
+    data = request.get_json(silent=True) or {}
+    transaction_id = data.get('transaction_id')
+    amount = data.get('amount')
+    if not isinstance(transaction_id, str):
+        return jsonify({'error': 'transaction_id is required'}), 400
+    if not isinstance(amount, (int, float)) or isinstance(amount, bool):
+        return jsonify({'error': 'amount must be a number'}), 400
+    return _accepted('refund_late_fee_payment', {'transaction_id': transaction_id, 'amount': amount})
+
+@payments_bp.route('/jobs/<int:job_id>')
+def payment_job_status(job_id):
+    """
+    Report a payment job's status ('queued', 'running', 'succeeded', 'failed' or 'needs_review')
+    and, once finished, its result.
+    """
+    job = get_payment_job(job_id)
+    if not job:
+        return jsonify({'error': 'Payment job not found'}), 404
+    return jsonify(job)
+
+@payments_bp.route('/transactions/<transaction_id>')
+def payment_status(transaction_id):
+    """
+    Report a payment's status, from the payments ledger where its outcome is known.
+    """
+    try:
+        return jsonify(get_payment_status(transaction_id))
+    except Exception as e:
+        return jsonify({'error': f"Payment status unavailable: {str(e)}"}), 502
+
+@payments_bp.route('/circuit')
+def payment_circuit_status():
+    """
+    Report the payment gateway circuit breaker's state and counters, for monitoring.
+    """
+    return jsonify(get_payment_gateway().breaker.stats())
@@ -0,0 +1,191 @@
+"""
+Catalog Import Module - Bulk loading of books from CSV or JSON Lines files
+
+Rows are read one at a time from the open file, so an import of any size
+keeps only one batch in memory. Each row is checked with the same rules as
+`add_book_to_catalog`; valid rows are written in batches, one transaction and
+one executemany per batch, instead of one transaction per book. ISBNs already
+in the catalog (or earlier in the same file) are skipped and reported with
+the row they came from, as are rows that fail validation. A file that cannot
+be read any further (bad text encoding, malformed CSV) stops the import at
+that line; the rows before it are still imported.
+"""
+
+import csv
+import json
+import time
+from typing import Callable, Dict, IO, Iterable, Iterator, Optional, Tuple
+
+from database import insert_books, refresh_caches
+from services.library_service import validate_book
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+IMPORT_FIELDS = ('title', 'author', 'isbn', 'total_copies')
+IMPORT_BATCH_SIZE = 5000  # Rows written per transaction
+MAX_REPORTED_ERRORS = 1000  # Rows listed in the result's errors; later ones are only counted
+
+class ImportFileError(ValueError):
+    """The import file cannot be read past a line (bad text encoding or malformed CSV)."""
+
+    def __init__(self, line: int, message: str):
+        super().__init__(f"Line {line}: {message}")
+        self.line = line
+        self.message = message
+
+def detect_import_format(filename: str) -> Optional[str]:
+    """Guess the import format from a file name ('.csv', '.jsonl' or '.ndjson')."""
+    name = filename.lower()
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return None
+
+def decode_lines(source: IO[bytes]) -> Iterator[str]:
+    """
+    Decode a UTF-8 byte stream one line at a time.
+
+    Decoding per line (rather than through a TextIOWrapper, which decodes in
+    large chunks) lets an undecodable byte be reported with its line number.
+    A leading byte order mark is dropped.
+
+    Raises:
+        ImportFileError: at the first line that is not valid UTF-8
+    """
+    for line_number, line in enumerate(source, 1):
+        try:
+            yield line.decode('utf-8-sig' if line_number == 1 else 'utf-8')
+        except UnicodeDecodeError as e:
+            raise ImportFileError(line_number, f"File is not valid UTF-8 text ({e.reason}).") from e
+
+def iter_import_rows(source: Iterable[str], format: str) -> Iterator[Tuple[int, object]]:
+    """
+    Read raw rows from a CSV file (with a header line) or a JSON Lines file.
+
+    Args:
+        source: text file positioned at the start of the data (or decode_lines over a byte stream)
+        format: 'csv' or 'jsonl'
+
+    Yields:
+        tuple: (line number, row dict), or (line number, error message) for a line that cannot be parsed
+
+    Raises:
+        ImportFileError: if the file cannot be decoded or the CSV is malformed; rows before it were yielded
+    """
+    if format == 'csv':
+        reader = csv.DictReader(source)
+        try:
+            missing = [field for field in IMPORT_FIELDS if field not in (reader.fieldnames or ())]
+            if missing:
+                yield 1, f"CSV header is missing column(s): {', '.join(missing)}."
+                return
+            for row in reader:
+                yield reader.line_num, row
+        except csv.Error as e:
+            raise ImportFileError(reader.line_num + 1, f"Malformed CSV: {e}") from e
+    elif format == 'jsonl':
+        for line_number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, f"Invalid JSON: {e}"
+                continue
+            yield line_number, row if isinstance(row, dict) else "Each line must be a JSON object."
+    else:
+        raise ValueError(f"Unknown import format: {format!r}")
+
+def parse_book_row(row: Dict) -> Tuple[Optional[Tuple[str, str, str, int]], Optional[str]]:
+    """
+    Turn a raw import row into a book, applying the catalog rules (R1).
+
+    Returns:
+        tuple: ((title, author, isbn, total_copies), None) or (None, error message)
+    """
+    title = row.get('title') or ''
+    author = row.get('author') or ''
+    isbn = str(row.get('isbn') or '').strip()
+    total_copies = row.get('total_copies')
+    if isinstance(total_copies, str):
+        try:
+            total_copies = int(total_copies.strip())
+        except ValueError:
+            return None, "Total copies must be a positive integer."
+    if isinstance(total_copies, bool) or not isinstance(title, str) or not isinstance(author, str):
+        return None, "Title and author must be text and total copies a positive integer."
+
+    error = validate_book(title, author, isbn, total_copies)
+    if error:
+        return None, error
+    return (title.strip(), author.strip(), isbn, total_copies), None
+
+def import_books(source: Iterable[str], format: str, batch_size: int = IMPORT_BATCH_SIZE,
+                 on_batch: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Import books from a CSV or JSON Lines file.
+
+    Args:
+        source: text file (or decode_lines over a byte stream) to read rows from
+        format: 'csv' or 'jsonl'
+        batch_size: rows written per transaction
+        on_batch: called with the running result after each batch is written (e.g. to show progress)
+
+    Returns:
+        dict: rows read, books imported, duplicates skipped, invalid rows, the first
+            MAX_REPORTED_ERRORS problems as {'line', 'isbn', 'error'}, elapsed seconds and rows per second,
+            and 'failed': None, or {'line', 'error'} if the file could not be read to the end
+            (the rows read before that line are still imported and counted)
+    """
+    result = {'rows': 0, 'imported': 0, 'duplicates': 0, 'invalid': 0, 'errors': [],
+              'seconds': 0.0, 'rows_per_second': 0.0, 'failed': None}
+    start = time.perf_counter()
+
+    def update_rate():
+        result['seconds'] = time.perf_counter() - start
+        result['rows_per_second'] = result['rows'] / result['seconds'] if result['seconds'] else 0.0
+
+    def report_error(line_number, isbn, error):
+        if len(result['errors']) < MAX_REPORTED_ERRORS:
+            result['errors'].append({'line': line_number, 'isbn': isbn, 'error': error})
+
+    def write(batch):
+        """Write one batch of books, keyed by ISBN with their line numbers."""
+        inserted, duplicates = insert_books([book for book, _ in batch.values()])
+        result['imported'] += inserted
+        result['duplicates'] += len(batch) - inserted
+        for isbn in duplicates:
+            report_error(batch[isbn][1], isbn, "A book with this ISBN already exists.")
+        update_rate()
+        if on_batch:
+            on_batch(result)
+
+    batch = {}
+    try:
+        for line_number, row in iter_import_rows(source, format):
+            result['rows'] += 1
+            book, error = parse_book_row(row) if isinstance(row, dict) else (None, row)
+            if error:
+                result['invalid'] += 1
+                report_error(line_number, row.get('isbn') if isinstance(row, dict) else None, error)
+                continue
+            isbn = book[2]
+            if isbn in batch:
+                # Duplicates in earlier batches are already in the catalog and are found by insert_books
+                result['duplicates'] += 1
+                report_error(line_number, isbn, "Duplicate ISBN in this file.")
+                continue
+            batch[isbn] = (book, line_number)
+            if len(batch) >= batch_size:
+                write(batch)
+                batch = {}
+    except ImportFileError as e:
+        result['failed'] = {'line': e.line, 'error': e.message}
+    if batch:
+        write(batch)
+    update_rate()
+
+    # New books change the catalog version, so listings are re-read on their own;
+    # this also drops the process's book lookups without waiting for the next request
+    refresh_caches()
+    return result
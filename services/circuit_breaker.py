@@ -0,0 +1,189 @@
+"""
+Circuit Breaker Module - Fail fast when an external service is slow or down
+
+Calls go through CircuitBreaker.call, which runs them on a small thread pool
+and stops waiting once the per-call deadline passes, so a hung service cannot
+hold the caller's thread. Outcomes of the most recent calls are kept in a
+rolling window; when too many of them failed or were slow, the circuit opens
+and calls are rejected immediately with CircuitOpenError. After a cool-down
+the circuit is half-open: a limited number of probe calls are let through,
+and their outcome closes the circuit again or re-opens it.
+
+A call that misses its deadline is abandoned, not stopped: it keeps running
+on its thread and may still take effect, so callers must treat
+DeadlineExceeded as an unknown outcome rather than a failure to retry.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a call while the circuit is open."""
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a call does not finish within the breaker's deadline; the call itself may still complete."""
+
+class CircuitBreaker:
+    """Circuit breaker with a per-call deadline, a rolling failure/latency window and half-open probing."""
+
+    def __init__(self, name: str, deadline: float = 5.0, window_size: int = 20, minimum_calls: int = 5,
+                 failure_rate_threshold: float = 0.5, slow_call_duration: float = 2.0,
+                 slow_call_rate_threshold: float = 0.5, open_seconds: float = 30.0, half_open_calls: int = 1,
+                 max_concurrent_calls: int = 10, clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            name: service name used in error messages and stats
+            deadline: seconds to wait for a call before giving up on it
+            window_size: number of recent calls the failure and slow-call rates are taken over
+            minimum_calls: calls needed in the window before the circuit can open
+            failure_rate_threshold: fraction of failed calls (errors and missed deadlines) that opens the circuit
+            slow_call_duration: calls taking at least this many seconds count as slow
+            slow_call_rate_threshold: fraction of slow calls that opens the circuit
+            open_seconds: how long the circuit stays open before probing
+            half_open_calls: probe calls allowed at once while half-open
+            max_concurrent_calls: threads available for calls; further calls queue, and the
+                time spent queued counts towards the deadline
+            clock: monotonic clock, replaceable in tests
+        """
+        self.name = name
+        self.deadline = deadline
+        self.minimum_calls = minimum_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._clock = clock
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_calls, thread_name_prefix=f"{name} call")
+        self._lock = threading.Lock()
+        self._window = deque(maxlen=window_size)  # (failed, slow) for each recent call
+        self._state = CLOSED
+        self._opened_at = None
+        self._probes = 0
+        self._counters = dict.fromkeys(
+            ('calls', 'successes', 'failures', 'deadlines_exceeded', 'slow_calls', 'rejected', 'times_opened'), 0)
+
+    def call(self, function: Callable, *args, **kwargs):
+        """
+        Call `function` through the breaker.
+
+        Any exception raised by `function` counts as a failed call, so services
+        should raise (rather than return) errors that mean the service is unwell.
+
+        Raises:
+            CircuitOpenError: if the circuit is open (the function is not called)
+            DeadlineExceeded: if the function does not return within the deadline
+            Exception: whatever the function raises
+        """
+        probe = self._before_call()
+        start = self._clock()
+        future = self._executor.submit(function, *args, **kwargs)
+        try:
+            result = future.result(timeout=self.deadline)
+        except Exception:
+            if future.done():
+                self._after_call(probe, False, self._clock() - start)
+                raise
+            future.cancel()
+            self._after_call(probe, False, self._clock() - start, deadline_exceeded=True)
+            raise DeadlineExceeded(f"{self.name} did not respond within {self.deadline:g} s") from None
+        self._after_call(probe, True, self._clock() - start)
+        return result
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def stats(self) -> Dict:
+        """State and counters for monitoring."""
+        with self._lock:
+            state = self._current_state()
+            calls = len(self._window)
+            return {
+                'name': self.name,
+                'state': state,
+                'retry_after': round(self._retry_after(), 1) if state == OPEN else None,
+                'window': {
+                    'calls': calls,
+                    'failure_rate': sum(failed for failed, _ in self._window) / calls if calls else 0.0,
+                    'slow_call_rate': sum(slow for _, slow in self._window) / calls if calls else 0.0
+                },
+                **self._counters
+            }
+
+    def reset(self) -> None:
+        """Close the circuit and forget recent calls."""
+        with self._lock:
+            self._close()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and self._retry_after() <= 0:
+            return HALF_OPEN
+        return self._state
+
+    def _retry_after(self) -> float:
+        return self._opened_at + self.open_seconds - self._clock()
+
+    def _before_call(self) -> bool:
+        """Admit a call or raise CircuitOpenError; returns True if the call is a half-open probe."""
+        with self._lock:
+            if self._current_state() == OPEN:
+                self._counters['rejected'] += 1
+                raise CircuitOpenError(f"{self.name} is unavailable (circuit open); "
+                                       f"try again in {max(self._retry_after(), 0):.0f} s")
+            if self._current_state() == HALF_OPEN:
+                if self._state == OPEN:
+                    self._state = HALF_OPEN
+                    self._probes = 0
+                if self._probes >= self.half_open_calls:
+                    self._counters['rejected'] += 1
+                    raise CircuitOpenError(f"{self.name} is unavailable (checking whether it has recovered); "
+                                           "try again shortly")
+                self._probes += 1
+            self._counters['calls'] += 1
+            return self._state == HALF_OPEN
+
+    def _after_call(self, probe: bool, succeeded: bool, duration: float, deadline_exceeded: bool = False) -> None:
+        slow = duration >= self.slow_call_duration
+        with self._lock:
+            self._counters['successes' if succeeded else 'failures'] += 1
+            self._counters['deadlines_exceeded'] += deadline_exceeded
+            self._counters['slow_calls'] += slow
+            if probe:
+                self._probes -= 1
+                if succeeded and not slow:
+                    self._close()
+                else:
+                    self._open()
+                return
+            self._window.append((not succeeded, slow))
+            if self._state == CLOSED and self._window_exceeds_thresholds():
+                self._open()
+
+    def _window_exceeds_thresholds(self) -> bool:
+        calls = len(self._window)
+        if calls < self.minimum_calls:
+            return False
+        failures = sum(failed for failed, _ in self._window)
+        slow_calls = sum(slow for _, slow in self._window)
+        return (failures / calls >= self.failure_rate_threshold or
+                slow_calls / calls >= self.slow_call_rate_threshold)
+
+    def _open(self) -> None:
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._counters['times_opened'] += 1
+
+    def _close(self) -> None:
+        self._state = CLOSED
+        self._opened_at = None
+        self._probes = 0
+        self._window.clear()
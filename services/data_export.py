@@ -0,0 +1,76 @@
+"""
+Data Export Module - Streaming CSV and NDJSON exports of the catalog and loan history
+
+Exports are generators of text chunks, one chunk per batch of rows read from
+the database cursor, so a route or command can write them out as they are
+produced without holding the table in memory. Rows come out in id order; an
+export can be resumed from the last id it produced, and loans can also be
+exported from a point in time.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Iterator, Optional
+
+from database import EXPORT_COLUMNS, iter_export_rows
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+EXPORT_BATCH_SIZE = 1000  # Rows fetched and written per chunk
+
+# Public export names and the table each one reads
+EXPORT_TABLES = {
+    'books': 'books',
+    'loans': 'borrow_records',
+}
+
+def export_rows(name: str, format: str, after_id: Optional[int] = None, since: Optional[datetime] = None,
+                header: bool = True, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[str]:
+    """
+    Export the books catalog or the loan history as CSV or NDJSON.
+
+    Args:
+        name: 'books' or 'loans'
+        format: 'csv' or 'ndjson'
+        after_id: only rows with a larger id
+        since: loans only: loans borrowed or returned at or after this moment
+        header: write a CSV header line first
+        batch_size: rows per chunk
+
+    Returns:
+        iterator: str chunks of the export, each holding whole rows
+
+    Raises:
+        ValueError: for an unknown export name or format, or `since` with books
+    """
+    # Checked here rather than in the generators, so errors surface before a response starts
+    if name not in EXPORT_TABLES:
+        raise ValueError(f"Unknown export: {name!r}")
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {format!r}")
+    if since is not None and name != 'loans':
+        raise ValueError("Only loans can be exported since a timestamp; use after_id for books.")
+
+    table = EXPORT_TABLES[name]
+    columns = EXPORT_COLUMNS[table]
+    batches = iter_export_rows(table, after_id, since, batch_size)
+    return _csv_chunks(columns, batches, header) if format == 'csv' else _ndjson_chunks(columns, batches)
+
+def _csv_chunks(columns, batches, header) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    if header:
+        writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def _ndjson_chunks(columns, batches) -> Iterator[str]:
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
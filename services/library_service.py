@@ -3,14 +3,31 @@ Library Service Module - Business Logic Functions
 Contains all the core business logic for the Library Management System
 """
 
+import base64
+import json
+import logging
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from itertools import groupby
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple, Union
 from database import (
     get_book_by_id, get_book_by_isbn, get_patron_borrow_count,
-    insert_book, insert_borrow_record, update_book_availability,
-    update_borrow_record_return_date, get_all_books, get_patron_borrowed_books, get_patron_borrowing_history
+    insert_book, get_all_books, get_patron_borrowed_books, get_patron_borrowing_history,
+    borrow_book_atomic, return_book_atomic, search_books, get_books_by_isbns,
+    get_books_page, get_patron_borrowing_history_page, iter_overdue_loans, get_patron_summary,
+    reserve_late_fee_payment, get_payment_allocations, get_open_loan_id, get_payment_by_key,
+    get_payment_by_transaction, begin_payment, finish_payment, update_payment_status, record_payment_refund,
+    record_pending_refund, settle_pending_refund
 )
-from services.payment_service import PaymentGateway
+from services.payment_service import AsyncPaymentGateway, PaymentGateway, charge_outcome_unknown, get_payment_gateway
+
+logger = logging.getLogger(__name__)
+
+SEARCH_RESULT_LIMIT = 100  # Maximum number of books returned by one title/author search
+DEFAULT_PAGE_SIZE = 50  # Books or history records per page when no page size is given
+MAX_PAGE_SIZE = 200  # Largest page size a client may request
+PAYMENT_SUCCEEDED_STATUSES = ('completed', 'refunded')  # Ledger statuses of charges that went through
+PAYMENT_FINAL_STATUSES = ('completed', 'failed', 'refunded')  # Ledger statuses that never change on their own
+IDEMPOTENCY_KEY_REUSED = "This idempotency key was already used for a different payment."
 
 def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -> Tuple[bool, str]:
     """
@@ -27,23 +44,9 @@ def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -
         tuple: (success: bool, message: str)
     """
     # Input validation
-    if not title or not title.strip():
-        return False, "Title is required."
-    
-    if len(title.strip()) > 200:
-        return False, "Title must be less than 200 characters."
-    
-    if not author or not author.strip():
-        return False, "Author is required."
-    
-    if len(author.strip()) > 100:
-        return False, "Author must be less than 100 characters."
-    
-    if len(isbn) != 13:
-        return False, "ISBN must be exactly 13 digits."
-    
-    if not isinstance(total_copies, int) or total_copies <= 0:
-        return False, "Total copies must be a positive integer."
+    error = validate_book(title, author, isbn, total_copies)
+    if error:
+        return False, error
     
     # Check for duplicate ISBN
     existing = get_book_by_isbn(isbn)
@@ -57,6 +60,33 @@ def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -
     else:
         return False, "Database error occurred while adding the book."
 
+def validate_book(title: str, author: str, isbn: str, total_copies: int) -> Optional[str]:
+    """
+    Check a new book's details against the catalog rules (R1).
+    
+    Returns:
+        str: the first problem found, or None if the details are valid
+    """
+    if not title or not title.strip():
+        return "Title is required."
+    
+    if len(title.strip()) > 200:
+        return "Title must be less than 200 characters."
+    
+    if not author or not author.strip():
+        return "Author is required."
+    
+    if len(author.strip()) > 100:
+        return "Author must be less than 100 characters."
+    
+    if len(isbn) != 13:
+        return "ISBN must be exactly 13 digits."
+    
+    if not isinstance(total_copies, int) or total_copies <= 0:
+        return "Total copies must be a positive integer."
+    
+    return None
+
 def borrow_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     """
     Allow a patron to borrow a book.
@@ -73,38 +103,26 @@ def borrow_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
         return False, "Invalid patron ID. Must be exactly 6 digits."
     
-    # Check if book exists and is available
-    book = get_book_by_id(book_id)
-    if not book:
+    # Check limits and record the borrow in one transaction
+    borrow_date = datetime.now()
+    due_date = borrow_date + timedelta(days=14)
+    status, book = borrow_book_atomic(patron_id, book_id, borrow_date, due_date, max_borrowed=5)
+
+    if status == 'not_found':
         return False, "Book not found."
     
-    if book['available_copies'] <= 0:
+    if status == 'unavailable':
         return False, "This book is currently not available."
     
-    # Check patron's current borrowed books count
-    current_borrowed = get_patron_borrow_count(patron_id)
-    if current_borrowed >= 5:
+    if status == 'limit_reached':
         return False, "You have reached the maximum borrowing limit of 5 books."
 
-    # Check if book is already borrowed by this patron
-    borrowed_books = get_patron_borrowed_books(patron_id)
-    for book in borrowed_books:
-        if book['book_id'] == book_id:
-            return False, "This book is already borrowed by you."
+    if status == 'already_borrowed':
+        return False, "This book is already borrowed by you."
     
-    # Create borrow record
-    borrow_date = datetime.now()
-    due_date = borrow_date + timedelta(days=14)
-    
-    # Insert borrow record and update availability
-    borrow_success = insert_borrow_record(patron_id, book_id, borrow_date, due_date)
-    if not borrow_success:
+    if status != 'borrowed':
         return False, "Database error occurred while creating borrow record."
     
-    availability_success = update_book_availability(book_id, -1)
-    if not availability_success:
-        return False, "Database error occurred while updating book availability."
-    
     return True, f'Successfully borrowed "{book["title"]}". Due date: {due_date.strftime("%Y-%m-%d")}.'
 
 def return_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
@@ -119,36 +137,73 @@ def return_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     Returns:
         tuple: (success: bool, message: str)
     """
+    success, message, _ = return_book_with_late_fee(patron_id, book_id)
+    return success, message
+
+def return_book_with_late_fee(patron_id: str, book_id: int) -> Tuple[bool, str, Dict]:
+    """
+    Process book return by a patron and report the late fee owed for it.
+
+    The loan lookup, return date and availability update run in one transaction,
+    and the late fee is computed from the same loan record, so return desks do
+    not need a separate late fee lookup.
+
+    Args:
+        patron_id: 6-digit library card ID
+        book_id: ID of the book to return
+        
+    Returns:
+        tuple: (success: bool, message: str, late_fee: dict)
+            late_fee has the same shape as calculate_late_fee_for_book's result
+    """
     # Validate patron ID
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
-        return False, "Invalid patron ID. Must be exactly 6 digits."
+        message = "Invalid patron ID. Must be exactly 6 digits."
+        return False, message, {'fee_amount': 0.0, 'days_overdue': None, 'status': message}
 
-    # Check if book exists and is borrowed by this patron
-    book = get_book_by_id(book_id)
-    if not book:
-        return False, "Book not found."
+    # Find the open loan and record the return in one transaction
+    return_date = datetime.now()
+    status, book, due_date = return_book_atomic(patron_id, book_id, return_date)
 
-    # Check if book is borrowed by this patron
-    borrowed_books = get_patron_borrowed_books(patron_id)
-    borrow_record = None
-    for book in borrowed_books:
-        if book['book_id'] == book_id:
-            borrow_record = book
-            break
-    if not borrow_record:
-        return False, "Book was not borrowed by this patron."
+    if status == 'not_found':
+        return False, "Book not found.", {'fee_amount': 0.0, 'days_overdue': None, 'status': "Book not found."}
 
-    # Update return date and book availability
-    return_date = datetime.now()
-    return_success = update_borrow_record_return_date(patron_id, book_id, return_date)
-    if not return_success:
-        return False, "Database error occurred while updating return date."
-    
-    availability_success = update_book_availability(book_id, 1)
-    if not availability_success:
-        return False, "Database error occurred while updating book availability."
+    if status == 'not_borrowed':
+        message = "Book was not borrowed by this patron."
+        return False, message, {'fee_amount': 0.0, 'days_overdue': None, 'status': "Borrow record not found."}
 
-    return True, f'Successfully returned "{book["title"]}". Return date: {return_date.strftime("%Y-%m-%d")}.'
+    if status != 'returned':
+        message = "Database error occurred while updating return date."
+        return False, message, {'fee_amount': 0.0, 'days_overdue': None, 'status': message}
+
+    late_fee = compute_late_fee(due_date, return_date)
+    message = f'Successfully returned "{book["title"]}". Return date: {return_date.strftime("%Y-%m-%d")}.'
+    if late_fee['fee_amount'] > 0:
+        message += f" Late fee: ${late_fee['fee_amount']:.2f} ({late_fee['days_overdue']} days overdue)."
+    return True, message, late_fee
+
+def compute_late_fee(due_date: datetime, as_of: datetime) -> Dict:
+    """
+    Apply the late fee schedule to a loan.
+
+    Books are due 14 days after borrowing:
+    - $0.50/day for the first 7 days overdue
+    - $1.00/day for each additional day after 7 days
+    - Maximum $15.00 per book
+
+    Args:
+        due_date: when the loan was due
+        as_of: the moment to calculate the fee for (e.g. now, or the return date)
+
+    Returns:
+        dict: {'fee_amount': float, 'days_overdue': int, 'status': str}
+    """
+    days_overdue = (as_of - due_date).days
+    if days_overdue <= 0:
+        return {'fee_amount': 0.0, 'days_overdue': 0, 'status': "Not overdue"}
+
+    late_fee = min(days_overdue, 7) * 0.5 + max(days_overdue - 7, 0) * 1.0
+    return {'fee_amount': min(late_fee, 15.0), 'days_overdue': days_overdue, 'status': "Overdue"}
 
 def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
     """
@@ -186,30 +241,20 @@ def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
     # Extract dates from borrow_record
     due_date = borrow_record.get("due_date")
 
-    days_overdue = (datetime.today() - due_date).days
-    late_fee = 0.0
-
-    # Calculate late fee
-    if days_overdue <= 0:
-        days_overdue = 0
-        status = "Not overdue"
-    elif days_overdue >= 7:
-        # $0.50/day for first 7 days, then $1.00/day after, max $15.00
-        late_fee = 7 * 0.5 + (days_overdue - 7) * 1.0
-        late_fee = min(late_fee, 15.0)
-        status = "Overdue"
-
-    return {'fee_amount': late_fee, 'days_overdue': days_overdue, 'status': status}
+    return compute_late_fee(due_date, datetime.today())
 
-def search_books_in_catalog(search_term: str, search_type: str) -> List[Dict]:
+def search_books_in_catalog(search_term: str, search_type: str, limit: int = SEARCH_RESULT_LIMIT) -> List[Dict]:
     """
     Search for books in the catalog.
     
     Implements R6 as per requirements
 
     Args:
-        search_term: search term
+        search_term: search term; for ISBN searches, one or more comma-separated ISBNs
+            (hyphens, spaces and ISBN-10 are accepted)
         search_type: search type
+        limit: maximum number of title/author matches to return (at most SEARCH_RESULT_LIMIT),
+            best matches first
         
     Returns:
         list: list of books
@@ -222,17 +267,116 @@ def search_books_in_catalog(search_term: str, search_type: str) -> List[Dict]:
     search_term = search_term.lower()
 
     # Search for books
-    books = get_all_books()
-    result = []
     if search_type == 'isbn':
-        for book in books:
-            if search_term == book['isbn']:
-                result.append(book)
-        return result
-    for book in books:
-        if search_term in book[search_type].lower():
-            result.append(book)
-    return result
+        # Comma-separated ISBNs are looked up together (e.g. from a barcode scanner)
+        isbns = [normalize_isbn(isbn) for isbn in search_term.split(',') if isbn.strip()]
+        return get_books_by_isbns(isbns)
+    limit = max(1, min(limit, SEARCH_RESULT_LIMIT))
+    return search_books(search_term, search_type, limit)
+
+def normalize_isbn(isbn: str) -> str:
+    """
+    Normalize an ISBN for lookup.
+
+    Removes hyphens and spaces and converts a valid ISBN-10 to its ISBN-13 form.
+    Anything else is returned cleaned but otherwise unchanged.
+
+    Args:
+        isbn: ISBN as typed or scanned, e.g. "0-7432-7356-7"
+
+    Returns:
+        str: normalized ISBN, e.g. "9780743273565"
+    """
+    cleaned = isbn.replace('-', '').replace(' ', '').strip().upper()
+    if len(cleaned) != 10 or not cleaned[:9].isdigit() or not (cleaned[9].isdigit() or cleaned[9] == 'X'):
+        return cleaned
+
+    # ISBN-10 check digit: weighted sum with weights 10..1 must be divisible by 11 (X = 10)
+    digits = [int(digit) for digit in cleaned[:9]] + [10 if cleaned[9] == 'X' else int(cleaned[9])]
+    if sum(digit * weight for digit, weight in zip(digits, range(10, 0, -1))) % 11 != 0:
+        return cleaned
+
+    # ISBN-13: "978" prefix, then a check digit from alternating weights 1 and 3
+    isbn13 = '978' + cleaned[:9]
+    total = sum(int(digit) * (1 if position % 2 == 0 else 3) for position, digit in enumerate(isbn13))
+    return isbn13 + str((10 - total % 10) % 10)
+
+def encode_cursor(key: Tuple) -> str:
+    """Encode a pagination key as an opaque, URL-safe cursor string."""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str, key_type: type = str) -> Tuple:
+    """
+    Decode a cursor produced by encode_cursor.
+
+    Args:
+        cursor: the cursor string
+        key_type: expected type of the sort key (the second element is always an int ID)
+
+    Raises:
+        ValueError: if the cursor is malformed
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid page cursor.") from e
+    if not (isinstance(key, list) and len(key) == 2 and isinstance(key[0], key_type) and isinstance(key[1], int)):
+        raise ValueError("Invalid page cursor.")
+    return key[0], key[1]
+
+def get_catalog_page(cursor: Optional[str] = None, page_size: int = DEFAULT_PAGE_SIZE) -> Dict:
+    """
+    Get one page of the catalog ordered by title.
+    
+    Implements R2 for large catalogs
+
+    Args:
+        cursor: `next_cursor` from the previous page, or None for the first page
+        page_size: number of books per page (clamped to 1..MAX_PAGE_SIZE)
+
+    Returns:
+        dict: {'books': list of books, 'next_cursor': str or None}
+
+    Raises:
+        ValueError: if the cursor is malformed
+    """
+    after = decode_cursor(cursor) if cursor else None
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    books, next_key = get_books_page(after, page_size)
+    return {'books': books, 'next_cursor': encode_cursor(next_key) if next_key else None}
+
+def get_catalog_cursor_at(book: Mapping) -> str:
+    """A get_catalog_page cursor whose page starts with the given book (e.g. one that was just added)."""
+    return encode_cursor((book['title'], book['id'] - 1))
+
+def get_patron_history_page(patron_id: str, cursor: Optional[str] = None, page_size: int = DEFAULT_PAGE_SIZE) -> Optional[Dict]:
+    """
+    Get one page of a patron's borrowing history ordered by borrow date.
+
+    Args:
+        patron_id: 6-digit library card ID
+        cursor: `next_cursor` from the previous page, or None for the first page
+        page_size: number of records per page (clamped to 1..MAX_PAGE_SIZE)
+
+    Returns:
+        dict: {'patron_id': str, 'borrowing_history': list of records, 'next_cursor': str or None}
+            Returns None for invalid patron ID input (must be exactly 6 digits).
+
+    Raises:
+        ValueError: if the cursor is malformed
+    """
+    # Validate patron ID
+    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+        return None
+
+    after = decode_cursor(cursor, int) if cursor else None
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    history, next_key = get_patron_borrowing_history_page(patron_id, after, page_size)
+    return {
+        'patron_id': patron_id,
+        'borrowing_history': history,
+        'next_cursor': encode_cursor(next_key) if next_key else None
+    }
 
 def get_patron_status_report(patron_id: str) -> Dict:
     """
@@ -247,35 +391,43 @@ def get_patron_status_report(patron_id: str) -> Dict:
         dict: 
             Dictionary representing the patron status report:
                 - 'patron_id' (str): Patron's 6-digit library card ID
-                - 'currently_borrowed_books' (list of dict): List of currently borrowed books with fields:
+                - 'currently_borrowed_books' (list of Loan): List of currently borrowed books with fields:
                     - 'book_id' (int)
                     - 'title' (str)
-                    - 'borrow_date' (str)
-                    - 'due_date' (str)
-                    - 'return_date' (str or None)
+                    - 'author' (str)
+                    - 'borrow_date' (datetime)
+                    - 'due_date' (datetime)
+                    - 'return_date' (datetime or None)
+                    - 'is_overdue' (bool)
                 - 'total_late_fees_owed' (float): Total amount of late fees currently owed by the patron
-                - 'borrowing_history' (list of dict): Complete borrowing history records (same fields as above)
+                - 'borrowing_history' (list of Loan): Complete borrowing history records (same fields as above)
+                - 'last_activity' (datetime): Most recent borrow or return by the patron
             Returns None for invalid patron ID input (must be exactly 6 digits).
     """
     # Validate patron ID
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
         return None
     
-    # Get patron's currently borrowed books
-    currently_borrowed_books = get_patron_borrowed_books(patron_id) # also contains borrow history
+    # The patrons summary row says whether there is anything to report without touching borrow_records
+    summary = get_patron_summary(patron_id)
+    if not summary or summary['open_loans'] == 0:
+        return None
 
-    # Get patron's late fees
-    late_fees = 0.0
-    for book in currently_borrowed_books:
-        result = calculate_late_fee_for_book(patron_id, book['book_id'])
-        late_fee = result['fee_amount']
-        status = result['status']
-        if status == "Overdue":
-            late_fees += late_fee
-    
-    # Get patron's borrowing history
+    # Load the patron's whole history once; current loans are the unreturned records
     borrowing_history = get_patron_borrowing_history(patron_id)
 
+    # Derive currently borrowed books and late fees in one pass; the loan records are shared, not copied
+    now = datetime.now()
+    currently_borrowed_books = []
+    late_fees = 0.0
+    for loan in borrowing_history:
+        if loan.return_date is not None:
+            continue
+        currently_borrowed_books.append(loan)
+        result = compute_late_fee(loan.due_date, now)
+        if result['status'] == "Overdue":
+            late_fees += result['fee_amount']
+
     if not currently_borrowed_books or not borrowing_history:
         return None
 
@@ -283,20 +435,91 @@ def get_patron_status_report(patron_id: str) -> Dict:
         'patron_id': patron_id,
         'currently_borrowed_books': currently_borrowed_books,
         'total_late_fees_owed': late_fees,
-        'borrowing_history': borrowing_history
+        'borrowing_history': borrowing_history,
+        'last_activity': summary['last_activity']
     }
 
-def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway = None) -> Tuple[bool, str, Optional[str]]:
+def calculate_late_fees_for_patrons(patron_ids: Union[List[str], str]) -> Iterator[Dict]:
+    """
+    Calculate late fees for many patrons at once.
+
+    Overdue loans for all requested patrons are read with one query and run
+    through the fee schedule in a single pass, so summaries can be streamed as
+    they are produced.
+
+    Args:
+        patron_ids: list of 6-digit library card IDs, or "all" for every patron with overdue loans
+
+    Returns:
+        iterator of dict, one per patron in patron ID order:
+            - 'patron_id' (str)
+            - 'total_late_fees_owed' (float)
+            - 'overdue_books' (list of dict): 'loan_id', 'book_id', 'title', 'due_date', 'days_overdue', 'fee_amount'
+            Requested patrons without overdue loans are included with no fees.
+
+    Raises:
+        ValueError: if a patron ID is not exactly 6 digits
+    """
+    if patron_ids == "all":
+        return _late_fee_summaries(None)
+
+    for patron_id in patron_ids:
+        if not isinstance(patron_id, str) or not patron_id.isdigit() or len(patron_id) != 6:
+            raise ValueError(f"Invalid patron ID: {patron_id!r}. Must be exactly 6 digits.")
+    return _late_fee_summaries(sorted(set(patron_ids)))
+
+def _late_fee_summaries(patron_ids: Optional[List[str]]) -> Iterator[Dict]:
+    """Group the streamed overdue loans by patron and total their fees."""
+    now = datetime.now()
+    remaining = iter(patron_ids or [])
+    next_requested = next(remaining, None)
+
+    for patron_id, loans in groupby(iter_overdue_loans(now, patron_ids), key=lambda loan: loan['patron_id']):
+        # Requested patrons that sort before this one have nothing overdue
+        while next_requested is not None and next_requested < patron_id:
+            yield {'patron_id': next_requested, 'total_late_fees_owed': 0.0, 'overdue_books': []}
+            next_requested = next(remaining, None)
+        if next_requested == patron_id:
+            next_requested = next(remaining, None)
+
+        overdue_books = []
+        late_fees = 0.0
+        for loan in loans:
+            result = compute_late_fee(loan['due_date'], now)
+            if result['status'] != "Overdue":
+                continue
+            overdue_books.append({
+                'loan_id': loan['loan_id'],
+                'book_id': loan['book_id'],
+                'title': loan['title'],
+                'due_date': loan['due_date'],
+                'days_overdue': result['days_overdue'],
+                'fee_amount': result['fee_amount']
+            })
+            late_fees += result['fee_amount']
+        if overdue_books or patron_ids is not None:
+            yield {'patron_id': patron_id, 'total_late_fees_owed': late_fees, 'overdue_books': overdue_books}
+
+    while next_requested is not None:
+        yield {'patron_id': next_requested, 'total_late_fees_owed': 0.0, 'overdue_books': []}
+        next_requested = next(remaining, None)
+
+def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway = None,
+                  idempotency_key: Optional[str] = None) -> Tuple[bool, str, Optional[str]]:
     """
     Process payment for late fees using external payment gateway.
     
     NEW FEATURE FOR ASSIGNMENT 3: Demonstrates need for mocking/stubbing
     This function depends on an external payment service that should be mocked in tests.
     
+    Every charge is recorded in the payments ledger. Calling again with the
+    same idempotency key returns the recorded result without charging again.
+    
     Args:
         patron_id: 6-digit library card ID
         book_id: ID of the book with late fees
         payment_gateway: Payment gateway instance (injectable for testing)
+        idempotency_key: client-chosen key identifying this payment, so retries are safe
         
     Returns:
         tuple: (success: bool, message: str, transaction_id: Optional[str])
@@ -307,47 +530,370 @@ def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway
         mock_gateway.process_payment.return_value = (True, "txn_123", "Success")
         success, msg, txn = pay_late_fees("123456", 1, mock_gateway)
     """
+    # Use provided gateway or the shared one
+    if payment_gateway is None:
+        payment_gateway = get_payment_gateway()
+    
+    replay = _replay_payment(idempotency_key, patron_id, book_id, payment_gateway)
+    if replay:
+        return _replayed_result(replay, patron_id, book_id)
+    
+    error, fee_amount, book = _prepare_late_fee_payment(patron_id, book_id)
+    if error:
+        return False, error, None
+    
+    payment_id, fee_amount, replay = _begin_book_payment(idempotency_key, patron_id, book_id, fee_amount)
+    if replay:
+        return replay
+    
+    # Process payment through external gateway
+    # THIS IS WHAT YOU SHOULD MOCK IN THEIR TESTS!
+    try:
+        success, transaction_id, message = payment_gateway.process_payment(
+            patron_id=patron_id,
+            amount=fee_amount,
+            description=f"Late fees for '{book['title']}'",
+            **_gateway_key(idempotency_key)
+        )
+    except Exception as e:
+        # Handle payment gateway errors
+        return _record_payment_error(payment_id, e)
+    return _record_payment(payment_id, _payment_result(success, transaction_id, message))
+
+
+async def pay_late_fees_async(patron_id: str, book_id: int, payment_gateway: AsyncPaymentGateway = None,
+                              idempotency_key: Optional[str] = None) -> Tuple[bool, str, Optional[str]]:
+    """
+    Async counterpart of pay_late_fees, for use with AsyncPaymentGateway.
+    
+    Validation and results are the same as pay_late_fees; only the gateway
+    call is awaited, so an event loop can have many payments in flight.
+    
+    Args:
+        patron_id: 6-digit library card ID
+        book_id: ID of the book with late fees
+        payment_gateway: Async payment gateway instance (injectable for testing)
+        idempotency_key: client-chosen key identifying this payment, so retries are safe
+        
+    Returns:
+        tuple: (success: bool, message: str, transaction_id: Optional[str])
+    """
+    if payment_gateway is None:
+        payment_gateway = AsyncPaymentGateway()
+    
+    replay = _replay_payment(idempotency_key, patron_id, book_id)
+    if replay and replay['status'] == 'unknown' and not _payment_differs(replay, patron_id, book_id):
+        try:
+            status = await payment_gateway.verify_payment_status(idempotency_key=idempotency_key)
+        except Exception:
+            status = {}
+        replay = _settle_payment(replay, status)
+    if replay and (replay['status'] != 'error' or _payment_differs(replay, patron_id, book_id)):
+        return _replayed_result(replay, patron_id, book_id)
+    
+    error, fee_amount, book = _prepare_late_fee_payment(patron_id, book_id)
+    if error:
+        return False, error, None
+    
+    payment_id, fee_amount, replay = _begin_book_payment(idempotency_key, patron_id, book_id, fee_amount)
+    if replay:
+        return replay
+    
+    try:
+        success, transaction_id, message = await payment_gateway.process_payment(
+            patron_id=patron_id,
+            amount=fee_amount,
+            description=f"Late fees for '{book['title']}'",
+            **_gateway_key(idempotency_key)
+        )
+    except Exception as e:
+        return _record_payment_error(payment_id, e)
+    return _record_payment(payment_id, _payment_result(success, transaction_id, message))
+
+
+def _prepare_late_fee_payment(patron_id: str, book_id: int) -> Tuple[Optional[str], float, Optional[Dict]]:
+    """
+    Check that a late fee payment can be made and look up what to charge.
+    
+    Returns:
+        tuple: (error message or None, fee amount, book)
+    """
     # Validate patron ID
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
-        return False, "Invalid patron ID. Must be exactly 6 digits.", None
+        return "Invalid patron ID. Must be exactly 6 digits.", 0.0, None
     
     # Calculate late fee first
     fee_info = calculate_late_fee_for_book(patron_id, book_id)
     
     # Check if there's a fee to pay
     if not fee_info or 'fee_amount' not in fee_info:
-        return False, "Unable to calculate late fees.", None
+        return "Unable to calculate late fees.", 0.0, None
     
     fee_amount = fee_info.get('fee_amount', 0.0)
     if fee_amount <= 0:
-        return False, "No late fees to pay for this book.", None
+        return "No late fees to pay for this book.", 0.0, None
     
     # Get book details for payment description
     book = get_book_by_id(book_id)
     if not book:
-        return False, "Book not found.", None
+        return "Book not found.", 0.0, None
     
-    # Use provided gateway or create new one
+    return None, fee_amount, book
+
+
+def _begin_book_payment(idempotency_key: Optional[str], patron_id: str, book_id: int,
+                        fee_amount: float) -> Tuple[Optional[int], float, Optional[Tuple[bool, str, Optional[str]]]]:
+    """
+    Open the ledger entry for a single-book charge, reserving the loan's fee the way pay_all_late_fees does.
+    
+    Fees already paid or being paid for the loan (book by book or all at once)
+    are subtracted, so the two kinds of payment never charge the same fee twice.
+    
+    Returns:
+        tuple: (ledger id, amount to charge, None) if the charge may go ahead, or
+            (None, 0.0, result) with the (success, message, transaction_id) to return instead
+    """
+    loan_id = get_open_loan_id(patron_id, book_id)
+    if loan_id is None:
+        # No open loan to reserve the fee against
+        payment_id, replay = begin_payment(idempotency_key, patron_id, book_id, fee_amount)
+        if replay:
+            return None, 0.0, _replayed_result(replay, patron_id, book_id, fee_amount)
+        return payment_id, fee_amount, None
+    
+    payment_id, allocations, replay = reserve_late_fee_payment(
+        idempotency_key, patron_id, [{'loan_id': loan_id, 'book_id': book_id, 'amount': fee_amount}], book_id)
+    if payment_id is not None:
+        return payment_id, allocations[0]['amount'], None
+    if replay is None:
+        return None, 0.0, (False, "The late fees for this book have already been paid.", None)
+    if idempotency_key and replay['idempotency_key'] == idempotency_key:
+        return None, 0.0, _replayed_result(replay, patron_id, book_id)
+    return None, 0.0, (False, "This payment is already in progress.", None)
+
+
+def _payment_result(success: bool, transaction_id: str, message: str) -> Tuple[bool, str, Optional[str]]:
+    """Turn a gateway charge response into the (success, message, transaction_id) returned to callers."""
+    if success:
+        return True, f"Payment successful! {message}", transaction_id
+    return False, f"Payment failed: {message}", None
+
+
+def _replay_payment(idempotency_key: Optional[str], patron_id: str, book_id: Optional[int],
+                    payment_gateway: PaymentGateway = None) -> Optional[Dict]:
+    """
+    The ledger entry to answer with for a repeated idempotency key, or None if the charge should go ahead.
+    
+    A charge whose outcome is unknown is first looked up with the gateway
+    (when one is given), so it is only made again if the gateway never received it.
+    An entry for another patron or book is returned whatever its status, so the
+    request is rejected rather than answered with someone else's payment.
+    """
+    if not idempotency_key:
+        return None
+    payment = get_payment_by_key(idempotency_key)
+    if payment and _payment_differs(payment, patron_id, book_id):
+        return payment
+    if payment_gateway is not None:
+        payment = settle_payment(idempotency_key, payment_gateway)
+    # A charge that never reached the gateway may be retried with the same key
+    return payment if payment and payment['status'] != 'error' else None
+
+
+def idempotency_key_conflicts(idempotency_key: Optional[str], patron_id: str, book_id: Optional[int] = None) -> bool:
+    """
+    Whether an idempotency key is already in the ledger for a different payment.
+    
+    Args:
+        idempotency_key: the client's key, or None
+        patron_id: patron the new request is for
+        book_id: book the new request is for, or None for all of the patron's late fees
+        
+    Returns:
+        bool: True if the key was used by another patron or for another book
+    """
+    payment = get_payment_by_key(idempotency_key) if idempotency_key else None
+    return payment is not None and _payment_differs(payment, patron_id, book_id)
+
+
+def _payment_differs(payment: Dict, patron_id: str, book_id: Optional[int], amount: Optional[float] = None) -> bool:
+    """Whether a ledger entry is for another patron, book or (when given) amount than a request."""
+    return (payment['patron_id'] != patron_id or payment['book_id'] != book_id or
+            (amount is not None and round(payment['amount'], 2) != round(amount, 2)))
+
+
+def settle_payment(idempotency_key: str, payment_gateway: PaymentGateway = None) -> Optional[Dict]:
+    """
+    Look up a charge whose outcome is unknown with the gateway and record the answer.
+    
+    Args:
+        idempotency_key: the charge's idempotency key
+        payment_gateway: Payment gateway instance (default: the shared one)
+        
+    Returns:
+        dict: the ledger entry, settled if it was unknown and the gateway could answer; None if there is none
+    """
+    payment = get_payment_by_key(idempotency_key)
+    if not payment or payment['status'] != 'unknown':
+        return payment
     if payment_gateway is None:
-        payment_gateway = PaymentGateway()
+        payment_gateway = get_payment_gateway()
+    try:
+        status = payment_gateway.verify_payment_status(idempotency_key=idempotency_key)
+    except Exception:
+        status = {}
+    return _settle_payment(payment, status)
+
+
+def _settle_payment(payment: Dict, status: Dict) -> Dict:
+    """
+    Record what the gateway reports for a charge whose outcome was unknown.
+    
+    Args:
+        payment: the ledger entry, with status 'unknown'
+        status: verify_payment_status's answer for the charge's idempotency key ({} if it could not be asked)
+        
+    Returns:
+        dict: the updated ledger entry ('completed', 'failed', 'error' if the gateway
+            never received the charge, or still 'unknown')
+    """
+    if status.get('status') == 'completed':
+        message = f"Payment successful! Payment of ${payment['amount']:.2f} processed successfully"
+        finish_payment(payment['id'], 'completed', status.get('transaction_id'), message)
+    elif status.get('status') == 'failed':
+        finish_payment(payment['id'], 'failed', None, f"Payment failed: {status.get('message', '')}")
+    elif status.get('status') == 'not_found':
+        finish_payment(payment['id'], 'error', None, "Payment processing error: the gateway did not receive the payment.")
+    else:
+        return payment
+    return get_payment_by_key(payment['idempotency_key'])
+
+
+def _replayed_result(payment: Dict, patron_id: str, book_id: Optional[int],
+                     amount: Optional[float] = None) -> Tuple[bool, str, Optional[str]]:
+    """The (success, message, transaction_id) originally returned for a ledger entry of this request."""
+    if _payment_differs(payment, patron_id, book_id, amount):
+        return False, IDEMPOTENCY_KEY_REUSED, None
+    if payment['status'] == 'pending':
+        return False, "This payment is already in progress.", None
+    if payment['status'] == 'unknown':
+        return False, ("The outcome of an earlier attempt at this payment is not known yet, "
+                       "so it has not been charged again. Try again later."), None
+    success = payment['status'] in PAYMENT_SUCCEEDED_STATUSES
+    return success, payment['message'], payment['transaction_id'] if success else None
+
+
+def _gateway_key(idempotency_key: Optional[str]) -> Dict:
+    """process_payment's keyword for the ledger's idempotency key, so the gateway also applies the charge once."""
+    return {'idempotency_key': idempotency_key} if idempotency_key else {}
+
+
+def _record_payment(payment_id: int, result: Tuple[bool, str, Optional[str]],
+                    status: Optional[str] = None) -> Tuple[bool, str, Optional[str]]:
+    """
+    Store a charge's result in its ledger entry and return it.
+    
+    The gateway has already answered, so a ledger write that fails does not
+    change the result; it is logged with the transaction ID for reconciliation.
+    """
+    success, message, transaction_id = result
+    status = status or ('completed' if success else 'failed')
+    if not finish_payment(payment_id, status, transaction_id, message):
+        logger.error("Payment %s was %s by the gateway (transaction %s) but could not be recorded; "
+                     "its ledger entry is still pending", payment_id, status, transaction_id)
+    return result
+
+
+def _record_payment_error(payment_id: int, error: Exception) -> Tuple[bool, str, None]:
+    """
+    Record a charge that raised in its ledger entry and return the error result.
+    
+    If the charge may still have been applied (e.g. it timed out), the entry is
+    marked 'unknown' and is looked up with the gateway before any retry;
+    otherwise it is marked 'error' and the same key may be charged again.
+    """
+    if charge_outcome_unknown(error):
+        message = (f"Payment processing error: {str(error)}. The payment may still have gone through; "
+                   "it will not be charged again until the gateway confirms its outcome.")
+        return _record_payment(payment_id, (False, message, None), 'unknown')
+    return _record_payment(payment_id, (False, f"Payment processing error: {str(error)}", None), 'error')
+
+
+def pay_all_late_fees(patron_id: str, payment_gateway: PaymentGateway = None,
+                      idempotency_key: Optional[str] = None) -> Tuple[bool, str, Optional[Dict]]:
+    """
+    Pay all of a patron's outstanding late fees with a single gateway charge.
+    
+    Fees for every overdue loan are calculated in one pass, and the total is
+    charged with one process_payment call. Before the gateway is called, the
+    amounts still owed on each loan (less anything already paid, or reserved by
+    another payment in progress) are reserved in payment_allocations together
+    with the charge's entry in the payments ledger, so concurrent submissions
+    cannot charge the same fees twice. The reservations become the recorded
+    split of the transaction when it succeeds and are released when it fails;
+    calling again with the same idempotency key returns the recorded payment.
+    
+    Args:
+        patron_id: 6-digit library card ID
+        payment_gateway: Payment gateway instance (injectable for testing)
+        idempotency_key: client-chosen key identifying this payment, so retries are safe
+        
+    Returns:
+        tuple: (success: bool, message: str, payment: Optional[dict]) where payment has
+            'transaction_id', 'amount' and 'allocations' (list of dict with
+            'loan_id', 'book_id', 'title', 'amount')
+    """
+    if payment_gateway is None:
+        payment_gateway = get_payment_gateway()
+    
+    replay = _replay_payment(idempotency_key, patron_id, None, payment_gateway)
+    if replay:
+        return _replayed_payment(replay, patron_id)
+    
+    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+        return False, "Invalid patron ID. Must be exactly 6 digits.", None
+    
+    summary = next(calculate_late_fees_for_patrons([patron_id]))
+    titles = {book['loan_id']: book['title'] for book in summary['overdue_books']}
+    payment_id, allocations, replay = reserve_late_fee_payment(idempotency_key, patron_id, [
+        {'loan_id': book['loan_id'], 'book_id': book['book_id'], 'amount': book['fee_amount']}
+        for book in summary['overdue_books']
+    ])
+    if replay:
+        if idempotency_key and replay['idempotency_key'] == idempotency_key:
+            return _replayed_payment(replay, patron_id)
+        return False, "This payment is already in progress.", None
+    if payment_id is None:
+        return False, "No late fees to pay.", None
+    for allocation in allocations:
+        allocation['title'] = titles[allocation['loan_id']]
+    total = round(sum(allocation['amount'] for allocation in allocations), 2)
     
-    # Process payment through external gateway
-    # THIS IS WHAT YOU SHOULD MOCK IN THEIR TESTS!
     try:
         success, transaction_id, message = payment_gateway.process_payment(
             patron_id=patron_id,
-            amount=fee_amount,
-            description=f"Late fees for '{book['title']}'"
+            amount=total,
+            description=f"Late fees for {len(allocations)} overdue book(s)",
+            **_gateway_key(idempotency_key)
         )
-        
-        if success:
-            return True, f"Payment successful! {message}", transaction_id
-        else:
-            return False, f"Payment failed: {message}", None
-            
     except Exception as e:
-        # Handle payment gateway errors
-        return False, f"Payment processing error: {str(e)}", None
+        return _record_payment_error(payment_id, e)
+    if not success:
+        _record_payment(payment_id, (False, f"Payment failed: {message}", None))
+        return False, f"Payment failed: {message}", None
+    
+    message = f"Payment successful! {message}"
+    _record_payment(payment_id, (True, message, transaction_id))
+    return True, message, {'transaction_id': transaction_id, 'amount': total, 'allocations': allocations}
+
+
+def _replayed_payment(payment: Dict, patron_id: str) -> Tuple[bool, str, Optional[Dict]]:
+    """The (success, message, payment) originally returned by pay_all_late_fees for a ledger entry."""
+    success, message, transaction_id = _replayed_result(payment, patron_id, None)
+    if not success:
+        return False, message, None
+    return True, message, {'transaction_id': transaction_id, 'amount': payment['amount'],
+                           'allocations': get_payment_allocations(transaction_id)}
 
 
 def refund_late_fee_payment(transaction_id: str, amount: float, payment_gateway: PaymentGateway = None) -> Tuple[bool, str]:
@@ -363,30 +909,181 @@ def refund_late_fee_payment(transaction_id: str, amount: float, payment_gateway:
         
     Returns:
         tuple: (success: bool, message: str)
-    """
-    # Validate inputs
-    if not transaction_id or not transaction_id.startswith("txn_"):
-        return False, "Invalid transaction ID."
     
-    if amount <= 0:
-        return False, "Refund amount must be greater than 0."
-    
-    if amount > 15.00:  # Maximum late fee per book
-        return False, "Refund amount exceeds maximum late fee."
+    A refund whose gateway call timed out may still have been made, so it is
+    held as pending in the ledger (see charge_outcome_unknown). The next refund
+    of the same payment first asks the gateway whether it went through, and is
+    only sent if it did not.
+    """
+    error = _check_refund(transaction_id, amount)
+    if error:
+        return False, error
     
-    # Use provided gateway or create new one
+    # Use provided gateway or the shared one
     if payment_gateway is None:
-        payment_gateway = PaymentGateway()
+        payment_gateway = get_payment_gateway()
+    
+    payment = get_payment_by_transaction(transaction_id)
+    if payment and payment['pending_refund']:
+        try:
+            status = payment_gateway.verify_payment_status(transaction_id)
+        except Exception:
+            status = {}
+        result = _settle_pending_refund(payment, status)
+        if result:
+            return result
     
     # Process refund through external gateway
     # THIS IS WHAT YOU SHOULD MOCK IN YOUR TESTS!
     try:
         success, message = payment_gateway.refund_payment(transaction_id, amount)
+    except Exception as e:
+        return _refund_error(transaction_id, amount, e)
+    if success:
+        record_payment_refund(transaction_id, amount)
+    return _refund_result(success, message)
+
+
+async def refund_late_fee_payment_async(transaction_id: str, amount: float,
+                                        payment_gateway: AsyncPaymentGateway = None) -> Tuple[bool, str]:
+    """
+    Async counterpart of refund_late_fee_payment, for use with AsyncPaymentGateway.
+    
+    Args:
+        transaction_id: Original transaction ID to refund
+        amount: Amount to refund
+        payment_gateway: Async payment gateway instance (injectable for testing)
         
-        if success:
-            return True, message
-        else:
-            return False, f"Refund failed: {message}"
-            
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    error = _check_refund(transaction_id, amount)
+    if error:
+        return False, error
+    
+    if payment_gateway is None:
+        payment_gateway = AsyncPaymentGateway()
+    
+    payment = get_payment_by_transaction(transaction_id)
+    if payment and payment['pending_refund']:
+        try:
+            status = await payment_gateway.verify_payment_status(transaction_id)
+        except Exception:
+            status = {}
+        result = _settle_pending_refund(payment, status)
+        if result:
+            return result
+    
+    try:
+        success, message = await payment_gateway.refund_payment(transaction_id, amount)
     except Exception as e:
-        return False, f"Refund processing error: {str(e)}"
\ No newline at end of file
+        return _refund_error(transaction_id, amount, e)
+    if success:
+        record_payment_refund(transaction_id, amount)
+    return _refund_result(success, message)
+
+
+def _check_refund(transaction_id: str, amount: float) -> Optional[str]:
+    """Validate a refund request, returning an error message or None."""
+    if not transaction_id or not transaction_id.startswith("txn_"):
+        return "Invalid transaction ID."
+    
+    if amount <= 0:
+        return "Refund amount must be greater than 0."
+    
+    if amount > 15.00:  # Maximum late fee per book
+        return "Refund amount exceeds maximum late fee."
+    
+    return None
+
+
+def _refund_error(transaction_id: str, amount: float, error: Exception) -> Tuple[bool, str]:
+    """The result of a refund call that raised; one that may have gone through is held as pending."""
+    if not charge_outcome_unknown(error):
+        return False, f"Refund processing error: {str(error)}"
+    record_pending_refund(transaction_id, amount)
+    return False, (f"Refund processing error: {str(error)}. The refund may still have been made, so it is "
+                   "held as pending until the gateway confirms it; it will not be sent again before then.")
+
+
+def _settle_pending_refund(payment: Dict, status: Dict) -> Optional[Tuple[bool, str]]:
+    """
+    Record what the gateway reports for a charge with a refund of unknown outcome.
+    
+    The gateway reports a charge as refunded once any refund of it went
+    through, so this only tells the pending refund apart when no earlier
+    refund of the charge was recorded.
+    
+    Args:
+        payment: the ledger entry, with a pending refund
+        status: verify_payment_status's answer for the charge ({} if it could not be asked)
+        
+    Returns:
+        tuple: (success, message) if the pending refund went through or is still unknown;
+            None if it did not go through and the refund may be sent
+    """
+    if status.get('status') == 'refunded' and not payment['refunded_amount']:
+        settle_pending_refund(payment['transaction_id'], True)
+        return True, "The earlier refund of this payment went through; it was not sent again."
+    if status.get('status') == 'completed':
+        settle_pending_refund(payment['transaction_id'], False)
+        return None
+    return False, ("The outcome of an earlier refund of this payment is not known yet, "
+                   "so it has not been refunded again. Try again later.")
+
+
+def _refund_result(success: bool, message: str) -> Tuple[bool, str]:
+    """Turn a gateway refund response into the (success, message) returned to callers."""
+    if success:
+        return True, message
+    return False, f"Refund failed: {message}"
+
+
+def get_payment_status(transaction_id: str, payment_gateway: PaymentGateway = None) -> Dict:
+    """
+    Check the status of a late fee payment.
+    
+    Payments in the ledger with a final status ('completed', 'failed' or
+    'refunded') are answered locally. Only payments the ledger does not know
+    the outcome of, or with a refund whose outcome is unknown, are checked
+    with the gateway, and the ledger is updated with what it reports.
+    
+    Args:
+        transaction_id: Transaction ID to check
+        payment_gateway: Payment gateway instance (injectable for testing)
+        
+    Returns:
+        dict: 'transaction_id', 'status' and 'source' ('ledger' or 'gateway'), plus
+            'patron_id', 'book_id', 'amount', 'refunded_amount' and 'pending_refund' for payments in the ledger
+    """
+    payment = get_payment_by_transaction(transaction_id)
+    if payment and payment['status'] in PAYMENT_FINAL_STATUSES and not payment['pending_refund']:
+        return _payment_status(payment, 'ledger')
+    
+    if payment_gateway is None:
+        payment_gateway = get_payment_gateway()
+    status = payment_gateway.verify_payment_status(transaction_id)
+    if not payment:
+        return {'transaction_id': transaction_id, 'status': status.get('status', 'unknown'), 'source': 'gateway'}
+    
+    if payment['pending_refund']:
+        _settle_pending_refund(payment, status)
+        return _payment_status(get_payment_by_transaction(transaction_id), 'gateway')
+    if status.get('status') and status['status'] != payment['status']:
+        update_payment_status(transaction_id, status['status'])
+        payment['status'] = status['status']
+    return _payment_status(payment, 'gateway')
+
+
+def _payment_status(payment: Dict, source: str) -> Dict:
+    """The status report for a ledger entry."""
+    return {
+        'transaction_id': payment['transaction_id'],
+        'status': payment['status'],
+        'patron_id': payment['patron_id'],
+        'book_id': payment['book_id'],
+        'amount': payment['amount'],
+        'refunded_amount': payment['refunded_amount'],
+        'pending_refund': payment['pending_refund'],
+        'source': source
+    }
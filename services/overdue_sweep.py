@@ -0,0 +1,146 @@
+"""
+Overdue Sweep Module - Library-wide late fee calculation for the nightly job
+
+Applies the same fee schedule as `compute_late_fee` to every open loan at once.
+With NumPy installed, the integer due timestamps are loaded into one int64
+array and days overdue and fees are computed in vectorized form; without it
+the sweep falls back to calling `compute_late_fee` for each loan.
+"""
+
+import heapq
+import json
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency; the scalar fallback is used instead
+    np = None
+
+from database import from_timestamp, get_open_loan_columns, get_open_loan_count, to_timestamp
+from services.library_service import compute_late_fee
+
+MICROSECONDS_PER_DAY = 86_400_000_000
+DAYS_OVERDUE_BUCKETS = ((1, 7), (8, 14), (15, 28), (29, None))  # inclusive ranges reported in the summary
+
+def compute_late_fees(due_timestamps: Sequence[int], as_of: datetime) -> Tuple[Sequence[int], Sequence[float]]:
+    """
+    Apply the late fee schedule to many loans at once.
+
+    Matches `compute_late_fee` exactly: days overdue are whole days, rounded
+    down, and loans that are not overdue get 0 days and no fee.
+
+    Args:
+        due_timestamps: due dates as integer loan timestamps (see database.to_timestamp)
+        as_of: the moment to calculate fees for
+
+    Returns:
+        tuple: (days overdue, fee amounts), as NumPy arrays when NumPy is installed, lists otherwise
+    """
+    if np is None:
+        results = [compute_late_fee(from_timestamp(due), as_of) for due in due_timestamps]
+        return [result['days_overdue'] for result in results], [result['fee_amount'] for result in results]
+
+    elapsed = to_timestamp(as_of) - np.asarray(due_timestamps, dtype=np.int64)
+    days_overdue = np.maximum(elapsed // MICROSECONDS_PER_DAY, 0)
+    fees = np.minimum(days_overdue, 7) * 0.5 + np.maximum(days_overdue - 7, 0) * 1.0
+    return days_overdue, np.minimum(fees, 15.0)
+
+def sweep_overdue_loans(as_of: Optional[datetime] = None) -> Dict:
+    """
+    Find every overdue open loan in the library and calculate its late fee.
+
+    Args:
+        as_of: the moment to calculate fees for (default: now)
+
+    Returns:
+        dict:
+            - 'as_of' (datetime)
+            - 'open_loans' (int): number of open loans in the library
+            - 'loan_ids', 'patron_ids', 'book_ids', 'days_overdue', 'fee_amount': parallel
+              columns for the overdue loans only, ordered by borrow record id
+    """
+    as_of = as_of or datetime.now()
+    # Loans not yet due cannot owe a fee, so SQLite only returns the ones due before as_of
+    loan_ids, patron_ids, book_ids, due_timestamps = get_open_loan_columns(due_before=as_of)
+    days_overdue, fees = compute_late_fees(due_timestamps, as_of)
+
+    if np is None:
+        overdue = [i for i, days in enumerate(days_overdue) if days > 0]
+        columns = [[column[i] for i in overdue] for column in (loan_ids, patron_ids, book_ids, days_overdue, fees)]
+    else:
+        overdue = days_overdue > 0
+        columns = [np.asarray(loan_ids, dtype=np.int64)[overdue], np.asarray(patron_ids)[overdue],
+                   np.asarray(book_ids, dtype=np.int64)[overdue], days_overdue[overdue], fees[overdue]]
+
+    return {
+        'as_of': as_of,
+        'open_loans': get_open_loan_count(),
+        'loan_ids': columns[0],
+        'patron_ids': columns[1],
+        'book_ids': columns[2],
+        'days_overdue': columns[3],
+        'fee_amount': columns[4]
+    }
+
+def _totals_by_patron(patron_ids: Sequence[str], fees: Sequence[float]) -> List[Tuple[str, float, int]]:
+    """Total fees and overdue loan counts per patron, as (patron_id, total, loans) tuples."""
+    if np is None:
+        totals = {}
+        for patron_id, fee in zip(patron_ids, fees):
+            total, loans = totals.get(patron_id, (0.0, 0))
+            totals[patron_id] = (total + fee, loans + 1)
+        return [(patron_id, total, loans) for patron_id, (total, loans) in totals.items()]
+
+    patrons, inverse = np.unique(patron_ids, return_inverse=True)
+    totals = np.bincount(inverse, weights=fees, minlength=len(patrons))
+    loans = np.bincount(inverse, minlength=len(patrons))
+    return list(zip(patrons.tolist(), totals.tolist(), loans.tolist()))
+
+def _count_days_overdue(days_overdue: Sequence[int], low: int, high: Optional[int]) -> int:
+    """Count loans overdue by between `low` and `high` days inclusive (no upper bound if `high` is None)."""
+    if np is None:
+        return sum(1 for days in days_overdue if days >= low and (high is None or days <= high))
+    in_range = days_overdue >= low
+    if high is not None:
+        in_range &= days_overdue <= high
+    return int(np.count_nonzero(in_range))
+
+def summarize_sweep(sweep: Dict, top_patrons: int = 10) -> Dict:
+    """
+    Build the summary report for an overdue sweep.
+
+    Args:
+        sweep: result of `sweep_overdue_loans`
+        top_patrons: number of patrons with the highest fees to list
+
+    Returns:
+        dict: JSON-serializable summary with loan and fee totals, a breakdown of
+            days overdue, and the patrons owing the most
+    """
+    days_overdue, fees = sweep['days_overdue'], sweep['fee_amount']
+    by_patron = _totals_by_patron(sweep['patron_ids'], fees)
+    highest = heapq.nsmallest(top_patrons, by_patron, key=lambda entry: (-entry[1], entry[0]))
+
+    return {
+        'as_of': sweep['as_of'].isoformat(),
+        'open_loans': sweep['open_loans'],
+        'overdue_loans': len(fees),
+        'total_late_fees': float(sum(fees) if np is None else np.sum(fees)),
+        'loans_at_fee_cap': sum(1 for fee in fees if fee == 15.0) if np is None else int(np.count_nonzero(fees == 15.0)),
+        'patrons_with_overdue_loans': len(by_patron),
+        'days_overdue': {
+            f"{low}+" if high is None else f"{low}-{high}": _count_days_overdue(days_overdue, low, high)
+            for low, high in DAYS_OVERDUE_BUCKETS
+        },
+        'top_patrons': [
+            {'patron_id': patron_id, 'total_late_fees_owed': total, 'overdue_loans': loans}
+            for patron_id, total, loans in highest
+        ]
+    }
+
+def write_sweep_report(summary: Dict, path: str) -> None:
+    """Write a sweep summary to `path` as JSON."""
+    with open(path, 'w') as report_file:
+        json.dump(summary, report_file, indent=2)
+        report_file.write('\n')
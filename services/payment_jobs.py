@@ -0,0 +1,225 @@
+"""
+Payment Jobs Module - Background processing of late fee payments and refunds
+
+Web requests queue payment jobs in the payment_jobs table, which costs one
+local insert, and return straight away; a pool of worker threads drains the
+table and calls the payment gateway. Because jobs live in SQLite they survive
+a process restart: queued jobs are picked up again as soon as workers start,
+and a job that was running when its process died is taken over once its lease
+expires. Charges carry an idempotency key recorded in the payments ledger, so
+a job taken over like that returns the first attempt's result instead of
+charging again. Refunds have no key, so a taken-over refund job is not run
+again but set aside ('needs_review') for staff to check with the gateway. A charge that was cut off mid-call is left pending in the
+ledger; it is marked unknown and looked up with the gateway by its key,
+either when its job is taken over or by the workers' periodic reconciliation.
+
+Workers are started by the serving entry point (python app.py) or by
+`flask --app app payment-worker`, not by create_app, so command line tasks
+and test apps never run payment jobs.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+
+from database import claim_payment_job, expire_pending_payments, finish_payment_job, insert_payment_job
+from services.library_service import pay_all_late_fees, pay_late_fees, refund_late_fee_payment, settle_payment
+
+logger = logging.getLogger(__name__)
+
+JOB_LEASE_SECONDS = 120  # Longer than any gateway call including retries
+MAX_JOB_ATTEMPTS = 3  # A job interrupted this many times is failed instead of retried again
+POLL_INTERVAL = 1.0  # Seconds an idle worker waits before checking for jobs queued by other processes
+RECONCILE_INTERVAL = 60.0  # Seconds between idle workers' checks for charges left pending by a dead process
+MAX_ERROR_BACKOFF = 30.0  # Longest wait before a worker polls again after repeated errors
+
+def _pay_late_fees_job(payload: Dict) -> Dict:
+    success, message, transaction_id = pay_late_fees(payload['patron_id'], payload['book_id'],
+                                                     idempotency_key=payload['idempotency_key'])
+    return {'success': success, 'message': message, 'transaction_id': transaction_id}
+
+def _pay_all_late_fees_job(payload: Dict) -> Dict:
+    success, message, payment = pay_all_late_fees(payload['patron_id'], idempotency_key=payload['idempotency_key'])
+    return {'success': success, 'message': message, 'payment': payment}
+
+def _refund_late_fee_payment_job(payload: Dict) -> Dict:
+    success, message = refund_late_fee_payment(payload['transaction_id'], payload['amount'])
+    return {'success': success, 'message': message}
+
+# Job kinds and the service call each one runs
+JOB_HANDLERS: Dict[str, Callable[[Dict], Dict]] = {
+    'pay_late_fees': _pay_late_fees_job,
+    'pay_all_late_fees': _pay_all_late_fees_job,
+    'refund_late_fee_payment': _refund_late_fee_payment_job,
+}
+
+def enqueue_payment_job(kind: str, payload: Dict) -> Optional[int]:
+    """
+    Queue a payment job for the background workers.
+
+    Args:
+        kind: one of JOB_HANDLERS ('pay_late_fees', 'pay_all_late_fees', 'refund_late_fee_payment')
+        payload: keyword arguments for the job's service call
+
+    Returns:
+        int: the job id, or None if the job could not be stored
+
+    Raises:
+        ValueError: if `kind` is not a known job kind
+    """
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown payment job kind: {kind!r}")
+    job_id = insert_payment_job(kind, payload)
+    if job_id is not None and _workers is not None:
+        _workers.wake()
+    return job_id
+
+def run_next_payment_job() -> bool:
+    """
+    Claim and run one payment job.
+
+    Returns:
+        bool: True if a job was run, False if none was waiting
+    """
+    job = claim_payment_job(JOB_LEASE_SECONDS)
+    if job is None:
+        return False
+
+    if job['attempts'] > MAX_JOB_ATTEMPTS:
+        finish_payment_job(job['id'], 'failed', {
+            'success': False, 'message': f"Job was interrupted {MAX_JOB_ATTEMPTS} times; not retried again."})
+        return True
+
+    if job['kind'] == 'refund_late_fee_payment' and job['attempts'] > 1:
+        # Refunds carry no idempotency key, and a refund the gateway made just before
+        # its worker died may not have reached the ledger, so running it again could
+        # refund twice; staff check it with the gateway instead
+        logger.warning("Refund job %d was interrupted and needs checking with the gateway", job['id'])
+        finish_payment_job(job['id'], 'needs_review', {
+            'success': False, 'message': "Refund was interrupted and may have been sent; it needs checking before it is retried."})
+        return True
+
+    # Charges are keyed by job unless the client gave a key, so a job taken
+    # over after its worker died does not charge the patron a second time
+    job['payload'].setdefault('idempotency_key', f"payment-job-{job['id']}")
+    if job['attempts'] > 1:
+        # The previous worker's lease expired, so a charge it left pending was
+        # cut off; the service looks it up with the gateway instead of answering "in progress"
+        expire_pending_payments(datetime.now(), job['payload']['idempotency_key'])
+    try:
+        result = JOB_HANDLERS[job['kind']](job['payload'])
+    except Exception as e:
+        result = {'success': False, 'message': f"Payment job error: {str(e)}"}
+    finish_payment_job(job['id'], 'succeeded' if result['success'] else 'failed', result)
+    return True
+
+def reconcile_stale_payments(now: Optional[datetime] = None) -> int:
+    """
+    Settle ledger entries left pending by a process that died mid-charge.
+
+    Entries pending for longer than JOB_LEASE_SECONDS are marked unknown and
+    looked up with the gateway by their idempotency key; those the gateway
+    never received become retryable errors. Entries without a key cannot be
+    looked up: their fees are released and they are logged for an operator.
+
+    Args:
+        now: the current time (default: now)
+
+    Returns:
+        int: the number of entries expired
+    """
+    keys = expire_pending_payments((now or datetime.now()) - timedelta(seconds=JOB_LEASE_SECONDS))
+    for key in keys:
+        if key is not None:
+            settle_payment(key)
+    if None in keys:
+        logger.warning("%d interrupted payments without an idempotency key need checking with the gateway",
+                       keys.count(None))
+    return len(keys)
+
+class PaymentWorkerPool:
+    """Worker threads that run payment jobs until stopped."""
+
+    def __init__(self, workers: int = 4, poll_interval: float = POLL_INTERVAL,
+                 reconcile_interval: float = RECONCILE_INTERVAL):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.reconcile_interval = reconcile_interval
+        self._reconcile_lock = threading.Lock()
+        self._next_reconcile = 0.0
+        self._wakeup = threading.Condition()
+        self._pending_wakeups = 0
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"payment-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the workers once their current jobs finish."""
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def wake(self) -> None:
+        """Tell an idle worker that a job has been queued."""
+        with self._wakeup:
+            self._pending_wakeups += 1
+            self._wakeup.notify()
+
+    def _run(self) -> None:
+        failures = 0
+        while not self._stopping.is_set():
+            try:
+                if run_next_payment_job():
+                    failures = 0
+                    continue
+                self._reconcile_if_due()
+                failures = 0
+            except Exception:
+                # e.g. the database is locked; wait longer after each failure in a row
+                failures += 1
+                delay = min(self.poll_interval * 2 ** failures, MAX_ERROR_BACKOFF)
+                logger.exception("Payment worker error; retrying in %.1f s", delay)
+                self._stopping.wait(delay)
+                continue
+            with self._wakeup:
+                if not self._pending_wakeups:
+                    self._wakeup.wait(self.poll_interval)
+                self._pending_wakeups = max(self._pending_wakeups - 1, 0)
+
+    def _reconcile_if_due(self) -> None:
+        """Run reconcile_stale_payments on one idle worker every reconcile_interval seconds."""
+        with self._reconcile_lock:
+            if time.monotonic() < self._next_reconcile:
+                return
+            self._next_reconcile = time.monotonic() + self.reconcile_interval
+        reconcile_stale_payments()
+
+_workers: Optional[PaymentWorkerPool] = None
+_workers_lock = threading.Lock()
+
+def start_payment_workers(workers: int = 4) -> PaymentWorkerPool:
+    """Start this process's payment workers, if they are not running already."""
+    global _workers
+    with _workers_lock:
+        if _workers is None:
+            _workers = PaymentWorkerPool(workers)
+            _workers.start()
+        return _workers
+
+def stop_payment_workers(timeout: Optional[float] = None) -> None:
+    """Stop this process's payment workers."""
+    global _workers
+    with _workers_lock:
+        if _workers is not None:
+            _workers.stop(timeout)
+            _workers = None
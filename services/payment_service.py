@@ -1,38 +1,193 @@
 """
 Payment Service Module - External Payment Gateway Integration
-This module simulates integration with an external payment processing API.
+This module integrates with an external payment processing API, which is
+simulated unless a gateway URL is configured.
 
 For Assignment 3: You will learn to mock this service in their tests
 since we cannot make actual payment API calls during testing.
 """
 
+import asyncio
+import random
+import threading
+import uuid
 import requests
-from typing import Dict, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from services.circuit_breaker import CircuitBreaker
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Tuple
 import time
 
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}  # Gateway responses worth retrying after a backoff
+DECLINE_STATUSES = {400, 402, 409, 422}  # Gateway responses that refuse the request itself
+
+class GatewayError(requests.RequestException):
+    """
+    The gateway failed to handle a request, as opposed to declining it: it
+    answered 5xx or 429 after all retries, or rejected the client itself
+    (401, 403, 404). Nothing was charged or refunded, and the same request may
+    be made again later.
+    """
+    
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+# Simulated gateway round-trip times, in seconds
+PAYMENT_LATENCY = 0.5
+REFUND_LATENCY = 0.5
+STATUS_LATENCY = 0.3
+
+def _simulate_payment(patron_id: str, amount: float) -> Tuple[bool, str, str]:
+    """The simulated gateway's answer to a charge request."""
+    if amount <= 0:
+        return False, "", "Invalid amount: must be greater than 0"
+    
+    if amount > 1000:
+        return False, "", "Payment declined: amount exceeds limit"
+    
+    if len(patron_id) != 6:
+        return False, "", "Invalid patron ID format"
+    
+    # Simulate successful payment; the random part keeps same-second charges apart
+    transaction_id = f"txn_{patron_id}_{int(time.time())}_{uuid.uuid4().hex[:12]}"
+    return True, transaction_id, f"Payment of ${amount:.2f} processed successfully"
+
+def _simulate_refund(transaction_id: str, amount: float) -> Tuple[bool, str]:
+    """The simulated gateway's answer to a refund request."""
+    if not transaction_id or not transaction_id.startswith("txn_"):
+        return False, "Invalid transaction ID"
+    
+    if amount <= 0:
+        return False, "Invalid refund amount"
+    
+    refund_id = f"refund_{transaction_id}_{int(time.time())}"
+    return True, f"Refund of ${amount:.2f} processed successfully. Refund ID: {refund_id}"
+
+def _simulate_status(transaction_id: str) -> Dict:
+    """The simulated gateway's answer to a status request."""
+    if not transaction_id or not transaction_id.startswith("txn_"):
+        return {"status": "not_found", "message": "Transaction not found"}
+    
+    # Simulate status check
+    return {
+        "transaction_id": transaction_id,
+        "status": "completed",
+        "amount": 10.50,
+        "timestamp": time.time()
+    }
+
+def _simulate_status_by_key(charges: Dict[str, Tuple[bool, str, str]], idempotency_key: str) -> Dict:
+    """The simulated gateway's answer to a status request for the charge made with an idempotency key."""
+    if idempotency_key not in charges:
+        return {"status": "not_found", "message": "Transaction not found"}
+    success, transaction_id, message = charges[idempotency_key]
+    return {"transaction_id": transaction_id, "status": "completed" if success else "failed", "message": message}
+
+def charge_outcome_unknown(error: Exception) -> bool:
+    """
+    Whether a charge that raised `error` may still have been applied by the gateway.
+    
+    True for timeouts (including a circuit breaker's deadline) and connections
+    that broke after the request could have been sent; such a charge must be
+    looked up with verify_payment_status rather than simply made again. False
+    when the request never left (connection refused, circuit open) or the
+    gateway answered that it failed (GatewayError).
+    """
+    if isinstance(error, GatewayError):
+        return False
+    if isinstance(error, requests.ConnectionError):
+        cause = getattr(error.args[0], 'reason', None) if error.args else None
+        return not isinstance(error, requests.ConnectTimeout) and not isinstance(cause, ConnectTimeoutError)
+    return isinstance(error, (requests.Timeout, TimeoutError))
+
+def _not_found(response: requests.Response, body: Dict) -> bool:
+    """Whether the gateway answered that the transaction does not exist (rather than that the URL is wrong)."""
+    return response.status_code == 404 and body.get("status") == "not_found"
+
 
 class PaymentGateway:
     """
-    Simulates an external payment gateway API.
+    Client for an external payment gateway API.
     In production, this would connect to services like Stripe, PayPal, etc.
     
+    Without a base_url the gateway is simulated: calls sleep for a typical
+    round trip and answer locally. With a base_url, calls are made over HTTP
+    through a pooled requests.Session, so connections (and TLS sessions) are
+    kept alive and reused between calls. Every request has connect and read
+    timeouts; connection errors, timeouts and 429/5xx responses are retried
+    with jittered exponential backoff. Charges and refunds carry an
+    Idempotency-Key header that stays the same across retries, so a retried
+    charge cannot be applied twice. Callers that pass their own key (such as
+    the payments ledger's) can also look the charge up by that key later.
+    
     For testing purposes, you should MOCK this class to avoid:
     - Making actual API calls
     - Depending on external service availability
     - Incurring costs or rate limits
     """
     
-    def __init__(self, api_key: str = "test_key_12345"):
+    def __init__(self, api_key: str = "test_key_12345", base_url: Optional[str] = None,
+                 pool_size: int = 10, connect_timeout: float = 3.05, read_timeout: float = 10.0,
+                 max_retries: int = 3, backoff_base: float = 0.1, backoff_max: float = 2.0,
+                 pooled: bool = True):
         """
         Initialize payment gateway with API credentials.
         
         Args:
             api_key: API key for authentication (default is test key)
+            base_url: gateway URL to call over HTTP; None simulates the gateway
+            pool_size: most keep-alive connections kept open to the gateway
+            connect_timeout: seconds to wait for a connection to be established
+            read_timeout: seconds to wait for the gateway to respond
+            max_retries: retries after the first attempt for retryable errors
+            backoff_base: first retry waits up to this many seconds, doubling for each retry
+            backoff_max: longest wait between retries, in seconds
+            pooled: reuse connections through the session (False opens one per call)
         """
         self.api_key = api_key
-        self.base_url = "https://api.payment-gateway.example.com"
+        self.simulated = base_url is None
+        self.base_url = (base_url or "https://api.payment-gateway.example.com").rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pooled = pooled
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._simulated_charges: Dict[str, Tuple[bool, str, str]] = {}  # by idempotency key
+    
+    @property
+    def session(self) -> requests.Session:
+        """The pooled HTTP session, created on first use."""
+        with self._session_lock:
+            if self._session is None:
+                session = requests.Session()
+                # Retries are handled in _request, where the idempotency key and backoff live
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True, max_retries=0)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["Authorization"] = f"Bearer {self.api_key}"
+                self._session = session
+            return self._session
+    
+    def close(self) -> None:
+        """Close the pooled connections."""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
     
-    def process_payment(self, patron_id: str, amount: float, description: str = "") -> Tuple[bool, str, str]:
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def process_payment(self, patron_id: str, amount: float, description: str = "",
+                        idempotency_key: Optional[str] = None) -> Tuple[bool, str, str]:
         """
         Process a payment through the external gateway.
         
@@ -43,44 +198,39 @@ class PaymentGateway:
             patron_id: 6-digit patron/customer ID
             amount: Payment amount in dollars
             description: Payment description
+            idempotency_key: sent as the Idempotency-Key header; the gateway applies a key only once
             
         Returns:
-            tuple: (success: bool, transaction_id: str, message: str)
+            tuple: (success: bool, transaction_id: str, message: str); success is False
+                only when the gateway declines the charge
+            
+        Raises:
+            GatewayError: if the gateway fails to process the charge (e.g. 5xx after all retries)
+            requests.RequestException: if the gateway cannot be reached after all retries
             
         Example:
             gateway = PaymentGateway()
             success, txn_id, msg = gateway.process_payment("123456", 10.50, "Late fees")
         """
-        # Simulate API call delay
-        time.sleep(0.5)
-        
-        # In a real implementation, this would make an HTTP request:
-        # response = requests.post(
-        #     f"{self.base_url}/charges",
-        #     headers={"Authorization": f"Bearer {self.api_key}"},
-        #     json={
-        #         "customer_id": patron_id,
-        #         "amount": amount,
-        #         "currency": "usd",
-        #         "description": description
-        #     }
-        # )
-        
-        # For this template, we simulate different scenarios based on amount
-        # This allows testing without a real API
-        
-        if amount <= 0:
-            return False, "", "Invalid amount: must be greater than 0"
-        
-        if amount > 1000:
-            return False, "", "Payment declined: amount exceeds limit"
+        if self.simulated:
+            # Simulate API call delay
+            time.sleep(PAYMENT_LATENCY)
+            # For this template, we simulate different scenarios based on amount
+            # This allows testing without a real API
+            if idempotency_key is None:
+                return _simulate_payment(patron_id, amount)
+            return self._simulated_charges.setdefault(idempotency_key, _simulate_payment(patron_id, amount))
         
-        if len(patron_id) != 6:
-            return False, "", "Invalid patron ID format"
-        
-        # Simulate successful payment
-        transaction_id = f"txn_{patron_id}_{int(time.time())}"
-        return True, transaction_id, f"Payment of ${amount:.2f} processed successfully"
+        response, body = self._request("POST", "/charges", {
+            "customer_id": patron_id,
+            "amount": amount,
+            "currency": "usd",
+            "description": description
+        }, idempotency_key)
+        if response.status_code in DECLINE_STATUSES:
+            return False, "", body.get("message", f"Payment declined (HTTP {response.status_code})")
+        self._raise_for_failure(response, body)
+        return True, body["transaction_id"], body.get("message", f"Payment of ${amount:.2f} processed successfully")
     
     def refund_payment(self, transaction_id: str, amount: float) -> Tuple[bool, str]:
         """
@@ -94,20 +244,23 @@ class PaymentGateway:
             amount: Amount to refund
             
         Returns:
-            tuple: (success: bool, message: str)
+            tuple: (success: bool, message: str); success is False only when the gateway declines the refund
+            
+        Raises:
+            GatewayError: if the gateway fails to process the refund (e.g. 5xx after all retries)
+            requests.RequestException: if the gateway cannot be reached after all retries
         """
-        time.sleep(0.5)
-        
-        if not transaction_id or not transaction_id.startswith("txn_"):
-            return False, "Invalid transaction ID"
+        if self.simulated:
+            time.sleep(REFUND_LATENCY)
+            return _simulate_refund(transaction_id, amount)
         
-        if amount <= 0:
-            return False, "Invalid refund amount"
-        
-        refund_id = f"refund_{transaction_id}_{int(time.time())}"
-        return True, f"Refund of ${amount:.2f} processed successfully. Refund ID: {refund_id}"
+        response, body = self._request("POST", "/refunds", {"transaction_id": transaction_id, "amount": amount})
+        if response.status_code in DECLINE_STATUSES or _not_found(response, body):
+            return False, body.get("message", f"Refund declined (HTTP {response.status_code})")
+        self._raise_for_failure(response, body)
+        return True, body.get("message", f"Refund of ${amount:.2f} processed successfully")
     
-    def verify_payment_status(self, transaction_id: str) -> Dict:
+    def verify_payment_status(self, transaction_id: str = "", idempotency_key: Optional[str] = None) -> Dict:
         """
         Check the status of a payment transaction.
         
@@ -116,19 +269,260 @@ class PaymentGateway:
         
         Args:
             transaction_id: Transaction ID to check
+            idempotency_key: look the charge up by the key it was made with instead
+                (for charges whose response never arrived)
+            
+        Returns:
+            dict: Payment status information; 'status' is 'not_found' if there is no such charge
+            
+        Raises:
+            GatewayError: if the gateway fails to answer (e.g. 5xx after all retries)
+            requests.RequestException: if the gateway cannot be reached after all retries
+        """
+        if self.simulated:
+            time.sleep(STATUS_LATENCY)
+            if idempotency_key is None:
+                return _simulate_status(transaction_id)
+            return _simulate_status_by_key(self._simulated_charges, idempotency_key)
+        
+        if idempotency_key is not None:
+            response, body = self._request("GET", "/charges", params={"idempotency_key": idempotency_key})
+        else:
+            response, body = self._request("GET", f"/charges/{transaction_id}")
+        if _not_found(response, body):
+            return {"status": "not_found", "message": body.get("message", "Transaction not found")}
+        self._raise_for_failure(response, body)
+        return body
+    
+    @staticmethod
+    def _raise_for_failure(response: requests.Response, body: Dict) -> None:
+        """Raise GatewayError unless the gateway accepted the request."""
+        if not response.ok:
+            raise GatewayError(body.get("message", f"Gateway error (HTTP {response.status_code})"),
+                               response.status_code)
+    
+    def _request(self, method: str, path: str, payload: Optional[Dict] = None, idempotency_key: Optional[str] = None,
+                 params: Optional[Dict] = None) -> Tuple[requests.Response, Dict]:
+        """
+        Call the gateway, retrying retryable failures with jittered exponential backoff.
+        
+        POST requests carry `idempotency_key` (or a new random key) as their
+        Idempotency-Key header, the same on every retry.
+        
+        Returns:
+            tuple: (final response, its decoded JSON body or {} if it has none)
+        """
+        headers = {"Idempotency-Key": idempotency_key or uuid.uuid4().hex} if method == "POST" else {}
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            try:
+                if self.pooled:
+                    response = self.session.request(method, url, json=payload, params=params, headers=headers,
+                                                    timeout=self.timeout)
+                else:
+                    response = requests.request(method, url, json=payload, params=params, timeout=self.timeout, headers={
+                        **headers, "Authorization": f"Bearer {self.api_key}", "Connection": "close"})
+                if response.status_code not in RETRYABLE_STATUSES or attempt >= self.max_retries:
+                    break
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+            # "Full jitter": a random wait up to the exponential backoff spreads out retrying clients
+            time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+            attempt += 1
+        
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        return response, body if isinstance(body, dict) else {}
+
+
+class GuardedPaymentGateway:
+    """
+    PaymentGateway whose calls go through a circuit breaker.
+    
+    Gateway errors (GatewayError for 5xx and other failed responses, timeouts,
+    connection errors) count as breaker failures; declines are answers, not
+    failures. Calls that miss the breaker's deadline raise DeadlineExceeded,
+    and while the circuit is open calls fail at once with CircuitOpenError
+    instead of waiting on a struggling provider; pay_late_fees and the other
+    services report either as a payment processing error. A charge abandoned
+    at the deadline may still go through, so it is recorded with an unknown
+    outcome (see charge_outcome_unknown) and settled before any retry; a
+    refund abandoned the same way is held as pending in the ledger until the
+    gateway confirms whether it went through.
+    """
+    
+    def __init__(self, gateway: PaymentGateway, breaker: Optional[CircuitBreaker] = None):
+        self.gateway = gateway
+        self.breaker = breaker or CircuitBreaker("Payment gateway")
+    
+    def process_payment(self, patron_id: str, amount: float, description: str = "",
+                        idempotency_key: Optional[str] = None) -> Tuple[bool, str, str]:
+        return self.breaker.call(self.gateway.process_payment, patron_id, amount, description, idempotency_key)
+    
+    def refund_payment(self, transaction_id: str, amount: float) -> Tuple[bool, str]:
+        return self.breaker.call(self.gateway.refund_payment, transaction_id, amount)
+    
+    def verify_payment_status(self, transaction_id: str = "", idempotency_key: Optional[str] = None) -> Dict:
+        return self.breaker.call(self.gateway.verify_payment_status, transaction_id, idempotency_key)
+    
+    def close(self) -> None:
+        self.gateway.close()
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+def get_payment_gateway() -> GuardedPaymentGateway:
+    """Get the shared gateway, so its connection pool and circuit breaker are shared by every payment."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = GuardedPaymentGateway(PaymentGateway())
+        return _gateway
+
+def configure_payment_gateway(breaker: Optional[CircuitBreaker] = None, **settings) -> GuardedPaymentGateway:
+    """
+    Replace the shared gateway; the old one is closed.
+    
+    Args:
+        breaker: circuit breaker to call the gateway through (default: a new one with default settings)
+        **settings: PaymentGateway arguments, e.g. base_url, pool_size, read_timeout
+    """
+    global _gateway
+    with _gateway_lock:
+        if _gateway is not None:
+            _gateway.close()
+        _gateway = GuardedPaymentGateway(PaymentGateway(**settings), breaker)
+        return _gateway
+
+def close_payment_gateway() -> None:
+    """Close the shared gateway's connections."""
+    with _gateway_lock:
+        if _gateway is not None:
+            _gateway.close()
+
+
+class AsyncPaymentGateway:
+    """
+    Asyncio version of PaymentGateway with the same contract.
+
+    Each call awaits the gateway instead of blocking the calling thread, so many
+    payments can be in flight at once. The batch methods charge or refund many
+    patrons concurrently, with at most `max_concurrency` requests outstanding.
+    
+    Mock this class in tests the same way as PaymentGateway (e.g. with
+    Mock(spec=AsyncPaymentGateway) and AsyncMock methods).
+    """
+    
+    def __init__(self, api_key: str = "test_key_12345", max_concurrency: int = 20):
+        """
+        Initialize payment gateway with API credentials.
+        
+        Args:
+            api_key: API key for authentication (default is test key)
+            max_concurrency: most gateway requests a batch keeps in flight at once
+        """
+        self.api_key = api_key
+        self.base_url = "https://api.payment-gateway.example.com"
+        self.max_concurrency = max_concurrency
+        self._simulated_charges: Dict[str, Tuple[bool, str, str]] = {}  # by idempotency key
+    
+    async def process_payment(self, patron_id: str, amount: float, description: str = "",
+                              idempotency_key: Optional[str] = None) -> Tuple[bool, str, str]:
+        """
+        Process a payment through the external gateway.
+        
+        Args:
+            patron_id: 6-digit patron/customer ID
+            amount: Payment amount in dollars
+            description: Payment description
+            idempotency_key: the gateway applies a key only once
+            
+        Returns:
+            tuple: (success: bool, transaction_id: str, message: str)
+        """
+        await asyncio.sleep(PAYMENT_LATENCY)
+        if idempotency_key is None:
+            return _simulate_payment(patron_id, amount)
+        return self._simulated_charges.setdefault(idempotency_key, _simulate_payment(patron_id, amount))
+    
+    async def refund_payment(self, transaction_id: str, amount: float) -> Tuple[bool, str]:
+        """
+        Refund a previous payment.
+        
+        Args:
+            transaction_id: Original transaction ID to refund
+            amount: Amount to refund
+            
+        Returns:
+            tuple: (success: bool, message: str)
+        """
+        await asyncio.sleep(REFUND_LATENCY)
+        return _simulate_refund(transaction_id, amount)
+    
+    async def verify_payment_status(self, transaction_id: str = "", idempotency_key: Optional[str] = None) -> Dict:
+        """
+        Check the status of a payment transaction.
+        
+        Args:
+            transaction_id: Transaction ID to check
+            idempotency_key: look the charge up by the key it was made with instead
             
         Returns:
-            dict: Payment status information
+            dict: Payment status information; 'status' is 'not_found' if there is no such charge
         """
-        time.sleep(0.3)
+        await asyncio.sleep(STATUS_LATENCY)
+        if idempotency_key is None:
+            return _simulate_status(transaction_id)
+        return _simulate_status_by_key(self._simulated_charges, idempotency_key)
+    
+    async def process_payments(self, charges: Iterable[Tuple[str, float, str]],
+                               max_concurrency: Optional[int] = None) -> List[Tuple[bool, str, str]]:
+        """
+        Charge many patrons concurrently.
+        
+        A charge that raises does not affect the others; it is reported as a
+        failed payment whose message names the error.
+        
+        Args:
+            charges: (patron_id, amount, description) for each payment
+            max_concurrency: most charges in flight at once (default: the gateway's limit)
+            
+        Returns:
+            list: one (success, transaction_id, message) tuple per charge, in input order
+        """
+        results = await self._gather(
+            [partial(self.process_payment, *charge) for charge in charges], max_concurrency)
+        return [(False, "", f"Payment processing error: {result}") if isinstance(result, Exception) else result
+                for result in results]
+    
+    async def refund_payments(self, refunds: Iterable[Tuple[str, float]],
+                              max_concurrency: Optional[int] = None) -> List[Tuple[bool, str]]:
+        """
+        Refund many payments concurrently.
+        
+        Args:
+            refunds: (transaction_id, amount) for each refund
+            max_concurrency: most refunds in flight at once (default: the gateway's limit)
+            
+        Returns:
+            list: one (success, message) tuple per refund, in input order
+        """
+        results = await self._gather(
+            [partial(self.refund_payment, *refund) for refund in refunds], max_concurrency)
+        return [(False, f"Refund processing error: {result}") if isinstance(result, Exception) else result
+                for result in results]
+    
+    async def _gather(self, calls: List, max_concurrency: Optional[int]) -> List:
+        """Await each call in `calls` under a concurrency limit; returns results (or raised exceptions) in order."""
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
         
-        if not transaction_id or not transaction_id.startswith("txn_"):
-            return {"status": "not_found", "message": "Transaction not found"}
+        async def limited(call):
+            async with semaphore:
+                return await call()
         
-        # Simulate status check
-        return {
-            "transaction_id": transaction_id,
-            "status": "completed",
-            "amount": 10.50,
-            "timestamp": time.time()
-        }
+        return await asyncio.gather(*(limited(call) for call in calls), return_exceptions=True)
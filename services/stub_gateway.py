@@ -0,0 +1,197 @@
+"""
+Stub Gateway Module - Local HTTP stand-in for the external payment gateway
+
+Serves the gateway API that PaymentGateway calls when given a base_url, so the
+real network path (connection pooling, timeouts, retries) can be exercised and
+load-tested offline. Answers follow the same rules as the simulated gateway.
+The stub can add latency and fail a fraction of requests with 503, and it
+counts the TCP connections it accepts, which shows whether clients reuse them.
+
+    POST /charges         {"customer_id", "amount", "currency", "description"}
+    POST /refunds         {"transaction_id", "amount"}
+    GET  /charges/<id>
+    GET  /charges?idempotency_key=<key>
+
+POST requests with an Idempotency-Key header already seen get the stored response.
+
+Run standalone with: python -m services.stub_gateway [--port 8099] [--latency 0.05]
+"""
+
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+class StubGatewayServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the stub gateway's settings, counters and transactions."""
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], latency: float = 0.0, failure_rate: float = 0.0):
+        super().__init__(address, StubGatewayHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.connections = 0
+        self.requests = 0
+        self.charges: Dict[str, Dict] = {}
+        self.responses: Dict[str, Tuple[int, Dict]] = {}  # by idempotency key
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def charge(self, body: Dict) -> Tuple[int, Dict]:
+        patron_id = str(body.get("customer_id", ""))
+        amount = body.get("amount")
+        if not isinstance(amount, (int, float)) or amount <= 0:
+            return 400, {"message": "Invalid amount: must be greater than 0"}
+        if amount > 1000:
+            return 402, {"message": "Payment declined: amount exceeds limit"}
+        if len(patron_id) != 6:
+            return 400, {"message": "Invalid patron ID format"}
+        transaction_id = f"txn_{patron_id}_{int(time.time())}_{next(self._ids)}"
+        self.charges[transaction_id] = {"transaction_id": transaction_id, "status": "completed",
+                                        "amount": amount, "timestamp": time.time()}
+        return 200, {"transaction_id": transaction_id, "message": f"Payment of ${amount:.2f} processed successfully"}
+
+    def charge_by_key(self, key: str) -> Tuple[int, Dict]:
+        """Look up the charge made with an idempotency key."""
+        with self.lock:
+            status, response = self.responses.get(key, (404, {}))
+        if status == 404 or (status == 200 and response.get("transaction_id") not in self.charges):
+            return 404, {"status": "not_found", "message": "Transaction not found"}
+        if status == 200:
+            return 200, self.charges[response["transaction_id"]]
+        return 200, {"status": "failed", "message": response.get("message", "")}
+
+    def refund(self, body: Dict) -> Tuple[int, Dict]:
+        transaction_id = body.get("transaction_id")
+        amount = body.get("amount")
+        if transaction_id not in self.charges:
+            return 404, {"status": "not_found", "message": "Invalid transaction ID"}
+        if not isinstance(amount, (int, float)) or amount <= 0:
+            return 400, {"message": "Invalid refund amount"}
+        refund_id = f"refund_{transaction_id}_{next(self._ids)}"
+        self.charges[transaction_id]["status"] = "refunded"
+        return 200, {"refund_id": refund_id,
+                     "message": f"Refund of ${amount:.2f} processed successfully. Refund ID: {refund_id}"}
+
+class StubGatewayHandler(BaseHTTPRequestHandler):
+    """Handles one keep-alive connection to the stub gateway."""
+
+    protocol_version = "HTTP/1.1"  # keep connections open between requests
+    disable_nagle_algorithm = True  # headers and body are written separately; don't wait on delayed ACKs
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if not self._begin():
+            return
+        url = urlsplit(self.path)
+        key = parse_qs(url.query).get("idempotency_key", [None])[0]
+        transaction_id = url.path.rstrip("/").rsplit("/", 1)[-1]
+        if url.path == "/charges" and key is not None:
+            self._send(*self.server.charge_by_key(key))
+        elif not url.path.startswith("/charges/"):
+            self._send(404, {"message": "Not found"})
+        elif transaction_id in self.server.charges:
+            self._send(200, self.server.charges[transaction_id])
+        else:
+            self._send(404, {"status": "not_found", "message": "Transaction not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            body = None
+        if not self._begin():
+            return
+        if not isinstance(body, dict):
+            self._send(400, {"message": "Request body must be a JSON object"})
+            return
+        handlers = {"/charges": self.server.charge, "/refunds": self.server.refund}
+        if self.path not in handlers:
+            self._send(404, {"message": "Not found"})
+            return
+
+        key = self.headers.get("Idempotency-Key")
+        with self.server.lock:
+            if key and key in self.server.responses:
+                status, response = self.server.responses[key]
+            else:
+                status, response = handlers[self.path](body)
+                if key:
+                    self.server.responses[key] = (status, response)
+        self._send(status, response)
+
+    def _begin(self) -> bool:
+        """Count the request, apply the configured latency, and maybe fail it; returns False if it failed."""
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.failure_rate:
+            self._send(503, {"message": "Service temporarily unavailable"})
+            return False
+        return True
+
+    def _send(self, status: int, body: Dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def start_stub_gateway(host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                       failure_rate: float = 0.0) -> StubGatewayServer:
+    """
+    Start a stub gateway on a background thread.
+
+    Args:
+        host: interface to listen on
+        port: port to listen on (0 picks a free one; see the server's url)
+        latency: seconds added to every request
+        failure_rate: fraction of requests answered with 503 (before being processed)
+
+    Returns:
+        StubGatewayServer: the running server; call shutdown() and server_close() to stop it
+    """
+    server = StubGatewayServer((host, port), latency, failure_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the stub payment gateway.")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StubGatewayServer((args.host, args.port), args.latency, args.failure_rate)
+    print(f"Stub payment gateway listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -13,3 +13,15 @@ def setup_database():
     """
     setup_pretest_database()
     yield 
+
+@pytest.fixture
+def overdue_book(mocker):
+    """Make every book look overdue with a $5.00 fee."""
+    mocker.patch(
+        "services.library_service.calculate_late_fee_for_book",
+        return_value={'fee_amount': 5.0, 'days_overdue': 3, 'status': 'overdue'}
+    )
+    mocker.patch(
+        "services.library_service.get_book_by_id",
+        return_value={"author":"Test Author","available_copies":2,"id":999,"isbn":"1234567890123","title":"Test Book","total_copies":3}
+    )
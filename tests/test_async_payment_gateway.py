@@ -0,0 +1,111 @@
+import pytest
+import asyncio
+import time
+from unittest.mock import AsyncMock, Mock
+from services.library_service import pay_late_fees_async, refund_late_fee_payment_async
+from services.payment_service import AsyncPaymentGateway
+
+@pytest.fixture
+def fast_gateway(monkeypatch):
+    """An AsyncPaymentGateway whose simulated round trips take 0.1 s."""
+    monkeypatch.setattr("services.payment_service.PAYMENT_LATENCY", 0.1)
+    monkeypatch.setattr("services.payment_service.REFUND_LATENCY", 0.1)
+    return AsyncPaymentGateway(max_concurrency=50)
+
+def test_batch_payments_run_concurrently(fast_gateway):
+    '''50 charges complete in about one gateway round trip, with results in input order.'''
+    charges = [(str(700000 + i), 5.0, "Late fees") for i in range(50)]
+
+    start = time.perf_counter()
+    results = asyncio.run(fast_gateway.process_payments(charges))
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < 1.0
+    assert all(success for success, _, _ in results)
+    assert [txn.split("_")[1] for _, txn, _ in results] == [patron_id for patron_id, _, _ in charges]
+
+def test_batch_payments_respect_concurrency_limit(fast_gateway):
+    '''With a limit of 2, four charges take two round trips.'''
+    charges = [(str(700100 + i), 5.0, "Late fees") for i in range(4)]
+
+    start = time.perf_counter()
+    asyncio.run(fast_gateway.process_payments(charges, max_concurrency=2))
+
+    assert time.perf_counter() - start >= 0.2
+
+def test_batch_payment_error_does_not_affect_others(fast_gateway, monkeypatch):
+    '''A charge that raises is reported as failed while the rest succeed.'''
+    process_payment = fast_gateway.process_payment
+
+    async def flaky(patron_id, amount, description=""):
+        if patron_id == "700201":
+            raise ConnectionError("network error")
+        return await process_payment(patron_id, amount, description)
+
+    monkeypatch.setattr(fast_gateway, "process_payment", flaky)
+    results = asyncio.run(fast_gateway.process_payments([("700200", 5.0, ""), ("700201", 5.0, ""), ("700202", 0.0, "")]))
+
+    assert results[0][0] == True
+    assert results[1] == (False, "", "Payment processing error: network error")
+    assert results[2] == (False, "", "Invalid amount: must be greater than 0")
+
+def test_batch_refunds(fast_gateway):
+    '''Refunds are batched the same way as charges.'''
+    results = asyncio.run(fast_gateway.refund_payments([("txn_700300_1", 5.0), ("bad_id", 5.0)]))
+
+    assert results[0][0] == True
+    assert results[1] == (False, "Invalid transaction ID")
+
+def test_pay_late_fees_async_valid_payment(overdue_book):
+    '''The async service validates like pay_late_fees and awaits the gateway.'''
+    mock_payment_gateway = Mock(spec=AsyncPaymentGateway)
+    mock_payment_gateway.process_payment = AsyncMock(return_value=(True, "txn_123456_1", "Payment of $5.00 processed successfully"))
+
+    success, message, transaction_id = asyncio.run(pay_late_fees_async("123456", 999, mock_payment_gateway))
+
+    assert success == True
+    assert "payment of $5.00 processed successfully" in message.lower()
+    assert transaction_id == "txn_123456_1"
+    mock_payment_gateway.process_payment.assert_awaited_once_with(
+        patron_id="123456", amount=5.0, description="Late fees for 'Test Book'"
+    )
+
+def test_pay_late_fees_async_settles_timed_out_charge(overdue_book):
+    '''A timed-out async charge is looked up by its key on retry and charged again only if the gateway never got it.'''
+    mock_payment_gateway = Mock(spec=AsyncPaymentGateway)
+    mock_payment_gateway.process_payment = AsyncMock(side_effect=[
+        TimeoutError("timed out"), (True, "txn_668201_1", "Payment of $5.00 processed successfully")])
+    mock_payment_gateway.verify_payment_status = AsyncMock(return_value={"status": "not_found"})
+
+    first = asyncio.run(pay_late_fees_async("668201", 999, mock_payment_gateway, idempotency_key="key-668201"))
+    second = asyncio.run(pay_late_fees_async("668201", 999, mock_payment_gateway, idempotency_key="key-668201"))
+
+    assert first[0] == False
+    assert second == (True, "Payment successful! Payment of $5.00 processed successfully", "txn_668201_1")
+    mock_payment_gateway.verify_payment_status.assert_awaited_once_with(idempotency_key="key-668201")
+    assert mock_payment_gateway.process_payment.await_count == 2
+
+def test_pay_late_fees_async_invalid_patron_id():
+    '''An invalid patron ID never reaches the gateway.'''
+    mock_payment_gateway = Mock(spec=AsyncPaymentGateway)
+    mock_payment_gateway.process_payment = AsyncMock()
+
+    success, message, transaction_id = asyncio.run(pay_late_fees_async("abcdef", 1, mock_payment_gateway))
+
+    assert success == False
+    assert "invalid patron id" in message.lower()
+    assert transaction_id is None
+    mock_payment_gateway.process_payment.assert_not_awaited()
+
+def test_refund_late_fee_payment_async():
+    '''The async refund validates like refund_late_fee_payment and reports gateway errors.'''
+    mock_payment_gateway = Mock(spec=AsyncPaymentGateway)
+    mock_payment_gateway.refund_payment = AsyncMock(side_effect=Exception("network error"))
+
+    assert asyncio.run(refund_late_fee_payment_async("txn_123456_1", 16.0, mock_payment_gateway)) == \
+        (False, "Refund amount exceeds maximum late fee.")
+    success, message = asyncio.run(refund_late_fee_payment_async("txn_123456_1", 5.0, mock_payment_gateway))
+
+    assert success == False
+    assert "refund processing error" in message.lower()
+    mock_payment_gateway.refund_payment.assert_awaited_once_with("txn_123456_1", 5.0)
@@ -0,0 +1,92 @@
+import pytest
+import time
+from dataclasses import FrozenInstanceError
+from cache import LRUCache, MISSING
+from database import book_cache, get_book_by_id, get_book_by_isbn
+from services.library_service import (
+    borrow_book_by_patron,
+    get_all_books
+)
+from .util import add_new_book_for_testing
+
+def test_lru_cache_evicts_least_recently_used():
+    """The least recently used entry is evicted once the cache is full."""
+    cache = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()['evictions'] == 1
+
+def test_lru_cache_expires_entries():
+    """Entries older than the TTL are treated as misses."""
+    cache = LRUCache(max_entries=10, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+
+    assert cache.get("a") is MISSING
+    assert cache.stats()['entries'] == 0
+
+def test_lru_cache_counts_hits_and_misses():
+    """Hits and misses are counted."""
+    cache = LRUCache(max_entries=10)
+    cache.get("a")
+    cache.set("a", 1)
+    cache.get("a")
+
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+def test_lru_cache_ignores_value_loaded_before_invalidation():
+    """A value read before a concurrent invalidation is not cached."""
+    cache = LRUCache(max_entries=10)
+    version = cache.version
+    cache.invalidate("a")
+    cache.set("a", "stale", if_version=version)
+
+    assert cache.get("a") is MISSING
+
+def test_lru_cache_disabled():
+    """A cache with zero entries never stores anything."""
+    cache = LRUCache(max_entries=0)
+    cache.set("a", 1)
+
+    assert cache.get("a") is MISSING
+
+def test_get_book_by_id_is_served_from_cache():
+    """Repeated lookups of the same book hit the cache."""
+    book_id = get_all_books()[0]['id']
+    get_book_by_id(book_id)
+    hits_before = book_cache.stats()['hits']
+
+    assert get_book_by_id(book_id) == get_book_by_id(book_id)
+    assert book_cache.stats()['hits'] == hits_before + 2
+
+def test_cached_book_is_read_only():
+    """Returned books are shared with the cache, so they cannot be changed."""
+    book_id = get_all_books()[0]['id']
+    book = get_book_by_id(book_id)
+
+    with pytest.raises(TypeError):
+        book['title'] = "Changed"
+    with pytest.raises(FrozenInstanceError):
+        book.title = "Changed"
+    assert get_book_by_id(book_id)['title'] != "Changed"
+
+def test_borrow_invalidates_cached_book():
+    """Borrowing a book is reflected in cached lookups by ID and by ISBN."""
+    success, _, isbn = add_new_book_for_testing(get_all_books())
+    if not success:
+        pytest.skip("Failed to add a new book for testing.")
+    book = get_book_by_isbn(isbn)
+    available_before = get_book_by_id(book['id'])['available_copies']
+
+    success, _ = borrow_book_by_patron("880001", book['id'])
+
+    assert success == True
+    assert get_book_by_id(book['id'])['available_copies'] == available_before - 1
+    assert get_book_by_isbn(book['isbn'])['available_copies'] == available_before - 1
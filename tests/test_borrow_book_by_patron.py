@@ -1,5 +1,5 @@
 import pytest
-import time
+import threading
 from services.library_service import (
     borrow_book_by_patron,
     get_all_books,
@@ -7,10 +7,11 @@ from services.library_service import (
     get_book_by_id
 )
 from .util import (
+    add_new_book_for_testing,
     get_book_with_available_copies,
     generate_patron_id_under_borrow_limit
 )
-from database import get_patron_borrowed_books
+from database import get_patron_borrowed_books, get_book_by_isbn
 
 def test_borrow_book_valid():
     """Test borrowing a book with valid patron ID and book ID."""
@@ -109,3 +110,30 @@ def test_borrow_book_already_borrowed():
     success, message = borrow_book_by_patron(patron_id, book["id"])
     assert success == False
     assert "already borrowed" in message.lower()
+
+def test_borrow_book_concurrent_no_oversell():
+    """Test that patrons racing for the last copies can never borrow more copies than exist."""
+    success, _, isbn = add_new_book_for_testing(get_all_books(), available_copies=2)
+    if not success:
+        pytest.skip("Failed to add a new book for testing.")
+    book_id = get_book_by_isbn(isbn)['id']
+    patron_ids = [str(770000 + i) for i in range(12)]
+    results = []
+    start = threading.Barrier(len(patron_ids))
+
+    def borrow(patron_id):
+        start.wait()
+        results.append(borrow_book_by_patron(patron_id, book_id))
+
+    threads = [threading.Thread(target=borrow, args=(patron_id,)) for patron_id in patron_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    successes = [message for success, message in results if success]
+    failures = [message for success, message in results if not success]
+    assert len(successes) == 2
+    assert all("not available" in message.lower() for message in failures)
+    assert get_book_by_id(book_id)['available_copies'] == 0
+    assert sum(get_patron_borrow_count(patron_id) for patron_id in patron_ids) == 2
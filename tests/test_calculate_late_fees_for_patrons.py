@@ -0,0 +1,62 @@
+import pytest
+import json
+from app import create_app
+from services.library_service import (
+    calculate_late_fees_for_patrons,
+    calculate_late_fee_for_book
+)
+from .util import borrow_days_ago
+
+def test_bulk_late_fees_match_per_book_fees():
+    """Bulk fees agree with calculate_late_fee_for_book for every overdue loan."""
+    first_book = borrow_days_ago("661001", 17)
+    second_book = borrow_days_ago("661001", 40)
+
+    summaries = list(calculate_late_fees_for_patrons(["661001"]))
+
+    assert len(summaries) == 1
+    fees = {book['book_id']: book['fee_amount'] for book in summaries[0]['overdue_books']}
+    assert fees[first_book] == calculate_late_fee_for_book("661001", first_book)['fee_amount'] == 1.5
+    assert fees[second_book] == calculate_late_fee_for_book("661001", second_book)['fee_amount'] == 15.0
+    assert summaries[0]['total_late_fees_owed'] == 16.5
+
+def test_bulk_late_fees_include_requested_patrons_without_fees():
+    """Requested patrons with nothing overdue are reported with no fees, in patron ID order."""
+    borrow_days_ago("661102", 20)
+    borrow_days_ago("661103", 2)
+
+    summaries = list(calculate_late_fees_for_patrons(["661103", "661102", "661101"]))
+
+    assert [summary['patron_id'] for summary in summaries] == ["661101", "661102", "661103"]
+    assert [summary['total_late_fees_owed'] for summary in summaries] == [0.0, 3.0, 0.0]
+    assert summaries[2]['overdue_books'] == []
+
+def test_bulk_late_fees_for_all_patrons():
+    """"all" reports every patron with overdue loans and skips patrons without."""
+    borrow_days_ago("661201", 25)
+    borrow_days_ago("661202", 1)
+
+    patron_ids = [summary['patron_id'] for summary in calculate_late_fees_for_patrons("all")]
+
+    assert "661201" in patron_ids
+    assert "661202" not in patron_ids
+    assert patron_ids == sorted(patron_ids)
+
+def test_bulk_late_fees_invalid_patron_id():
+    """An invalid patron ID is rejected before any fees are calculated."""
+    with pytest.raises(ValueError):
+        calculate_late_fees_for_patrons(["661301", "abc123"])
+
+def test_bulk_late_fees_endpoint_streams_ndjson():
+    """The bulk endpoint streams one JSON summary per line."""
+    borrow_days_ago("661401", 30)
+    client = create_app().test_client()
+
+    response = client.post('/api/late_fees', json={'patron_ids': ["661401", "661402"]})
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert [line['patron_id'] for line in lines] == ["661401", "661402"]
+    assert lines[0]['total_late_fees_owed'] == 12.5
+    assert client.get('/api/late_fees?patrons=661401,12').status_code == 400
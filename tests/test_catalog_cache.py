@@ -0,0 +1,86 @@
+import sqlite3
+import database
+from database import (
+    book_cache,
+    catalog_cache,
+    get_all_books,
+    get_book_by_id,
+    refresh_caches,
+    search_books
+)
+from services.library_service import add_book_to_catalog
+
+def write_from_other_process(sql, parameters=()):
+    """Simulate another worker process writing to library.db through its own connection."""
+    conn = sqlite3.connect(database.DATABASE)
+    conn.execute(sql, parameters)
+    conn.commit()
+    conn.close()
+
+def test_get_all_books_served_from_snapshot():
+    """An unchanged catalog is served from the snapshot cache."""
+    get_all_books()
+    hits_before = catalog_cache.stats()['hits']
+
+    get_all_books()
+
+    assert catalog_cache.stats()['hits'] == hits_before + 1
+
+def test_snapshot_sees_write_from_other_process():
+    """A book added by another worker shows up in the next catalog read."""
+    books_before = get_all_books()
+    write_from_other_process('''
+        INSERT INTO books (title, author, isbn, total_copies, available_copies)
+        VALUES ('Other Worker Book', 'Other Author', '5555555555555', 1, 1)
+    ''')
+
+    books_after = get_all_books()
+
+    assert len(books_after) == len(books_before) + 1
+    assert "Other Worker Book" in [book['title'] for book in books_after]
+
+def test_search_sees_availability_change_from_other_process():
+    """Cached search results are rebuilt after another worker changes availability."""
+    book = search_books("Mockingbird", "title", 10)[0]
+    write_from_other_process('UPDATE books SET available_copies = ? WHERE id = ?',
+                             (book['available_copies'] + 1, book['id']))
+
+    assert search_books("Mockingbird", "title", 10)[0]['available_copies'] == book['available_copies'] + 1
+    write_from_other_process('UPDATE books SET available_copies = ? WHERE id = ?',
+                             (book['available_copies'], book['id']))
+
+def test_snapshot_sees_write_from_this_process():
+    """A book added through the service layer shows up in the next catalog read."""
+    get_all_books()
+    success, _ = add_book_to_catalog("Snapshot Book", "Snapshot Author", "5555555555556", 1)
+    assert success == True
+
+    assert "Snapshot Book" in [book['title'] for book in get_all_books()]
+
+def test_refresh_caches_drops_books_changed_by_other_process():
+    """refresh_caches drops cached book lookups once another worker has written."""
+    book_id = get_all_books()[0]['id']
+    refresh_caches()
+    title = get_book_by_id(book_id)['title']
+    write_from_other_process('UPDATE books SET title = ? WHERE id = ?', ("Renamed Elsewhere", book_id))
+
+    refresh_caches()
+
+    assert get_book_by_id(book_id)['title'] == "Renamed Elsewhere"
+    write_from_other_process('UPDATE books SET title = ? WHERE id = ?', (title, book_id))
+
+def test_availability_change_only_evicts_its_own_book():
+    """A borrow or return elsewhere drops that book from the lookup cache and leaves the others cached."""
+    first, second = get_all_books()[:2]
+    refresh_caches()
+    get_book_by_id(first['id'])
+    get_book_by_id(second['id'])
+    write_from_other_process('UPDATE books SET available_copies = available_copies - 1 WHERE id = ?', (first['id'],))
+
+    refresh_caches()
+    hits_before = book_cache.stats()['hits']
+
+    assert get_book_by_id(first['id'])['available_copies'] == first['available_copies'] - 1
+    assert get_book_by_id(second['id'])['available_copies'] == second['available_copies']
+    assert book_cache.stats()['hits'] == hits_before + 1
+    write_from_other_process('UPDATE books SET available_copies = available_copies + 1 WHERE id = ?', (first['id'],))
@@ -0,0 +1,187 @@
+import pytest
+import time
+from app import create_app
+from services.circuit_breaker import CircuitBreaker, CircuitOpenError, DeadlineExceeded
+from database import get_payment_by_key, get_payment_by_transaction
+from services.library_service import pay_late_fees, refund_late_fee_payment
+from services.payment_service import GatewayError, GuardedPaymentGateway, PaymentGateway
+from services.stub_gateway import start_stub_gateway
+
+class FakeClock:
+    """A monotonic clock the test moves by hand."""
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def slow_stub():
+    """A stub payment gateway that takes 0.5 s to answer."""
+    server = start_stub_gateway(latency=0.5)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def failing_call():
+    raise ConnectionError("gateway unreachable")
+
+def test_failures_open_the_circuit():
+    '''Once the failure rate is reached, calls are rejected without being made.'''
+    breaker = CircuitBreaker("Test service", minimum_calls=3, window_size=5)
+    calls = []
+
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            breaker.call(failing_call)
+
+    with pytest.raises(CircuitOpenError):
+        breaker.call(calls.append, 1)
+    assert calls == []
+    stats = breaker.stats()
+    assert stats['state'] == 'open'
+    assert stats['failures'] == 3
+    assert stats['rejected'] == 1
+    assert stats['window']['failure_rate'] == 1.0
+
+def test_successful_probe_closes_the_circuit():
+    '''After the cool-down one probe is let through, and its success closes the circuit.'''
+    clock = FakeClock()
+    breaker = CircuitBreaker("Test service", minimum_calls=1, open_seconds=30, clock=clock)
+    with pytest.raises(ConnectionError):
+        breaker.call(failing_call)
+
+    clock.now += 29
+    assert breaker.state == 'open'
+    clock.now += 1
+    assert breaker.state == 'half_open'
+
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state == 'closed'
+    assert breaker.stats()['window']['calls'] == 0
+
+def test_failed_probe_reopens_the_circuit():
+    '''A failed probe opens the circuit for another cool-down.'''
+    clock = FakeClock()
+    breaker = CircuitBreaker("Test service", minimum_calls=1, open_seconds=30, clock=clock)
+    with pytest.raises(ConnectionError):
+        breaker.call(failing_call)
+    clock.now += 30
+
+    with pytest.raises(ConnectionError):
+        breaker.call(failing_call)
+
+    assert breaker.state == 'open'
+    assert breaker.stats()['times_opened'] == 2
+
+def test_slow_calls_open_the_circuit():
+    '''Calls that succeed but are consistently slow also open the circuit.'''
+    breaker = CircuitBreaker("Test service", minimum_calls=2, slow_call_duration=0.05)
+
+    for _ in range(2):
+        breaker.call(time.sleep, 0.06)
+
+    assert breaker.state == 'open'
+    assert breaker.stats()['slow_calls'] == 2
+
+def test_slow_gateway_fails_fast_once_open(slow_stub):
+    '''Calls to a slow gateway give up at the deadline, then stop reaching it at all.'''
+    gateway = GuardedPaymentGateway(PaymentGateway(base_url=slow_stub.url),
+                                    CircuitBreaker("Payment gateway", deadline=0.1, minimum_calls=2))
+
+    for _ in range(2):
+        start = time.perf_counter()
+        with pytest.raises(DeadlineExceeded):
+            gateway.process_payment("123456", 5.0)
+        assert time.perf_counter() - start < 0.3
+
+    start = time.perf_counter()
+    with pytest.raises(CircuitOpenError):
+        gateway.process_payment("123456", 5.0)
+    assert time.perf_counter() - start < 0.05
+    assert gateway.breaker.stats()['deadlines_exceeded'] == 2
+    gateway.close()
+
+def test_gateway_outage_opens_the_circuit():
+    '''5xx responses from the gateway are failures, not successful calls.'''
+    server = start_stub_gateway(failure_rate=1.0)
+    gateway = GuardedPaymentGateway(PaymentGateway(base_url=server.url, max_retries=0),
+                                    CircuitBreaker("Payment gateway", minimum_calls=3))
+
+    for _ in range(3):
+        with pytest.raises(GatewayError):
+            gateway.process_payment("123456", 5.0)
+    with pytest.raises(CircuitOpenError):
+        gateway.process_payment("123456", 5.0)
+
+    stats = gateway.breaker.stats()
+    assert stats['state'] == 'open'
+    assert stats['failures'] == 3
+    assert stats['successes'] == 0
+    gateway.close()
+    server.shutdown()
+    server.server_close()
+
+def test_charge_abandoned_at_deadline_is_not_charged_again(slow_stub, overdue_book):
+    '''A charge that missed the deadline may still go through, so a retry settles it instead of charging again.'''
+    gateway = GuardedPaymentGateway(PaymentGateway(base_url=slow_stub.url),
+                                    CircuitBreaker("Payment gateway", deadline=0.1))
+
+    first = pay_late_fees("668101", 999, gateway, idempotency_key="key-668101")
+    assert first[0] == False
+    assert get_payment_by_key("key-668101")['status'] == 'unknown'
+
+    time.sleep(0.6)  # the abandoned call completes on the breaker's thread
+    gateway.breaker.deadline = 2.0
+    second = pay_late_fees("668101", 999, gateway, idempotency_key="key-668101")
+
+    assert second[0] == True
+    assert len(slow_stub.charges) == 1
+    assert second[2] in slow_stub.charges
+    gateway.close()
+
+def test_refund_abandoned_at_deadline_is_not_refunded_again(slow_stub, mocker, overdue_book):
+    '''A refund that missed the deadline is held as pending, and a retry confirms it instead of refunding again.'''
+    gateway = GuardedPaymentGateway(PaymentGateway(base_url=slow_stub.url),
+                                    CircuitBreaker("Payment gateway", deadline=2.0))
+    transaction_id = pay_late_fees("668701", 999, gateway)[2]
+    refunds = mocker.spy(gateway.gateway, "refund_payment")
+
+    gateway.breaker.deadline = 0.1
+    first = refund_late_fee_payment(transaction_id, 5.0, gateway)
+    assert first[0] == False
+    assert "held as pending" in first[1]
+    assert get_payment_by_transaction(transaction_id)['pending_refund'] == 5.0
+
+    time.sleep(0.6)  # the abandoned call completes on the breaker's thread
+    gateway.breaker.deadline = 2.0
+    second = refund_late_fee_payment(transaction_id, 5.0, gateway)
+
+    assert second[0] == True
+    assert refunds.call_count == 1
+    payment = get_payment_by_transaction(transaction_id)
+    assert payment['status'] == 'refunded'
+    assert payment['refunded_amount'] == 5.0
+    assert payment['pending_refund'] == 0
+    gateway.close()
+
+def test_open_circuit_is_reported_by_pay_late_fees(overdue_book):
+    '''pay_late_fees reports an open circuit as a payment processing error.'''
+    breaker = CircuitBreaker("Payment gateway", minimum_calls=1)
+    with pytest.raises(ConnectionError):
+        breaker.call(failing_call)
+
+    success, message, transaction_id = pay_late_fees("668001", 999, GuardedPaymentGateway(PaymentGateway(), breaker))
+
+    assert success == False
+    assert "payment processing error" in message.lower()
+    assert "circuit open" in message.lower()
+
+def test_circuit_state_endpoint():
+    '''The breaker's state and counters are exposed for monitoring.'''
+    client = create_app().test_client()
+
+    response = client.get('/api/payments/circuit')
+
+    assert response.status_code == 200
+    assert response.json['state'] in ('closed', 'open', 'half_open')
+    assert 'rejected' in response.json
@@ -0,0 +1,71 @@
+import pytest
+from app import create_app
+from services.library_service import (
+    borrow_book_by_patron,
+    get_all_books,
+    get_book_by_isbn
+)
+from .util import add_new_book_for_testing
+
+@pytest.fixture
+def client():
+    """Flask test client for the application."""
+    return create_app().test_client()
+
+@pytest.mark.parametrize("url", ["/catalog", "/search?q=test&type=title", "/api/search?q=test", "/api/books"])
+def test_unchanged_catalog_returns_not_modified(client, url):
+    """Repeating a catalog request with its ETag returns 304 without a body."""
+    response = client.get(url)
+    etag = response.headers['ETag']
+
+    repeated = client.get(url, headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert repeated.status_code == 304
+    assert repeated.headers['ETag'] == etag
+    assert repeated.data == b''
+
+def test_catalog_change_invalidates_etag(client):
+    """Changing the catalog changes the catalog ETag."""
+    etag = client.get('/catalog').headers['ETag']
+    success, _, _ = add_new_book_for_testing(get_all_books())
+    if not success:
+        pytest.skip("Failed to add a new book for testing.")
+
+    response = client.get('/catalog', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+def test_book_etag_only_changes_with_that_book(client):
+    """A book's ETag survives changes to other books but not to itself."""
+    success, _, isbn = add_new_book_for_testing(get_all_books())
+    success_other, _, other_isbn = add_new_book_for_testing(get_all_books())
+    if not success or not success_other:
+        pytest.skip("Failed to add new books for testing.")
+    book_id = get_book_by_isbn(isbn)['id']
+    other_id = get_book_by_isbn(other_isbn)['id']
+    etag = client.get(f'/api/book/{book_id}').headers['ETag']
+
+    assert borrow_book_by_patron("990001", other_id)[0] == True
+    assert client.get(f'/api/book/{book_id}', headers={'If-None-Match': etag}).status_code == 304
+
+    assert borrow_book_by_patron("990001", book_id)[0] == True
+    assert client.get(f'/api/book/{book_id}', headers={'If-None-Match': etag}).status_code == 200
+
+def test_missing_book_has_no_etag(client):
+    """A 404 for an unknown book is not given an ETag."""
+    response = client.get('/api/book/999999')
+
+    assert response.status_code == 404
+    assert 'ETag' not in response.headers
+
+def test_pending_flash_message_bypasses_not_modified(client):
+    """A page with a flash message waiting to be shown is always rendered."""
+    etag = client.get('/catalog').headers['ETag']
+    client.post('/borrow', data={'patron_id': 'abc', 'book_id': '1'})
+
+    response = client.get('/catalog', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert b"Invalid patron ID" in response.data
@@ -0,0 +1,178 @@
+import pytest
+import sqlite3
+import threading
+from datetime import datetime
+from unittest.mock import Mock
+import database
+from app import create_app
+from database import (
+    ConnectionPool,
+    configure_pool,
+    db_connection,
+    get_book_by_id,
+    get_pool,
+    iter_overdue_loans
+)
+from services.data_export import export_rows
+from services.payment_service import PaymentGateway
+from .util import borrow_days_ago
+
+def test_pool_reuses_released_connection(tmp_path):
+    """A released connection is handed out again instead of opening a new one."""
+    pool = ConnectionPool(str(tmp_path / "pool.db"), size=2)
+    conn = pool.acquire()
+    pool.release(conn)
+
+    assert pool.acquire() is conn
+    assert pool.open_connections == 1
+    pool.close()
+
+def test_pool_respects_size_limit(tmp_path):
+    """Checking out more connections than the pool size times out."""
+    pool = ConnectionPool(str(tmp_path / "pool.db"), size=1, timeout=0.05)
+    conn = pool.acquire()
+
+    with pytest.raises(sqlite3.OperationalError):
+        pool.acquire()
+    pool.release(conn)
+    pool.close()
+
+def test_pool_waiting_thread_gets_released_connection(tmp_path):
+    """A thread blocked on a full pool receives the connection once it is released."""
+    pool = ConnectionPool(str(tmp_path / "pool.db"), size=1, timeout=5)
+    conn = pool.acquire()
+    received = []
+
+    waiter = threading.Thread(target=lambda: received.append(pool.acquire()))
+    waiter.start()
+    pool.release(conn)
+    waiter.join(timeout=5)
+
+    assert received == [conn]
+    pool.close()
+
+def test_pool_health_check_replaces_broken_connection(tmp_path):
+    """An idle connection that fails its health check is discarded and replaced."""
+    pool = ConnectionPool(str(tmp_path / "pool.db"), size=1, health_check_interval=0)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.close()  # Simulate a connection that went bad while idle
+
+    new_conn = pool.acquire()
+    assert new_conn is not conn
+    assert new_conn.execute('SELECT 1').fetchone()[0] == 1
+    assert pool.open_connections == 1
+    pool.close()
+
+def test_pool_release_rolls_back_open_transaction(tmp_path):
+    """Uncommitted work is rolled back when a connection goes back into the pool."""
+    pool = ConnectionPool(str(tmp_path / "pool.db"), size=1)
+    conn = pool.acquire()
+    conn.execute('CREATE TABLE t (x INTEGER)')
+    conn.execute('INSERT INTO t VALUES (1)')
+    pool.release(conn)
+
+    conn = pool.acquire()
+    assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 0
+    pool.close()
+
+def test_pool_close_refuses_checkout(tmp_path):
+    """A closed pool does not hand out connections."""
+    pool = ConnectionPool(str(tmp_path / "pool.db"))
+    pool.close()
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        pool.acquire()
+
+def test_db_connection_returns_its_connection_to_the_pool():
+    """Each db_connection block checks out its own connection and returns it when the block ends."""
+    with db_connection() as first, db_connection() as second:
+        assert first is not second
+        idle = get_pool().idle_connections
+
+    assert get_pool().idle_connections == idle + 2
+
+def test_requests_do_not_hold_a_connection_during_gateway_calls(mocker):
+    """A request waiting on the payment gateway leaves the pool free for other requests."""
+    started, finish = threading.Event(), threading.Event()
+    def slow_status(transaction_id):
+        started.set()
+        finish.wait(5)
+        return {"transaction_id": transaction_id, "status": "completed"}
+    gateway = Mock(spec=PaymentGateway)
+    gateway.verify_payment_status.side_effect = slow_status
+    mocker.patch("services.library_service.get_payment_gateway", return_value=gateway)
+    app = create_app()
+    configure_pool(size=1, timeout=1)
+    waiting = threading.Thread(target=lambda: app.test_client().get('/api/payments/transactions/txn_669701_1'))
+    try:
+        waiting.start()
+        assert started.wait(5)
+        assert app.test_client().get('/catalog').status_code == 200
+    finally:
+        finish.set()
+        waiting.join(5)
+        configure_pool()
+
+def test_streamed_export_does_not_hold_a_connection():
+    """A partly consumed export only borrows a connection while it reads each batch."""
+    configure_pool(size=1, timeout=0.5)
+    try:
+        chunks = export_rows('books', 'csv', batch_size=2)
+        next(chunks)
+        with db_connection() as conn:
+            assert conn.execute('SELECT 1').fetchone()[0] == 1
+        assert len(list(chunks)) > 0
+    finally:
+        configure_pool()
+
+def test_streamed_late_fees_do_not_hold_a_connection():
+    """Overdue loans are read in batches, each borrowing a connection only while it is read."""
+    for patron_id in ("669801", "669802", "669803"):
+        borrow_days_ago(patron_id, 20)
+        borrow_days_ago(patron_id, 20)
+    now = datetime.now()
+    expected = [loan['loan_id'] for loan in iter_overdue_loans(now)]
+    configure_pool(size=1, timeout=0.5)
+    try:
+        loans = iter_overdue_loans(now, batch_size=1)
+        first = next(loans)
+        assert get_book_by_id(first['book_id']) is not None
+        assert [first['loan_id']] + [loan['loan_id'] for loan in loans] == expected
+    finally:
+        configure_pool()
+
+def test_pool_follows_database_setting(monkeypatch, tmp_path):
+    """Changing DATABASE switches the process-wide pool to the new file."""
+    original_pool = get_pool()
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "other.db"))
+
+    assert get_pool().database == str(tmp_path / "other.db")
+    monkeypatch.undo()
+    assert get_pool() is not original_pool
+    assert get_pool().database == database.DATABASE
+
+def test_connection_applies_pragma_profile(tmp_path):
+    """Every new connection is configured with the PRAGMA profile."""
+    conn = database.get_db_connection(str(tmp_path / "pragmas.db"))
+
+    assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+    assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == database.PRAGMAS['busy_timeout']
+    assert conn.execute('PRAGMA temp_store').fetchone()[0] == 2  # MEMORY
+    conn.close()
+
+def test_init_database_enables_wal():
+    """init_database switches the database file to write-ahead logging."""
+    database.init_database()
+
+    with db_connection() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+def test_create_app_does_not_register_exit_handlers(mocker):
+    """Exit handlers are registered once when app is imported, not by every create_app call."""
+    register = mocker.patch("atexit.register")
+
+    create_app()
+    create_app()
+
+    register.assert_not_called()
@@ -0,0 +1,62 @@
+import csv
+import io
+import json
+import pytest
+from datetime import datetime, timedelta
+from app import create_app
+from services.data_export import export_rows
+from services.library_service import get_all_books
+from .util import borrow_new_book_days_ago
+
+def test_books_csv_export_matches_catalog():
+    '''The CSV export has a header line and one row per book, in id order.'''
+    rows = list(csv.DictReader(io.StringIO(''.join(export_rows('books', 'csv', batch_size=2)))))
+
+    books = sorted(get_all_books(), key=lambda book: book['id'])
+    assert [int(row['id']) for row in rows] == [book['id'] for book in books]
+    assert rows[0]['isbn'] == books[0]['isbn']
+    assert int(rows[0]['available_copies']) == books[0]['available_copies']
+
+def test_export_resumes_after_last_id():
+    '''An NDJSON export with after_id only contains rows added since the earlier export.'''
+    first = [json.loads(line) for line in ''.join(export_rows('loans', 'ndjson')).splitlines()]
+    book_id = borrow_new_book_days_ago("669501", 3)
+
+    later = [json.loads(line) for line in
+             ''.join(export_rows('loans', 'ndjson', after_id=first[-1]['id'] if first else None)).splitlines()]
+
+    assert [(loan['patron_id'], loan['book_id']) for loan in later] == [("669501", book_id)]
+    assert later[0]['return_date'] is None
+
+def test_loans_export_since_timestamp():
+    '''Loans borrowed before `since` and not returned since are left out.'''
+    borrow_new_book_days_ago("669502", 30)
+    recent_book_id = borrow_new_book_days_ago("669502", 1)
+
+    loans = [json.loads(line) for line in
+             ''.join(export_rows('loans', 'ndjson', since=datetime.now() - timedelta(days=2))).splitlines()]
+
+    assert [loan['book_id'] for loan in loans if loan['patron_id'] == "669502"] == [recent_book_id]
+    with pytest.raises(ValueError):
+        export_rows('books', 'csv', since=datetime.now())
+
+def test_export_endpoint_streams_and_command_writes_file(tmp_path):
+    '''The export endpoint streams its response; the command writes the same export to a file.'''
+    app = create_app()
+    client = app.test_client()
+
+    response = client.get('/api/export/books?format=ndjson')
+
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'application/x-ndjson'
+    assert len(response.get_data(as_text=True).splitlines()) == len(get_all_books())
+    assert client.get('/api/export/patrons').status_code == 404
+    assert client.get('/api/export/books?format=xml').status_code == 400
+    assert client.get('/api/export/loans?after_id=abc').status_code == 400
+
+    path = tmp_path / "books.csv"
+    result = app.test_cli_runner().invoke(args=["export-data", "books", "--output", str(path)])
+
+    assert result.exit_code == 0
+    assert path.read_text() == client.get('/api/export/books').get_data(as_text=True)
@@ -0,0 +1,107 @@
+import pytest
+import sqlite3
+import database
+from datetime import datetime, timedelta
+from database import (
+    MIGRATIONS,
+    db_connection,
+    init_database,
+    migrate_database,
+    to_timestamp
+)
+
+@pytest.fixture
+def fresh_database(monkeypatch, tmp_path):
+    """Point the database module at an empty database file for one test."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "migrations.db"))
+    yield database.DATABASE
+    database.close_pool()
+
+def get_index_names(conn):
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'borrow_records'").fetchall()
+    return {row['name'] for row in rows}
+
+def test_init_database_applies_all_migrations(fresh_database):
+    """A new database ends up at the latest schema version with the loan indexes."""
+    init_database()
+
+    with db_connection() as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        assert {'idx_borrow_records_open_patron', 'idx_borrow_records_book_return'} <= get_index_names(conn)
+
+def test_migrate_legacy_database_in_place(fresh_database):
+    """A pre-migration library.db keeps its rows and is upgraded to the latest version."""
+    legacy = sqlite3.connect(fresh_database)
+    legacy.executescript('''
+        CREATE TABLE books (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT NOT NULL, author TEXT NOT NULL,
+                            isbn TEXT UNIQUE NOT NULL, total_copies INTEGER NOT NULL, available_copies INTEGER NOT NULL);
+        CREATE TABLE borrow_records (id INTEGER PRIMARY KEY AUTOINCREMENT, patron_id TEXT NOT NULL, book_id INTEGER NOT NULL,
+                                     borrow_date TEXT NOT NULL, due_date TEXT NOT NULL, return_date TEXT,
+                                     FOREIGN KEY (book_id) REFERENCES books (id));
+        INSERT INTO books (title, author, isbn, total_copies, available_copies) VALUES ('Old', 'Author', '1111111111111', 1, 0);
+        INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
+            VALUES ('111111', 1, '2024-01-01T10:00:00', '2024-01-15T10:00:00');
+    ''')
+    legacy.close()
+
+    init_database()
+
+    assert database.get_patron_borrow_count('111111') == 1
+    assert database.get_patron_summary('111111')['overdue_loans'] == 1
+    assert database.get_patron_borrowed_books('111111')[0]['due_date'] == datetime(2024, 1, 15, 10, 0)
+    with db_connection() as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        record = conn.execute('SELECT borrow_ts, due_ts, return_ts FROM borrow_records').fetchone()
+    assert record['borrow_ts'] == to_timestamp(datetime(2024, 1, 1, 10, 0))
+    assert record['due_ts'] == to_timestamp(datetime(2024, 1, 15, 10, 0))
+    assert record['return_ts'] is None
+
+def test_migrate_database_is_idempotent(fresh_database):
+    """Running the migrations again on an up-to-date database changes nothing."""
+    init_database()
+
+    with db_connection() as conn:
+        indexes_before = get_index_names(conn)
+        assert migrate_database(conn) == len(MIGRATIONS)
+        assert get_index_names(conn) == indexes_before
+
+def test_open_loan_lookup_uses_index(fresh_database):
+    """Counting a patron's open loans is an index search, not a table scan."""
+    init_database()
+
+    with db_connection() as conn:
+        plan = conn.execute('''
+            EXPLAIN QUERY PLAN SELECT COUNT(*) FROM borrow_records WHERE patron_id = ? AND return_date IS NULL
+        ''', ('123456',)).fetchall()
+    details = " ".join(row['detail'] for row in plan)
+    assert "SEARCH borrow_records USING" in details
+    assert "SCAN borrow_records" not in details
+
+def test_text_only_loan_writes_get_timestamps(fresh_database):
+    """Loans written with only ISO text (as older code does) get the same timestamps Python computes."""
+    init_database()
+    borrow_dates = [datetime(2025, 3, 1, 9, 30, 15, 123456) + timedelta(days=i, seconds=i * 3607.25) for i in range(50)]
+    borrow_dates.append(datetime(2025, 3, 1))
+
+    with db_connection() as conn:
+        for borrow_date in borrow_dates:
+            conn.execute('''
+                INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date) VALUES ('222222', 1, ?, ?)
+            ''', (borrow_date.isoformat(), (borrow_date + timedelta(days=14)).isoformat()))
+        conn.execute("UPDATE borrow_records SET return_date = ? WHERE id = 1", (borrow_dates[3].isoformat(),))
+        conn.commit()
+        records = conn.execute('SELECT * FROM borrow_records ORDER BY id').fetchall()
+
+    assert [record['borrow_ts'] for record in records] == [to_timestamp(date) for date in borrow_dates]
+    assert [record['due_ts'] for record in records] == [to_timestamp(date + timedelta(days=14)) for date in borrow_dates]
+    assert records[0]['return_ts'] == to_timestamp(borrow_dates[3])
+
+def test_overdue_loan_lookup_uses_timestamp_index(fresh_database):
+    """Overdue open loans are found through the due timestamp index."""
+    init_database()
+
+    with db_connection() as conn:
+        plan = conn.execute('''
+            EXPLAIN QUERY PLAN SELECT id FROM borrow_records WHERE return_date IS NULL AND due_ts < ?
+        ''', (to_timestamp(datetime.now()),)).fetchall()
+    assert "idx_borrow_records_open_due_ts" in " ".join(row['detail'] for row in plan)
@@ -0,0 +1,74 @@
+import pytest
+from app import create_app
+from services.library_service import (
+    get_all_books,
+    get_book_by_isbn,
+    get_catalog_cursor_at,
+    get_catalog_page,
+    get_patron_history_page,
+    get_patron_borrowing_history,
+    MAX_PAGE_SIZE
+)
+
+def test_catalog_pages_cover_whole_catalog():
+    """Walking every page returns each book exactly once, in (title, id) order."""
+    books = []
+    page = get_catalog_page(page_size=2)
+    books.extend(page['books'])
+    while page['next_cursor']:
+        assert len(page['books']) == 2
+        page = get_catalog_page(page['next_cursor'], page_size=2)
+        books.extend(page['books'])
+
+    expected = sorted(get_all_books(), key=lambda book: (book['title'], book['id']))
+    assert books == expected
+
+def test_catalog_last_page_has_no_next_cursor():
+    """A page that reaches the end of the catalog has no next cursor."""
+    page = get_catalog_page(page_size=MAX_PAGE_SIZE)
+
+    assert page['next_cursor'] is None
+    assert len(page['books']) == len(get_all_books())
+
+def test_catalog_page_size_is_clamped():
+    """Requested page sizes are limited to 1..MAX_PAGE_SIZE."""
+    assert len(get_catalog_page(page_size=0)['books']) == 1
+    assert len(get_catalog_page(page_size=10 ** 6)['books']) <= MAX_PAGE_SIZE
+
+def test_catalog_page_invalid_cursor():
+    """A malformed cursor is rejected."""
+    with pytest.raises(ValueError):
+        get_catalog_page("not-a-cursor")
+
+def test_catalog_cursor_at_book_starts_its_page():
+    """A cursor made for a book gives the page that starts with that book."""
+    book = sorted(get_all_books(), key=lambda book: (book['title'], book['id']))[1]
+
+    assert get_catalog_page(get_catalog_cursor_at(book), page_size=2)['books'][0] == book
+
+def test_added_book_is_shown_after_redirect():
+    """Adding a book through the web form shows the catalog page holding the new book."""
+    client = create_app().test_client()
+
+    response = client.post('/add_book', follow_redirects=True, data={
+        'title': "Zzz Redirected Book", 'author': "Redirect Author", 'isbn': "6690000000401", 'total_copies': "2"})
+
+    assert response.status_code == 200
+    assert response.request.args['cursor'] == get_catalog_cursor_at(get_book_by_isbn("6690000000401"))
+    assert "Zzz Redirected Book" in response.get_data(as_text=True)
+    assert "has been successfully added" in response.get_data(as_text=True)
+
+def test_patron_history_pages_cover_whole_history():
+    """Walking a patron's history page by page returns every record in order."""
+    records = []
+    page = get_patron_history_page("123456", page_size=1)
+    records.extend(page['borrowing_history'])
+    while page['next_cursor']:
+        page = get_patron_history_page("123456", page['next_cursor'], page_size=1)
+        records.extend(page['borrowing_history'])
+
+    assert records == get_patron_borrowing_history("123456")
+
+def test_patron_history_page_invalid_patron_id():
+    """An invalid patron ID returns None."""
+    assert get_patron_history_page("abc123") is None
@@ -2,8 +2,10 @@ import pytest
 from datetime import datetime, timedelta
 from services.library_service import (
     get_patron_status_report,
-    borrow_book_by_patron
+    borrow_book_by_patron,
+    calculate_late_fee_for_book
 )
+from database import get_patron_borrowed_books
 from .util import (
     mock_insert_borrow_record,
 )
@@ -71,4 +73,18 @@ def test_get_patron_status_report_borrowing_history():
         assert 'author' in record
         assert 'borrow_date' in record
         assert 'due_date' in record
-        assert 'return_date' in record
\ No newline at end of file
+        assert 'return_date' in record
+
+
+def test_get_patron_status_report_matches_per_book_lookups():
+    """The single-pass report agrees with the per-book borrowed list and late fee lookups."""
+    mock_borrow_date = (datetime.today() - timedelta(days=25))
+    success, patron_id, _ = mock_insert_borrow_record(book=None, patron_id="771234", borrow_date=mock_borrow_date, due_date=None)
+    if not success:
+        pytest.skip("Failed to insert mock borrow record.")
+    report = get_patron_status_report(patron_id)
+
+    borrowed_books = get_patron_borrowed_books(patron_id)
+    expected_fees = sum(calculate_late_fee_for_book(patron_id, book['book_id'])['fee_amount'] for book in borrowed_books)
+    assert [book['book_id'] for book in report['currently_borrowed_books']] == [book['book_id'] for book in borrowed_books]
+    assert report['total_late_fees_owed'] == expected_fees
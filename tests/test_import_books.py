@@ -0,0 +1,108 @@
+import io
+import json
+from app import create_app
+from database import db_connection, get_book_by_isbn, get_catalog_version
+from services.catalog_import import import_books
+from services.library_service import get_all_books, search_books_in_catalog
+
+def test_import_csv_adds_valid_rows_and_reports_the_rest():
+    '''Valid rows are added; invalid rows and repeated ISBNs are skipped and reported by line.'''
+    source = io.StringIO(
+        "title,author,isbn,total_copies\n"
+        "Import One,Author One,6690000000001,3\n"
+        ",Author Two,6690000000002,1\n"
+        "Import Three,Author Three,669000000003,1\n"
+        "Import Four,Author Four,6690000000004,zero\n"
+        "Import One Again,Author One,6690000000001,2\n"
+        "Import Five,Author Five,6690000000005,1\n"
+    )
+
+    result = import_books(source, 'csv', batch_size=2)
+
+    assert result['rows'] == 6
+    assert result['imported'] == 2
+    assert result['invalid'] == 3
+    assert result['duplicates'] == 1
+    assert result['rows_per_second'] > 0
+    assert [(error['line'], error['error']) for error in result['errors']] == [
+        (3, "Title is required."),
+        (4, "ISBN must be exactly 13 digits."),
+        (5, "Total copies must be a positive integer."),
+        (6, "Duplicate ISBN in this file."),
+    ]
+    book = get_book_by_isbn("6690000000001")
+    assert book['title'] == "Import One"
+    assert book['available_copies'] == 3
+    assert get_book_by_isbn("6690000000005") is not None
+
+def test_import_jsonl_skips_books_already_in_catalog():
+    '''Re-importing a file only adds the books that are new, and bad lines do not stop the import.'''
+    rows = [{'title': f"Import JSON {i}", 'author': "JSON Author", 'isbn': f"669000000010{i}", 'total_copies': 2}
+            for i in range(3)]
+    first = import_books(io.StringIO("\n".join(json.dumps(row) for row in rows[:2])), 'jsonl')
+    second = import_books(io.StringIO("\n".join(json.dumps(row) for row in rows) + "\n{not json\n[1]\n"), 'jsonl')
+
+    assert first['imported'] == 2
+    assert second['imported'] == 1
+    assert second['duplicates'] == 2
+    assert second['invalid'] == 2
+    assert get_book_by_isbn("6690000000102")['title'] == "Import JSON 2"
+
+def test_imported_books_are_searchable_and_listed():
+    '''Batch inserts still update the search index and catalog version, so listings and searches see them.'''
+    get_all_books()
+    with db_connection() as conn:
+        version = get_catalog_version(conn)
+
+    import_books(io.StringIO("title,author,isbn,total_copies\n"
+                             "Quixotic Imports,Batch Author,6690000000301,1\n"
+                             "Quixotic Imports II,Batch Author,6690000000302,1\n"), 'csv')
+
+    with db_connection() as conn:
+        assert get_catalog_version(conn) > version
+    assert {book['isbn'] for book in search_books_in_catalog("quixotic imp", "title")} == {
+        "6690000000301", "6690000000302"}
+    assert "6690000000302" in {book['isbn'] for book in get_all_books()}
+
+def test_import_endpoint_and_command(tmp_path):
+    '''Books can be imported through the API and the command line.'''
+    app = create_app()
+    response = app.test_client().post('/api/books/import', content_type='text/csv', data=(
+        "title,author,isbn,total_copies\nImport API,API Author,6690000000201,1\n"))
+
+    assert response.status_code == 200
+    assert response.json['imported'] == 1
+
+    path = tmp_path / "books.jsonl"
+    path.write_text(json.dumps({'title': "Import CLI", 'author': "CLI Author",
+                                'isbn': "6690000000202", 'total_copies': 4}) + "\n")
+    result = app.test_cli_runner().invoke(args=["import-books", str(path)])
+
+    assert result.exit_code == 0
+    assert "Imported 1 of 1 rows" in result.output
+    assert get_book_by_isbn("6690000000202")['total_copies'] == 4
+    assert app.test_client().post('/api/books/import', data="x").status_code == 400
+
+def test_unreadable_import_stops_at_the_failing_line(tmp_path):
+    '''A body that is not UTF-8 or not valid CSV is rejected at its line, keeping the rows before it.'''
+    app = create_app()
+    response = app.test_client().post('/api/books/import', content_type='text/csv', data=(
+        b"title,author,isbn,total_copies\nBefore Bad Byte,Author,6690000000501,1\n"
+        b"Bad \xff Byte,Author,6690000000502,1\nAfter Bad Byte,Author,6690000000503,1\n"))
+
+    assert response.status_code == 400
+    assert response.json['failed']['line'] == 3
+    assert response.json['error'].startswith("Line 3: File is not valid UTF-8")
+    assert response.json['imported'] == 1
+    assert get_book_by_isbn("6690000000501") is not None
+    assert get_book_by_isbn("6690000000503") is None
+
+    path = tmp_path / "books.csv"
+    path.write_text("title,author,isbn,total_copies\nBefore Long Field,Author,6690000000504,1\n"
+                    f"{'x' * 200000},Author,6690000000505,1\n")
+    result = app.test_cli_runner().invoke(args=["import-books", str(path)])
+
+    assert result.exit_code == 1
+    assert "line 3: Malformed CSV" in result.output
+    assert "1 books from the 1 rows before it were imported" in result.output
+    assert get_book_by_isbn("6690000000504") is not None
@@ -0,0 +1,98 @@
+import pytest
+from datetime import datetime, timedelta
+from app import create_app
+from database import (
+    check_patron_summaries,
+    db_connection,
+    get_patron_summary,
+    rebuild_patron_summaries,
+    refresh_overdue_counts
+)
+from services.library_service import (
+    borrow_book_by_patron,
+    return_book_by_patron,
+    get_all_books,
+    get_book_by_isbn
+)
+from .util import add_new_book_for_testing, mock_insert_borrow_record
+
+def new_book_id():
+    success, _, isbn = add_new_book_for_testing(get_all_books())
+    if not success:
+        pytest.skip("Failed to add a new book for testing.")
+    return get_book_by_isbn(isbn)['id']
+
+def set_open_loans(patron_id, open_loans):
+    """Corrupt a summary row directly, as drift would."""
+    with db_connection() as conn:
+        conn.execute('UPDATE patrons SET open_loans = ? WHERE patron_id = ?', (open_loans, patron_id))
+        conn.commit()
+
+def test_borrow_and_return_update_summary():
+    """Borrowing and returning keep the open loan count and last activity current."""
+    book_id = new_book_id()
+
+    assert borrow_book_by_patron("663001", book_id)[0] == True
+    summary = get_patron_summary("663001")
+    assert summary['open_loans'] == 1
+    assert summary['last_activity'].date() == datetime.today().date()
+
+    assert return_book_by_patron("663001", book_id)[0] == True
+    assert get_patron_summary("663001")['open_loans'] == 0
+    assert check_patron_summaries() == []
+
+def test_patron_without_loans_has_no_summary():
+    """A patron who never borrowed has no summary row."""
+    assert get_patron_summary("663099") is None
+
+def test_refresh_overdue_counts():
+    """Overdue loans are counted as of the last refresh and uncounted when returned."""
+    book_id = new_book_id()
+    mock_insert_borrow_record(book={'id': book_id}, patron_id="663101",
+                              borrow_date=datetime.today() - timedelta(days=20), due_date=None)
+
+    refresh_overdue_counts(datetime.now())
+    assert get_patron_summary("663101")['overdue_loans'] == 1
+
+    assert return_book_by_patron("663101", book_id)[0] == True
+    assert get_patron_summary("663101")['overdue_loans'] == 0
+    assert check_patron_summaries() == []
+
+def test_borrow_limit_reads_summary():
+    """The borrow limit check uses the summary table's open loan count."""
+    book_id = new_book_id()
+    assert borrow_book_by_patron("663201", book_id)[0] == True
+    set_open_loans("663201", 5)
+
+    success, message = borrow_book_by_patron("663201", new_book_id())
+
+    assert success == False
+    assert "maximum borrowing limit" in message
+    rebuild_patron_summaries()
+
+def test_rebuild_reports_and_repairs_drift():
+    """Rebuilding reports drifted values and restores the recomputed ones."""
+    book_id = new_book_id()
+    assert borrow_book_by_patron("663301", book_id)[0] == True
+    set_open_loans("663301", 3)
+
+    drift = rebuild_patron_summaries()
+
+    assert {'patron_id': "663301", 'field': 'open_loans', 'expected': 1, 'actual': 3} in drift
+    assert get_patron_summary("663301")['open_loans'] == 1
+    assert check_patron_summaries() == []
+
+def test_rebuild_patron_summary_command_verify_only():
+    """--verify-only reports drift, exits non-zero and leaves the table alone."""
+    book_id = new_book_id()
+    assert borrow_book_by_patron("663401", book_id)[0] == True
+    set_open_loans("663401", 4)
+    runner = create_app().test_cli_runner()
+
+    result = runner.invoke(args=["rebuild-patron-summary", "--verify-only"])
+
+    assert result.exit_code == 1
+    assert "Patron 663401: open_loans was 4, expected 1" in result.output
+    assert get_patron_summary("663401")['open_loans'] == 4
+    assert runner.invoke(args=["rebuild-patron-summary"]).exit_code == 0
+    assert get_patron_summary("663401")['open_loans'] == 1
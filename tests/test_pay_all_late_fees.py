@@ -0,0 +1,153 @@
+import threading
+from unittest.mock import Mock
+from app import create_app
+from database import get_payment_allocations
+from services.library_service import pay_all_late_fees, pay_late_fees
+from services.payment_service import PaymentGateway
+from .util import approving_gateway, borrow_days_ago
+
+def test_pay_all_late_fees_single_charge():
+    '''All overdue books are paid with one gateway call and the split is recorded.'''
+    first_book = borrow_days_ago("664001", 17)
+    second_book = borrow_days_ago("664001", 30)
+    borrow_days_ago("664001", 2)
+    gateway = approving_gateway("txn_664001_1")
+
+    success, message, payment = pay_all_late_fees("664001", gateway)
+
+    assert success == True
+    assert "payment successful" in message.lower()
+    gateway.process_payment.assert_called_once_with(
+        patron_id="664001", amount=14.0, description="Late fees for 2 overdue book(s)"
+    )
+    assert payment['transaction_id'] == "txn_664001_1"
+    assert payment['amount'] == 14.0
+    recorded = get_payment_allocations("txn_664001_1")
+    assert [(allocation['book_id'], allocation['amount']) for allocation in recorded] == [(first_book, 1.5), (second_book, 12.5)]
+
+def test_pay_all_late_fees_only_charges_what_is_outstanding():
+    '''Fees already paid towards a loan are not charged again.'''
+    borrow_days_ago("664101", 20)
+    assert pay_all_late_fees("664101", approving_gateway("txn_664101_1"))[0] == True
+    gateway = approving_gateway("txn_664101_2")
+
+    success, message, payment = pay_all_late_fees("664101", gateway)
+
+    assert success == False
+    assert "no late fees" in message.lower()
+    assert payment is None
+    gateway.process_payment.assert_not_called()
+
+def test_pay_all_late_fees_gateway_failure_records_nothing():
+    '''A declined charge records no allocations.'''
+    borrow_days_ago("664201", 25)
+    gateway = Mock(spec=PaymentGateway)
+    gateway.process_payment.return_value = (False, "", "Payment declined")
+
+    success, message, payment = pay_all_late_fees("664201", gateway)
+
+    assert success == False
+    assert "payment failed" in message.lower()
+    assert payment is None
+    assert pay_all_late_fees("664201", approving_gateway("txn_664201_1"))[2]['amount'] == 7.5
+
+def test_pay_all_late_fees_invalid_patron_id():
+    '''An invalid patron ID never reaches the gateway.'''
+    gateway = approving_gateway("txn_unused")
+
+    success, message, payment = pay_all_late_fees("12ab56", gateway)
+
+    assert success == False
+    assert "invalid patron id" in message.lower()
+    gateway.process_payment.assert_not_called()
+
+def test_pay_all_late_fees_endpoint(mocker):
+    '''The endpoint reports the payment and its per-book split.'''
+    book_id = borrow_days_ago("664301", 40)
+    mocker.patch("services.library_service.get_payment_gateway", return_value=approving_gateway("txn_664301_1"))
+    client = create_app().test_client()
+
+    response = client.post('/api/pay_late_fees/664301')
+
+    assert response.status_code == 200
+    assert response.json['payment']['allocations'][0]['book_id'] == book_id
+    assert response.json['payment']['amount'] == 15.0
+    assert client.post('/api/pay_late_fees/664302').status_code == 400
+
+def test_concurrent_payments_do_not_charge_the_same_fees():
+    '''While one payment is at the gateway, a second submission finds its fees reserved and charges nothing.'''
+    borrow_days_ago("664401", 25)
+    at_gateway = threading.Event()
+    release = threading.Event()
+    first_gateway = approving_gateway("txn_664401_1")
+
+    def slow_charge(**kwargs):
+        at_gateway.set()
+        release.wait(5)
+        return (True, "txn_664401_1", "Payment processed successfully")
+
+    first_gateway.process_payment.side_effect = slow_charge
+    results = {}
+    first = threading.Thread(target=lambda: results.update(
+        first=pay_all_late_fees("664401", first_gateway, idempotency_key="payment-job-664401-1")))
+    first.start()
+    assert at_gateway.wait(5)
+    second_gateway = approving_gateway("txn_664401_2")
+
+    second = pay_all_late_fees("664401", second_gateway, idempotency_key="payment-job-664401-2")
+    release.set()
+    first.join(5)
+
+    assert second[0] == False
+    assert "already in progress" in second[1].lower()
+    second_gateway.process_payment.assert_not_called()
+    assert results['first'][0] == True
+    assert results['first'][2]['amount'] == 7.5
+    assert [allocation['amount'] for allocation in get_payment_allocations("txn_664401_1")] == [7.5]
+
+def test_unrecorded_charge_is_not_repeated(mocker):
+    '''If the outcome of a successful charge cannot be stored, its fees stay reserved instead of being charged again.'''
+    borrow_days_ago("664501", 20)
+    mocker.patch("services.library_service.finish_payment", return_value=False)
+    assert pay_all_late_fees("664501", approving_gateway("txn_664501_1"))[0] == True
+    gateway = approving_gateway("txn_664501_2")
+
+    success, message, payment = pay_all_late_fees("664501", gateway)
+
+    assert success == False
+    assert "already in progress" in message.lower()
+    gateway.process_payment.assert_not_called()
+
+def test_book_and_consolidated_payments_share_allocations():
+    '''Fees paid book by book are not charged again by pay_all_late_fees, and the other way round.'''
+    first_book = borrow_days_ago("664601", 20)
+    second_book = borrow_days_ago("664601", 20)
+    gateway = approving_gateway("txn_664601_1")
+    gateway.process_payment.side_effect = [(True, f"txn_664601_{i}", "Payment processed successfully") for i in (1, 2)]
+
+    assert pay_late_fees("664601", first_book, gateway)[0] == True
+    assert pay_late_fees("664601", second_book, gateway)[0] == True
+    success, message, _ = pay_all_late_fees("664601", gateway)
+
+    assert success == False
+    assert message == "No late fees to pay."
+    assert gateway.process_payment.call_count == 2
+
+    book_id = borrow_days_ago("664701", 20)
+    other_gateway = approving_gateway("txn_664701_1")
+    assert pay_all_late_fees("664701", other_gateway)[0] == True
+
+    assert pay_late_fees("664701", book_id, other_gateway) == (
+        False, "The late fees for this book have already been paid.", None)
+    other_gateway.process_payment.assert_called_once()
+
+def test_book_payment_waits_for_consolidated_payment_in_progress(mocker):
+    '''A book whose fee is reserved by a consolidated charge still in flight is not charged on its own.'''
+    book_id = borrow_days_ago("664801", 20)
+    mocker.patch("services.library_service.finish_payment")  # leave the consolidated charge pending
+    pay_all_late_fees("664801", approving_gateway("txn_664801_1"))
+    mocker.stopall()
+    gateway = approving_gateway("txn_664801_2")
+
+    assert pay_late_fees("664801", book_id, gateway) == (False, "This payment is already in progress.", None)
+    gateway.process_payment.assert_not_called()
@@ -0,0 +1,103 @@
+import pytest
+import requests
+import time
+from services.library_service import pay_late_fees
+from services.payment_service import GatewayError, PaymentGateway
+from services.stub_gateway import start_stub_gateway
+
+@pytest.fixture
+def stub_server():
+    """A stub payment gateway on a free local port."""
+    server = start_stub_gateway()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_charge_refund_and_status_over_http(stub_server):
+    '''Calls go to the gateway over HTTP and share one keep-alive connection.'''
+    with PaymentGateway(base_url=stub_server.url) as gateway:
+        success, transaction_id, message = gateway.process_payment("123456", 10.5, "Late fees")
+        status = gateway.verify_payment_status(transaction_id)
+        refunded, refund_message = gateway.refund_payment(transaction_id, 10.5)
+
+    assert success == True
+    assert transaction_id.startswith("txn_123456_")
+    assert "payment of $10.50 processed successfully" in message.lower()
+    assert status['amount'] == 10.5
+    assert refunded == True
+    assert "refund of $10.50 processed successfully" in refund_message.lower()
+    assert stub_server.connections == 1
+
+def test_gateway_declines_are_reported(stub_server):
+    '''Declined charges and unknown transactions are failures, not errors.'''
+    with PaymentGateway(base_url=stub_server.url) as gateway:
+        assert gateway.process_payment("123456", 2000.0) == (False, "", "Payment declined: amount exceeds limit")
+        assert gateway.refund_payment("txn_unknown", 5.0) == (False, "Invalid transaction ID")
+        assert gateway.verify_payment_status("txn_unknown")['status'] == "not_found"
+
+def test_unpooled_gateway_opens_a_connection_per_call(stub_server):
+    '''With pooling off every call pays for a new connection.'''
+    gateway = PaymentGateway(base_url=stub_server.url, pooled=False)
+    for _ in range(3):
+        assert gateway.process_payment("123456", 5.0)[0] == True
+
+    assert stub_server.connections == 3
+
+def test_retryable_responses_are_retried_then_raised(stub_server):
+    '''503 responses are retried with backoff, and the last one raises instead of reading as a decline.'''
+    stub_server.failure_rate = 1.0
+    with PaymentGateway(base_url=stub_server.url, max_retries=2, backoff_base=0.001) as gateway:
+        with pytest.raises(GatewayError) as error:
+            gateway.process_payment("123456", 5.0)
+
+    assert error.value.status_code == 503
+    assert str(error.value) == "Service temporarily unavailable"
+    assert stub_server.requests == 3
+
+def test_unavailable_gateway_does_not_fail_the_payment(stub_server, overdue_book):
+    '''A payment that hit a gateway outage can succeed with the same key once the gateway recovers.'''
+    stub_server.failure_rate = 1.0
+    with PaymentGateway(base_url=stub_server.url, max_retries=1, backoff_base=0.001) as gateway:
+        first = pay_late_fees("669601", 999, gateway, idempotency_key="key-669601")
+        stub_server.failure_rate = 0.0
+        second = pay_late_fees("669601", 999, gateway, idempotency_key="key-669601")
+
+    assert first[0] == False
+    assert "payment processing error" in first[1].lower()
+    assert second[0] == True
+    assert len(stub_server.charges) == 1
+
+def test_timed_out_charge_is_not_charged_twice(stub_server, overdue_book):
+    '''A charge whose response timed out is found by its idempotency key on retry instead of being made again.'''
+    stub_server.latency = 0.3
+    with PaymentGateway(base_url=stub_server.url, read_timeout=0.1, max_retries=0) as gateway:
+        first = pay_late_fees("669602", 999, gateway, idempotency_key="key-669602")
+    time.sleep(0.4)  # the gateway finishes the charge after the client gave up
+    stub_server.latency = 0.0
+    with PaymentGateway(base_url=stub_server.url) as gateway:
+        second = pay_late_fees("669602", 999, gateway, idempotency_key="key-669602")
+
+    assert first[0] == False
+    assert second[0] == True
+    assert len(stub_server.charges) == 1
+    assert second[2] in stub_server.charges
+
+def test_idempotency_key_prevents_duplicate_charges(stub_server):
+    '''A retried charge with the same idempotency key gets the original transaction.'''
+    headers = {"Idempotency-Key": "retry-test"}
+    payload = {"customer_id": "123456", "amount": 5.0}
+
+    first = requests.post(f"{stub_server.url}/charges", json=payload, headers=headers).json()
+    second = requests.post(f"{stub_server.url}/charges", json=payload, headers=headers).json()
+
+    assert first['transaction_id'] == second['transaction_id']
+    assert len(stub_server.charges) == 1
+
+def test_read_timeout_raises_after_retries(stub_server):
+    '''A gateway slower than the read timeout raises once retries run out.'''
+    stub_server.latency = 0.3
+    with PaymentGateway(base_url=stub_server.url, read_timeout=0.05, max_retries=1, backoff_base=0.001) as gateway:
+        with pytest.raises(requests.Timeout):
+            gateway.process_payment("123456", 5.0)
+
+    assert stub_server.requests == 2
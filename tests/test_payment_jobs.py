@@ -0,0 +1,188 @@
+import pytest
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+from app import create_app
+import services.payment_jobs
+from database import begin_payment, claim_payment_job, finish_payment_job, get_payment_by_key, get_payment_job
+from services.payment_jobs import (
+    JOB_LEASE_SECONDS,
+    PaymentWorkerPool,
+    enqueue_payment_job,
+    reconcile_stale_payments,
+    run_next_payment_job,
+    start_payment_workers,
+    stop_payment_workers
+)
+from services.library_service import pay_all_late_fees
+from services.payment_service import PaymentGateway
+from .util import approving_gateway, borrow_days_ago
+
+@pytest.fixture(autouse=True)
+def no_background_workers():
+    """Stop the background workers so each test decides when jobs run."""
+    stop_payment_workers()
+    yield
+    stop_payment_workers()
+
+def wait_for_job(job_id, timeout=5.0):
+    """Poll a job until it finishes or the timeout passes."""
+    deadline = time.monotonic() + timeout
+    job = get_payment_job(job_id)
+    while job['status'] in ('queued', 'running') and time.monotonic() < deadline:
+        time.sleep(0.02)
+        job = get_payment_job(job_id)
+    return job
+
+def test_payment_job_waits_in_queue_until_run(mocker, overdue_book):
+    '''A queued payment stays queued until a worker runs it, then records the gateway's result.'''
+    gateway = Mock(spec=PaymentGateway)
+    gateway.process_payment.return_value = (True, "txn_665001_1", "Payment of $5.00 processed successfully")
+    mocker.patch("services.library_service.get_payment_gateway", return_value=gateway)
+
+    job_id = enqueue_payment_job('pay_late_fees', {'patron_id': "665001", 'book_id': 999})
+
+    assert get_payment_job(job_id)['status'] == 'queued'
+    gateway.process_payment.assert_not_called()
+
+    assert run_next_payment_job() == True
+    job = get_payment_job(job_id)
+    assert job['status'] == 'succeeded'
+    assert job['attempts'] == 1
+    assert job['result']['transaction_id'] == "txn_665001_1"
+    assert run_next_payment_job() == False
+
+def test_rejected_payment_job_is_failed():
+    '''A job whose payment is rejected finishes as failed with the service's message.'''
+    job_id = enqueue_payment_job('refund_late_fee_payment', {'transaction_id': "bad_id", 'amount': 5.0})
+
+    run_next_payment_job()
+
+    job = get_payment_job(job_id)
+    assert job['status'] == 'failed'
+    assert job['result'] == {'success': False, 'message': "Invalid transaction ID."}
+
+def test_interrupted_job_is_taken_over_after_its_lease():
+    '''A running job whose worker died is claimed again once its lease expires.'''
+    job_id = enqueue_payment_job('pay_all_late_fees', {'patron_id': "665101"})
+    now = datetime.now()
+
+    assert claim_payment_job(60, now)['id'] == job_id
+    assert claim_payment_job(60, now + timedelta(seconds=30)) is None
+
+    reclaimed = claim_payment_job(60, now + timedelta(seconds=61))
+    assert reclaimed['id'] == job_id
+    assert reclaimed['attempts'] == 2
+    finish_payment_job(job_id, 'failed', {'success': False, 'message': "Cancelled by test"})
+
+def test_charge_cut_off_with_its_worker_is_settled_on_takeover(mocker, overdue_book):
+    '''A job taken over after its worker died mid-charge looks the charge up instead of reporting it in progress.'''
+    gateway = Mock(spec=PaymentGateway)
+    gateway.verify_payment_status.return_value = {"transaction_id": "txn_665401_1", "status": "completed"}
+    mocker.patch("services.library_service.get_payment_gateway", return_value=gateway)
+    job_id = enqueue_payment_job('pay_late_fees', {'patron_id': "665401", 'book_id': 999})
+
+    # The first worker claimed the job and began the charge, then died
+    claim_payment_job(JOB_LEASE_SECONDS, datetime.now() - timedelta(seconds=JOB_LEASE_SECONDS + 1))
+    begin_payment(f"payment-job-{job_id}", "665401", 999, 5.0)
+
+    assert run_next_payment_job() == True
+    job = get_payment_job(job_id)
+    assert job['status'] == 'succeeded'
+    assert job['result']['transaction_id'] == "txn_665401_1"
+    gateway.process_payment.assert_not_called()
+    gateway.verify_payment_status.assert_called_once_with(idempotency_key=f"payment-job-{job_id}")
+
+def test_interrupted_refund_job_is_set_aside_for_review(mocker):
+    '''A refund job taken over after its worker died is not sent to the gateway again.'''
+    gateway = Mock(spec=PaymentGateway)
+    mocker.patch("services.library_service.get_payment_gateway", return_value=gateway)
+    job_id = enqueue_payment_job('refund_late_fee_payment', {'transaction_id': "txn_665701_1", 'amount': 5.0})
+    claim_payment_job(JOB_LEASE_SECONDS, datetime.now() - timedelta(seconds=JOB_LEASE_SECONDS + 1))
+
+    assert run_next_payment_job() == True
+    job = get_payment_job(job_id)
+    assert job['status'] == 'needs_review'
+    assert job['result']['success'] == False
+    gateway.refund_payment.assert_not_called()
+
+def test_stale_pending_payments_are_reconciled(mocker):
+    '''Charges pending for longer than a job lease are settled with the gateway; recent ones are left alone.'''
+    gateway = Mock(spec=PaymentGateway)
+    gateway.verify_payment_status.return_value = {"status": "not_found", "message": "Transaction not found"}
+    mocker.patch("services.library_service.get_payment_gateway", return_value=gateway)
+    begin_payment("key-665501", "665501", 999, 5.0)
+
+    assert reconcile_stale_payments() == 0
+    assert get_payment_by_key("key-665501")['status'] == 'pending'
+
+    assert reconcile_stale_payments(datetime.now() + timedelta(seconds=JOB_LEASE_SECONDS + 1)) >= 1
+    assert get_payment_by_key("key-665501")['status'] == 'error'
+    gateway.verify_payment_status.assert_any_call(idempotency_key="key-665501")
+
+def test_interrupted_keyless_payment_stops_blocking_the_patron(mocker):
+    '''A keyless charge left pending is expired after a lease, releasing the fees it had reserved.'''
+    borrow_days_ago("665601", 20)
+    gateway = approving_gateway("txn_665601_1")
+    mocker.patch("services.library_service.finish_payment")  # the process dies before recording the result
+    pay_all_late_fees("665601", gateway)
+    mocker.stopall()
+
+    assert "already in progress" in pay_all_late_fees("665601", gateway)[1]
+    assert reconcile_stale_payments(datetime.now() + timedelta(seconds=JOB_LEASE_SECONDS + 1)) >= 1
+
+    assert pay_all_late_fees("665601", gateway)[0] == True
+    gateway.verify_payment_status.assert_not_called()
+
+def test_worker_logs_errors_and_backs_off(mocker, caplog):
+    '''A worker whose job check keeps failing logs the error and waits longer before each retry.'''
+    run = mocker.patch("services.payment_jobs.run_next_payment_job",
+                       side_effect=sqlite3.OperationalError("database is locked"))
+    workers = PaymentWorkerPool(workers=1, poll_interval=0.05)
+    workers.start()
+    time.sleep(0.5)
+    workers.stop(5)
+
+    assert 1 <= run.call_count <= 3  # waits of 0.1, 0.2, 0.4 s rather than one poll interval each
+    assert "Payment worker error" in caplog.text
+    assert "database is locked" in caplog.text
+
+def test_app_and_commands_do_not_start_workers():
+    '''Building the app (e.g. for a command line task) does not start payment workers.'''
+    app = create_app()
+
+    result = app.test_cli_runner().invoke(args=["export-data", "books"])
+
+    assert result.exit_code == 0
+    assert services.payment_jobs._workers is None
+
+def test_unknown_job_kind_is_rejected():
+    '''Only known job kinds can be queued.'''
+    with pytest.raises(ValueError):
+        enqueue_payment_job('charge_everyone', {})
+
+def test_payment_endpoints_accept_and_report_jobs():
+    '''Submitting a payment answers 202 at once; the workers finish it and the status endpoint reports it.'''
+    client = create_app().test_client()
+
+    response = client.post('/api/payments/late_fees', json={'patron_id': "665201"})
+
+    assert response.status_code == 202
+    assert response.headers['Location'] == response.json['status_url']
+    assert client.get(response.json['status_url']).json['status'] == 'queued'
+
+    # Jobs queued before the workers (re)start are still processed
+    start_payment_workers()
+    job = wait_for_job(response.json['job_id'])
+    assert job['status'] == 'failed'
+    assert "no late fees" in job['result']['message'].lower()
+
+def test_payment_endpoints_validate_requests():
+    '''Malformed submissions and unknown jobs are rejected.'''
+    client = create_app().test_client()
+
+    assert client.post('/api/payments/late_fees', json={'book_id': 1}).status_code == 400
+    assert client.post('/api/payments/late_fees', json={'patron_id': "665301", 'book_id': "1"}).status_code == 400
+    assert client.post('/api/payments/refunds', json={'transaction_id': "txn_1"}).status_code == 400
+    assert client.get('/api/payments/jobs/999999').status_code == 404
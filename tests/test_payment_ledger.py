@@ -0,0 +1,196 @@
+import requests
+from unittest.mock import Mock
+from database import begin_payment, get_payment_by_key, get_payment_by_transaction
+from app import create_app
+from services.library_service import (
+    IDEMPOTENCY_KEY_REUSED,
+    get_payment_status,
+    pay_all_late_fees,
+    pay_late_fees,
+    refund_late_fee_payment
+)
+from services.payment_service import PaymentGateway
+from .util import approving_gateway, borrow_days_ago
+
+def test_repeated_key_returns_recorded_result(overdue_book):
+    '''A retry with the same idempotency key is answered from the ledger without charging again.'''
+    gateway = approving_gateway("txn_667001_1")
+
+    first = pay_late_fees("667001", 999, gateway, idempotency_key="key-667001")
+    second = pay_late_fees("667001", 999, gateway, idempotency_key="key-667001")
+
+    assert first == second
+    assert first[0] == True
+    assert first[2] == "txn_667001_1"
+    gateway.process_payment.assert_called_once()
+    assert get_payment_by_key("key-667001")['status'] == 'completed'
+
+def test_declined_payment_is_replayed(overdue_book):
+    '''A declined charge is recorded, and retrying its key returns the same decline.'''
+    gateway = Mock(spec=PaymentGateway)
+    gateway.process_payment.return_value = (False, "", "Payment declined")
+
+    first = pay_late_fees("667101", 999, gateway, idempotency_key="key-667101")
+    second = pay_late_fees("667101", 999, gateway, idempotency_key="key-667101")
+
+    assert first == second == (False, "Payment failed: Payment declined", None)
+    gateway.process_payment.assert_called_once()
+
+def test_unreachable_gateway_can_be_retried(overdue_book):
+    '''A charge that errored before reaching the gateway may be retried with the same key.'''
+    gateway = approving_gateway("txn_667201_1")
+    gateway.process_payment.side_effect = [ConnectionError("network error"), gateway.process_payment.return_value]
+
+    first = pay_late_fees("667201", 999, gateway, idempotency_key="key-667201")
+    second = pay_late_fees("667201", 999, gateway, idempotency_key="key-667201")
+
+    assert first[0] == False
+    assert "payment processing error" in first[1].lower()
+    assert second[0] == True
+    assert gateway.process_payment.call_count == 2
+
+def test_key_in_progress_is_not_charged_again(overdue_book):
+    '''A key whose charge is still pending is reported as in progress.'''
+    begin_payment("key-667301", "667301", 999, 5.0)
+    gateway = approving_gateway("txn_667301_1")
+
+    success, message, transaction_id = pay_late_fees("667301", 999, gateway, idempotency_key="key-667301")
+
+    assert success == False
+    assert "already in progress" in message.lower()
+    gateway.process_payment.assert_not_called()
+
+def test_status_of_recorded_payment_is_served_from_ledger(overdue_book):
+    '''Finished payments are reported from the ledger; unknown ones are checked with the gateway.'''
+    gateway = approving_gateway("txn_667401_1")
+    pay_late_fees("667401", 999, gateway)
+    gateway.verify_payment_status.return_value = {"transaction_id": "txn_667401_x", "status": "completed"}
+
+    status = get_payment_status("txn_667401_1", gateway)
+    unknown = get_payment_status("txn_667401_x", gateway)
+
+    assert status['status'] == 'completed'
+    assert status['source'] == 'ledger'
+    assert status['amount'] == 5.0
+    assert unknown['source'] == 'gateway'
+    gateway.verify_payment_status.assert_called_once_with("txn_667401_x")
+
+def test_refund_is_recorded_in_ledger(overdue_book):
+    '''A full refund marks the payment refunded.'''
+    gateway = approving_gateway("txn_667501_1")
+    pay_late_fees("667501", 999, gateway)
+
+    assert refund_late_fee_payment("txn_667501_1", 5.0, gateway)[0] == True
+
+    status = get_payment_status("txn_667501_1", gateway)
+    assert status['status'] == 'refunded'
+    assert status['refunded_amount'] == 5.0
+    gateway.verify_payment_status.assert_not_called()
+
+def test_pay_all_late_fees_replays_payment():
+    '''Retrying a consolidated payment returns the original payment and its split.'''
+    book_id = borrow_days_ago("667601", 20)
+    gateway = approving_gateway("txn_667601_1")
+
+    first = pay_all_late_fees("667601", gateway, idempotency_key="key-667601")
+    second = pay_all_late_fees("667601", gateway, idempotency_key="key-667601")
+
+    assert second[0] == True
+    assert second[2]['transaction_id'] == first[2]['transaction_id'] == "txn_667601_1"
+    assert second[2]['amount'] == 3.0
+    assert [allocation['book_id'] for allocation in second[2]['allocations']] == [book_id]
+    gateway.process_payment.assert_called_once()
+
+def test_timed_out_charge_is_settled_not_repeated(overdue_book):
+    '''A charge that timed out is recorded as unknown and looked up by its key before any retry.'''
+    gateway = approving_gateway("txn_667701_1")
+    gateway.process_payment.side_effect = requests.ReadTimeout("read timed out")
+    gateway.verify_payment_status.return_value = {"transaction_id": "txn_667701_1", "status": "completed"}
+
+    first = pay_late_fees("667701", 999, gateway, idempotency_key="key-667701")
+    assert first[0] == False
+    assert "payment processing error" in first[1].lower()
+    assert get_payment_by_key("key-667701")['status'] == 'unknown'
+
+    second = pay_late_fees("667701", 999, gateway, idempotency_key="key-667701")
+
+    assert second[0] == True
+    assert second[2] == "txn_667701_1"
+    gateway.process_payment.assert_called_once()
+    gateway.verify_payment_status.assert_called_once_with(idempotency_key="key-667701")
+    assert get_payment_by_key("key-667701")['status'] == 'completed'
+
+def test_unknown_charge_stays_unknown_until_gateway_answers(overdue_book):
+    '''While the gateway cannot say what happened to a charge, retries neither charge nor fail it.'''
+    gateway = approving_gateway("txn_667801_1")
+    gateway.process_payment.side_effect = TimeoutError("deadline exceeded")
+    gateway.verify_payment_status.side_effect = requests.ConnectionError("network error")
+
+    pay_late_fees("667801", 999, gateway, idempotency_key="key-667801")
+    success, message, _ = pay_late_fees("667801", 999, gateway, idempotency_key="key-667801")
+
+    assert success == False
+    assert "not known yet" in message
+    gateway.process_payment.assert_called_once()
+    assert get_payment_by_key("key-667801")['status'] == 'unknown'
+
+def test_unknown_charge_the_gateway_never_received_is_retried(overdue_book):
+    '''If the gateway has no charge for the key, the retry charges it.'''
+    gateway = approving_gateway("txn_667901_1")
+    gateway.process_payment.side_effect = [requests.ReadTimeout("read timed out"), gateway.process_payment.return_value]
+    gateway.verify_payment_status.return_value = {"status": "not_found", "message": "Transaction not found"}
+
+    pay_late_fees("667901", 999, gateway, idempotency_key="key-667901")
+    second = pay_late_fees("667901", 999, gateway, idempotency_key="key-667901")
+
+    assert second[0] == True
+    assert gateway.process_payment.call_count == 2
+    assert gateway.process_payment.call_args.kwargs['idempotency_key'] == "key-667901"
+
+def test_same_second_simulated_charges_are_both_recorded(overdue_book, monkeypatch):
+    '''The simulated gateway gives every charge its own transaction ID, even within one second.'''
+    monkeypatch.setattr("services.payment_service.PAYMENT_LATENCY", 0)
+    gateway = PaymentGateway()
+
+    first = pay_late_fees("668301", 999, gateway)
+    second = pay_late_fees("668301", 999, gateway)
+
+    assert first[2] != second[2]
+    assert get_payment_by_transaction(first[2])['status'] == 'completed'
+    assert get_payment_by_transaction(second[2])['status'] == 'completed'
+
+def test_unrecorded_charge_is_logged(overdue_book, caplog):
+    '''A charge the ledger cannot record is still reported as charged, and the failure is logged.'''
+    gateway = approving_gateway("txn_668401_1")
+    pay_late_fees("668401", 999, gateway)
+
+    with caplog.at_level("ERROR"):
+        success, _, transaction_id = pay_late_fees("668401", 999, gateway)
+
+    assert success == True
+    assert transaction_id == "txn_668401_1"
+    assert "could not be recorded" in caplog.text
+
+def test_key_reused_for_another_payment_is_rejected(overdue_book):
+    '''A key already used by another patron or for another book is refused without charging.'''
+    gateway = approving_gateway("txn_668501_1")
+    pay_late_fees("668501", 999, gateway, idempotency_key="key-668501")
+
+    other_patron = pay_late_fees("668502", 999, gateway, idempotency_key="key-668501")
+    other_book = pay_late_fees("668501", 998, gateway, idempotency_key="key-668501")
+    all_fees = pay_all_late_fees("668501", gateway, idempotency_key="key-668501")
+
+    assert other_patron == other_book == (False, IDEMPOTENCY_KEY_REUSED, None)
+    assert all_fees == (False, IDEMPOTENCY_KEY_REUSED, None)
+    gateway.process_payment.assert_called_once()
+
+def test_payment_endpoint_rejects_reused_key(overdue_book):
+    '''Queuing a payment with a key that belongs to another payment answers 422.'''
+    pay_late_fees("668601", 999, approving_gateway("txn_668601_1"), idempotency_key="key-668601")
+    client = create_app().test_client()
+
+    response = client.post('/api/payments/late_fees', json={'patron_id': "668602", 'book_id': 999},
+                           headers={'Idempotency-Key': "key-668601"})
+
+    assert response.status_code == 422
+    assert response.json['error'] == IDEMPOTENCY_KEY_REUSED
@@ -2,6 +2,7 @@ import pytest
 from datetime import datetime, timedelta
 from services.library_service import (
     return_book_by_patron,
+    return_book_with_late_fee,
     get_all_books,
     get_book_by_id,
     get_book_by_isbn
@@ -11,6 +12,7 @@ from .util import (
     generate_patron_id_under_borrow_limit,
     add_new_book_for_testing,
     get_nonexistent_book_id,
+    mock_insert_borrow_record,
 )
 
 def test_return_book_valid():
@@ -59,3 +61,33 @@ def test_return_book_and_update_availability():
     
     available_after = get_book_by_id(book_id)['available_copies']
     assert available_after_borrow + 1 == available_after
+
+def test_return_book_reports_late_fee():
+    """Test that returning an overdue book reports its late fee in the same call."""
+    add_book_success, _, book_isbn = add_new_book_for_testing(get_all_books())
+    if not add_book_success:
+        pytest.skip("Failed to add a book for testing return functionality.")
+    mock_borrow_date = (datetime.today() - timedelta(days=29))
+    success, patron_id, book_id = mock_insert_borrow_record(book=get_book_by_isbn(book_isbn), patron_id=None, borrow_date=mock_borrow_date, due_date=None)
+    if not success:
+        pytest.skip("Failed to insert mock borrow record.")
+    success, message, late_fee = return_book_with_late_fee(patron_id, book_id)
+
+    assert success == True
+    assert late_fee['fee_amount'] == 11.5  # (7 days * $0.50) + (8 days * $1.00)
+    assert late_fee['days_overdue'] == 15
+    assert "late fee: $11.50" in message.lower()
+
+def test_return_book_twice_fails():
+    """Test that a loan can only be returned once."""
+    success, patron_id, book_id = mock_borrow_book(get_all_books())
+    if not success:
+        pytest.skip("Failed to borrow a book for testing return functionality.")
+    available_before = get_book_by_id(book_id)['available_copies']
+
+    assert return_book_by_patron(patron_id, book_id)[0] == True
+    success, message = return_book_by_patron(patron_id, book_id)
+
+    assert success == False
+    assert "not borrowed" in message.lower()
+    assert get_book_by_id(book_id)['available_copies'] == available_before + 1
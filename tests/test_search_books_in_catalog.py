@@ -1,7 +1,9 @@
 import pytest
+import database
 
 from services.library_service import (
     get_all_books,
+    normalize_isbn,
     search_books_in_catalog
 )
 from .util import (
@@ -58,3 +60,68 @@ def test_search_books_no_results():
     
     assert isinstance(books, list)
     assert len(books) == 0
+
+def test_search_books_partial_match_inside_word():
+    """Test that title search matches text in the middle of a word, case-insensitively."""
+    books = search_books_in_catalog("GATSB", "title")
+
+    assert [book['title'] for book in books] == ["The Great Gatsby"]
+
+def test_search_books_short_search_term():
+    """Test that search terms too short for the full-text index still match."""
+    books = search_books_in_catalog("19", "title")
+
+    assert "1984" in [book['title'] for book in books]
+
+def test_search_books_finds_newly_added_book():
+    """Test that a book is searchable as soon as it is added to the catalog."""
+    success, _, isbn = add_new_book_for_testing(get_all_books(), title="Zyxwvut Unusual Title")
+    if not success:
+        pytest.skip("Failed to add a new book for testing.")
+
+    books = search_books_in_catalog("wvut unus", "title")
+
+    assert [book['isbn'] for book in books] == [isbn]
+
+def test_search_books_respects_limit():
+    """Test that no more than the requested number of results is returned."""
+    books = search_books_in_catalog("Test Book", "title", limit=2)
+
+    assert len(books) == 2
+    for book in books:
+        assert "test book" in book['title'].lower()
+
+def test_search_books_without_fulltext_index(monkeypatch, tmp_path):
+    """Test that search falls back to a table scan when the full-text index is missing."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "no_fts.db"))
+    database.init_database()
+    database.add_sample_data()
+    with database.db_connection() as conn:
+        conn.execute('DROP TABLE books_fts')
+        conn.commit()
+
+    books = search_books_in_catalog("mockingbird", "title")
+    database.close_pool()
+
+    assert [book['title'] for book in books] == ["To Kill a Mockingbird"]
+
+def test_search_books_by_isbn_with_hyphens_and_isbn10():
+    """Test that ISBN search accepts hyphenated ISBN-13 and ISBN-10 forms."""
+    hyphenated = search_books_in_catalog("978-0-7432-7356-5", "isbn")
+    isbn10 = search_books_in_catalog("0-7432-7356-7", "isbn")
+
+    assert [book['title'] for book in hyphenated] == ["The Great Gatsby"]
+    assert [book['title'] for book in isbn10] == ["The Great Gatsby"]
+
+def test_search_books_by_multiple_isbns():
+    """Test looking up several comma-separated ISBNs in one search."""
+    books = search_books_in_catalog("9780061120084, 9780743273565,9999999999990", "isbn")
+
+    assert [book['isbn'] for book in books] == ["9780061120084", "9780743273565"]
+
+def test_normalize_isbn():
+    """Test ISBN normalization rules."""
+    assert normalize_isbn("978 0 06 112008 4") == "9780061120084"
+    assert normalize_isbn("0-06-112008-1") == "9780061120084"
+    assert normalize_isbn("080442957x") == "9780804429573"
+    assert normalize_isbn("0061120082") == "0061120082"  # Invalid ISBN-10 check digit is left alone
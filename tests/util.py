@@ -1,4 +1,6 @@
+import pytest
 from datetime import datetime, timedelta
+from unittest.mock import Mock
 from services.library_service import (
     add_book_to_catalog,
     get_patron_borrow_count,
@@ -6,6 +8,7 @@ from services.library_service import (
     get_all_books,
     get_book_by_isbn
 )
+from services.payment_service import PaymentGateway
 from database import insert_borrow_record, setup_database_for_testing
 
 def add_new_book_for_testing(all_books, title=None, author=None, available_copies=5):
@@ -77,6 +80,29 @@ def mock_insert_borrow_record(book=None, patron_id=None, borrow_date=None, due_d
     insert_borrow_record(patron_id, book_id, borrow_date, due_date)
     return True, patron_id, book_id
 
+def borrow_new_book_days_ago(patron_id, days):
+    """Helper function to insert an open loan of a fresh book borrowed `days` days ago; returns the book ID or None."""
+    success, _, isbn = add_new_book_for_testing(get_all_books())
+    if not success:
+        return None
+    _, _, book_id = mock_insert_borrow_record(book=get_book_by_isbn(isbn), patron_id=patron_id,
+                                              borrow_date=datetime.today() - timedelta(days=days), due_date=None)
+    return book_id
+
+def borrow_days_ago(patron_id, days):
+    """Helper function to insert an open loan of a fresh book borrowed `days` days ago; skips the test if it cannot."""
+    book_id = borrow_new_book_days_ago(patron_id, days)
+    if book_id is None:
+        pytest.skip("Failed to add a new book for testing.")
+    return book_id
+
+def approving_gateway(transaction_id):
+    """Helper function to make a mock gateway that approves every charge and refund, charging with the given transaction ID."""
+    gateway = Mock(spec=PaymentGateway)
+    gateway.process_payment.return_value = (True, transaction_id, "Payment processed successfully")
+    gateway.refund_payment.return_value = (True, "Refund processed successfully")
+    return gateway
+
 def setup_pretest_database():
     """
     Pre-test setup function to clear the database and prepopulate with test books.